@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Assets
+#
+# Works out the attachment name of every image in the doc set (deduplicated by
+# content, and unique by name), and copies them to the attachments directory.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# the name of the directory (in the output directory) that attachments are copied to.
+ATTACHMENTS_DIRNAME = "attachments"
+
+
+def plan_attachments(image_paths, srcdir, hasher):
+    """
+    Works out the attachment name for each image. Images with the same contents share a single
+    attachment. Images with different contents but the same basename get the start of their content
+    hash added to their names, so that they don't overwrite each other.
+
+    image_paths:
+       The paths (relative to *srcdir*) of the images used in the doc set.
+    hasher:
+       A SourceHasher used to hash the images.
+
+    Returns a tuple of two dicts: (image path -> attachment name, attachment name -> (source path,
+    content hash)).
+    """
+    by_hash = {}
+    for image_path in sorted(image_paths):
+        content_hash = hasher.hash(os.path.join(srcdir, image_path))
+        if content_hash is None:
+            # a missing image; Sphinx will have warned about it already.
+            continue
+        by_hash.setdefault(content_hash, []).append(image_path)
+
+    # find out which basenames are used by more than one distinct image.
+    basename_count = {}
+    for paths in by_hash.values():
+        basename = os.path.basename(paths[0])
+        basename_count[basename] = basename_count.get(basename, 0) + 1
+
+    image_names = {}
+    attachments = {}
+    for content_hash, paths in sorted(by_hash.items()):
+        name = os.path.basename(paths[0])
+        if basename_count[name] > 1:
+            root, ext = os.path.splitext(name)
+            name = "%s-%s%s" % (root, content_hash[:8], ext)
+        attachments[name] = (os.path.join(srcdir, paths[0]), content_hash)
+        for image_path in paths:
+            image_names[image_path] = name
+    return image_names, attachments
+
+
+def _copy_attachment(source, dest, hardlink):
+    """
+    Copies (or hardlinks) *source* to *dest*, through a temporary file so that a partially-copied
+    attachment is never left at *dest*.
+    """
+    tmp_dest = "%s.%d.tmp" % (dest, os.getpid())
+    if hardlink:
+        try:
+            os.link(source, tmp_dest)
+            os.replace(tmp_dest, dest)
+            return
+        except OSError:
+            # different filesystems, perhaps. Fall back to copying.
+            pass
+    shutil.copyfile(source, tmp_dest)
+    os.replace(tmp_dest, dest)
+
+
+def copy_attachments(attachments, dest_dir, previous=None, hardlink=False, max_workers=None):
+    """
+    Copies attachments to *dest_dir* in a pool of threads, skipping any that haven't changed since
+    the last build, and removing attachments that are no longer used.
+
+    attachments:
+       A dict of attachment name -> (source path, content hash), from plan_attachments().
+    previous:
+       A dict of attachment name -> content hash, for the attachments copied by the last build.
+    hardlink:
+       If True, attachments are hardlinked rather than copied (where possible).
+
+    Returns a tuple: (number copied, number unchanged, number removed).
+    """
+    previous = previous or {}
+    os.makedirs(dest_dir, exist_ok=True)
+
+    to_copy = []
+    for name, (source, content_hash) in sorted(attachments.items()):
+        dest = os.path.join(dest_dir, name)
+        if (previous.get(name) == content_hash) and os.path.exists(dest):
+            continue
+        to_copy.append((source, dest))
+
+    if to_copy:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_copy_attachment, source, dest, hardlink)
+                       for (source, dest) in to_copy]
+            for future in futures:
+                # re-raises any error from the copy.
+                future.result()
+
+    removed = 0
+    for name in previous:
+        if name not in attachments:
+            try:
+                os.remove(os.path.join(dest_dir, name))
+                removed += 1
+            except OSError:
+                pass
+
+    return (len(to_copy), len(attachments) - len(to_copy), removed)
@@ -12,12 +12,30 @@
 #===============================================================================
 
 import sys, os
-import codecs, re
+import re, json
 from typing import Iterator, Set
+from docutils import nodes
 from docutils.nodes import Node
-from docutils.core import publish_from_doctree
 from sphinx.builders import Builder
-from abstrys.sphinx_xwiki_writer import XWikiWriter, XWikiTranslator
+from sphinx.locale import __
+from sphinx.util import logging
+from sphinx.util.build_phase import BuildPhase
+from sphinx.util.display import status_iterator
+from sphinx.util.parallel import ParallelTasks, make_chunks
+from abstrys.sphinx_xwiki_writer import (XWikiWriter, XWikiTranslator, WRITER_VERSION,
+    get_page_reference)
+from abstrys.sphinx_xwiki_assets import ATTACHMENTS_DIRNAME, plan_attachments, copy_attachments
+from abstrys.sphinx_xwiki_links import (SectionIdCollector, LinkIndex, build_link_table,
+    get_section_ids)
+from abstrys.sphinx_xwiki_manifest import (BuildManifest, SourceHasher, HashingFileWriter,
+    hash_bytes, hash_file, write_bytes_atomic, write_json_atomic)
+from abstrys.sphinx_xwiki_publisher import XWikiPublisher, format_stats, publish_outdir
+from abstrys.sphinx_xwiki_xar import XarWriter
+from abstrys.sphinx_xwiki_profiler import ProfilingXWikiTranslator, TranslatorProfile
+from abstrys.sphinx_xwiki_trace import TraceBuffer, NULL_TRACE
+from abstrys.sphinx_xwiki_diagnostics import Diagnostics
+from abstrys.sphinx_xwiki_writequeue import WriteQueue
+from abstrys.sphinx_xwiki_cache import CACHE_DIRNAME, CACHE_SIZE, TranslationCache, hash_doctree
 
 JINJA2_MISSING_MSG = """
 Jinja2 is required to use the xwiki_page_template option!
@@ -29,6 +47,8 @@ To install it, run::
 Then try building your Sphinx project again.
 """
 
+logger = logging.getLogger(__name__)
+
 TEMPLATE_MISSING_MSG = """
 Couldn't find a template file at the path: %s
 
@@ -36,6 +56,24 @@ Make sure that either that file exists, or that you *remove* the
 `xwiki_page_template` variable from your `conf.py` file!
 """
 
+# the name of the directory (in the doctree directory) that compiled templates are cached in.
+TEMPLATE_CACHE_DIRNAME = "xwiki-templates"
+
+# the name of the directory (in the doctree directory) that the translated body of each page is kept
+# in, so that pages can be rendered again without translating them.
+BODY_DIRNAME = "xwiki-bodies"
+
+# the name of the file (in the output directory) that the page index is written to.
+PAGE_INDEX_FILENAME = "xwiki-pages.json"
+
+# stands in for the page contents when a template is split into the parts before and after them.
+PAGE_CONTENTS_MARKER = "\x00page_contents\x00"
+
+# the name of the file (in the output directory) that the translator profile is written to.
+PROFILE_FILENAME = "xwiki-profile.json"
+
+SNAKE_SPLITTER = re.compile("[-_]")
+
 def snake2camel(snaked_str):
    """
    Remove hyphens or underscores and capitalize each word beyond them.
@@ -51,12 +89,93 @@ def snake2camel(snaked_str):
 
       'ThisIsASnakeCaseString'
    """
-   snake_splitter = re.compile("[-_]")
-   camel_str = ""
-   words = snake_splitter.split(snaked_str)
-   for w in words:
-       camel_str += w.capitalize()
-   return camel_str
+   return "".join(w.capitalize() for w in SNAKE_SPLITTER.split(snaked_str))
+
+
+class PageIndex(object):
+    """
+    Maps each docname to its output filename, its XWiki page name and its fully qualified XWiki
+    reference, with xwiki_page_name_overrides applied.
+    """
+
+    def __init__(self, docnames, root_page='', overrides=None):
+        """
+        docnames:
+           The docnames in the doc set.
+        root_page:
+           The value of xwiki_root_page.
+        overrides:
+           The value of xwiki_page_name_overrides (a dict of docname to output filename), if set.
+        """
+        self.root_page = root_page
+        self.overrides = overrides or {}
+        self.found_docs = set(docnames)
+        # docname -> entry, for the docnames in the doc set only.
+        self.pages = {}
+        # page name -> fully qualified XWiki reference, for the translator.
+        self.references = {}
+        # page name -> docname.
+        self.docnames = {}
+        for docname in sorted(docnames):
+            self.get(docname)
+
+    def get(self, docname):
+        """
+        Returns the {'filename', 'page_name', 'reference'} entry for a docname. Names that aren't in
+        the doc set (such as 'genindex') get an entry, but it isn't kept in the index, since there's
+        no page written for them.
+        """
+        try:
+            return self.pages[docname]
+        except KeyError:
+            pass
+        if docname in self.overrides:
+            filename = self.overrides[docname]
+            page_name = filename[:-len(".xwiki")] if filename.endswith(".xwiki") else filename
+        else:
+            page_name = snake2camel(docname)
+            filename = page_name + ".xwiki"
+        entry = {
+            'filename': filename,
+            'page_name': page_name,
+            'reference': get_page_reference(page_name, self.root_page),
+            'attachments': [],
+        }
+        if docname not in self.found_docs:
+            return entry
+        self.pages[docname] = entry
+        self.references[page_name] = entry['reference']
+        self.docnames[page_name] = docname
+        return entry
+
+    def add_attachment(self, docname, name):
+        """
+        Records that the page for *docname* uses the attachment *name*.
+        """
+        attachments = self.get(docname)['attachments']
+        if name not in attachments:
+            attachments.append(name)
+            attachments.sort()
+
+    def save(self, path):
+        """
+        Writes the index as JSON, so that other tools (syncing the output with XWiki, for example)
+        can use it.
+        """
+        write_json_atomic(path, self.pages)
+
+
+class TeeStream(object):
+    """
+    Writes text to several streams at once.
+    """
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, text):
+        for stream in self.streams:
+            stream.write(text)
 
 
 class XWikiBuilder(Builder):
@@ -67,99 +186,952 @@ class XWikiBuilder(Builder):
     format = "xwiki"
     epilog = "XWiki output built to {outdir}"
 
+    # pages are translated and written in worker processes when building with -j.
+    allow_parallel = True
+
+    # the image types that XWiki can display, in order of preference.
+    supported_image_types = ['image/svg+xml', 'image/png', 'image/gif', 'image/jpeg']
+    # remote (and data: URI) images are linked to as they are, rather than downloaded (or
+    # extracted) into attachments.
+    supported_remote_images = True
+    supported_data_uri_images = True
+
+    def init(self) -> None:
+        # the record of what was written on the previous build (if any).
+        self.manifest = BuildManifest.load(self.outdir)
+        self.page_index = None
+        # which pages link to which, as of the last time each page was written.
+        self.link_index = LinkIndex(self.manifest.links)
+        # the compiled xwiki_page_template, and the hash of the files it was compiled from.
+        self.page_template = None
+        self.template_hash = None
+        # pages to write as well as the ones that Sphinx finds are outdated (see env_get_updated()).
+        self.requested_docnames = set()
+        # handlers for extension node types added with register_node_handler(), and the translator
+        # class that uses them, with what it was made from (see get_translator_class()).
+        self.node_handlers = {}
+        self.translator_class = None
+        self.translator_key = None
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Resets the state kept for a single build. This is called when the builder is created, and
+        again before each build when the same builder is used for more than one (in watch mode).
+        """
+        self.source_hasher = SourceHasher(self.manifest.files)
+        self.stale_outputs = set()
+        # pages that only need rendering again (because only the template changed), from their
+        # stored bodies.
+        self.rerender_docnames = set()
+        # the number of pages written, left unchanged and removed during this build.
+        self.pages_written = 0
+        self.pages_unchanged = 0
+        self.pages_removed = 0
+        self.attachment_counts = None
+        # the number of pages whose translation was found in, or added to, the translation cache.
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # the translator profile, if xwiki_profile is set.
+        self.profile = None
+        # the problems found while translating pages, over the whole build.
+        self.diagnostics = Diagnostics()
+        # the timeline of the build, if xwiki_trace_filename is set.
+        self.trace = TraceBuffer() if self.app.config.xwiki_trace_filename else NULL_TRACE
+        # pages are written by a background thread if xwiki_write_behind is set.
+        self.write_queue = self.create_write_queue()
+        # translations are cached if xwiki_translation_cache is set (see prepare_writing()).
+        self.translation_cache = None
+
+    def create_write_queue(self):
+        """
+        Returns a new WriteQueue if xwiki_write_behind is set, or None.
+        """
+        if self.app.config.xwiki_write_behind:
+            return WriteQueue(trace=self.trace)
+        return None
+
+    def get_page_index(self) -> PageIndex:
+        """
+        Returns the page index for the doc set, creating it if it hasn't been yet.
+        """
+        if self.page_index is None:
+            config = self.app.config
+            self.page_index = PageIndex(self.env.found_docs,
+                getattr(config, 'xwiki_root_page', ''),
+                getattr(config, 'xwiki_page_name_overrides', None))
+        return self.page_index
+
     def get_target_uri(self, docname: str, typ: str = None) -> str:
-        return snake2camel(docname)
+        return self.get_page_index().get(docname)['page_name']
+
+    def get_page_filename(self, docname: str) -> str:
+        """
+        Returns the name of the output file (relative to the output directory) for a docname: the
+        snake2camel version of the docname, or the name set through xwiki_page_name_overrides.
+        """
+        return self.get_page_index().get(docname)['filename']
+
+    def get_config_fingerprint(self) -> str:
+        """
+        Returns a hash of everything that affects the translation of *all* pages: the config
+        values, the writer version and the node types that extensions have added handlers for.
+
+        xwiki_page_name_overrides isn't part of this: it only changes the output filename of the
+        pages it names, which the manifest checks page by page, and the links to them (see
+        get_docs_with_renamed_link_targets()).
+        """
+        config = self.app.config
+        fingerprint = {
+            'writer_version': WRITER_VERSION,
+            'xwiki_root_page': getattr(config, 'xwiki_root_page', ''),
+            'node_handlers': sorted(self.get_node_handlers()),
+        }
+        return hash_bytes(json.dumps(fingerprint, sort_keys=True).encode('utf-8'))
+
+    def get_template_hash(self):
+        """
+        Returns a hash of xwiki_page_template and of every template that it includes, extends or
+        imports (see get_template_names()), or None if there's no template.
+        """
+        template = getattr(self.app.config, 'xwiki_page_template', None)
+        if not template:
+            return None
+        template_path = os.path.dirname(template)
+        return hash_bytes(json.dumps([(name, hash_file(os.path.join(template_path, name)))
+            for name in self.get_template_names()]).encode('utf-8'))
+
+    def get_template_names(self) -> list:
+        """
+        Returns the names (relative to its directory) of xwiki_page_template and of every template
+        that it uses, directly or through other templates. If a template uses one whose name is
+        only known when it's rendered, that could be any of them, so every template that can be
+        loaded from the directory is returned.
+        """
+        template_path, template_name = os.path.split(self.app.config.xwiki_page_template)
+        jinja_env = self.get_template_env(template_path)
+        from jinja2 import TemplateNotFound, meta
+        names = set()
+        pending = [template_name]
+        while pending:
+            name = pending.pop()
+            if name in names:
+                continue
+            names.add(name)
+            try:
+                source = jinja_env.loader.get_source(jinja_env, name)[0]
+            except TemplateNotFound:
+                # rendering reports this (unless it's an optional include).
+                continue
+            for referenced in meta.find_referenced_templates(jinja_env.parse(source)):
+                if referenced is None:
+                    return sorted(jinja_env.list_templates())
+                pending.append(referenced)
+        return sorted(names)
+
+    def get_template_fingerprint(self) -> str:
+        """
+        Returns a hash of the config values (and template files) that affect the rendering, but not
+        the translation, of all pages.
+        """
+        fingerprint = {
+            'xwiki_page_template': getattr(self.app.config, 'xwiki_page_template', None),
+            'template_hash': self.get_template_hash(),
+        }
+        return hash_bytes(json.dumps(fingerprint, sort_keys=True).encode('utf-8'))
+
+    def get_translation_cache_dir(self):
+        """
+        Returns the directory that translations are cached in, or None if they aren't cached: the
+        shared directory set with xwiki_translation_cache_dir (or the XWIKI_TRANSLATION_CACHE_DIR
+        environment variable), or else a directory in the doctree directory if
+        xwiki_translation_cache is set.
+        """
+        config = self.app.config
+        shared_dir = (config.xwiki_translation_cache_dir
+                      or os.environ.get('XWIKI_TRANSLATION_CACHE_DIR'))
+        if shared_dir:
+            return os.path.join(self.confdir, shared_dir)
+        if config.xwiki_translation_cache:
+            return os.path.join(self.doctreedir, CACHE_DIRNAME)
+        return None
+
+    def get_translation_fingerprint(self) -> str:
+        """
+        Returns a hash of everything other than the doctree that the translation of every page
+        depends on: the writer version, the config values used by the translator and the node
+        types that extensions have added handlers for.
+        """
+        config = self.app.config
+        fingerprint = {
+            'writer_version': WRITER_VERSION,
+            'xwiki_root_page': getattr(config, 'xwiki_root_page', ''),
+            'xwiki_page_name_overrides': getattr(config, 'xwiki_page_name_overrides', None) or {},
+            'node_handlers': sorted(self.get_node_handlers()),
+        }
+        return hash_bytes(json.dumps(fingerprint, sort_keys=True).encode('utf-8'))
+
+    def register_node_handler(self, node_type, visit, depart=None) -> None:
+        """
+        Registers functions to translate a node type, so that extensions can add support for their
+        own nodes. The handlers are only used by this builder.
+
+        node_type:
+           The node class (or its name).
+        visit, depart:
+           Functions called as ``visit(translator, node)`` and ``depart(translator, node)``. If
+           *depart* is None, departing the node does nothing.
+        """
+        node_name = node_type if isinstance(node_type, str) else node_type.__name__
+        self.node_handlers[node_name] = (visit, depart)
+
+    def get_node_handlers(self) -> dict:
+        """
+        Returns the handlers for extension node types, keyed by node class name: those added with
+        ``app.add_node(..., xwiki=(visit, depart))`` and with register_node_handler().
+        """
+        handlers = dict(self.app.registry.translation_handlers.get(self.name, {}))
+        handlers.update(self.node_handlers)
+        return handlers
+
+    def get_translator_class(self):
+        """
+        Returns the translator class for this builder's pages: a subclass of XWikiTranslator (or
+        of ProfilingXWikiTranslator, if xwiki_profile is set) with the builder's node handlers.
+        The class (and the dispatch table it has built up) is kept until the handlers change.
+        """
+        base = ProfilingXWikiTranslator if self.app.config.xwiki_profile else XWikiTranslator
+        handlers = self.get_node_handlers()
+        if self.translator_key != (base, handlers):
+            self.translator_class = base.with_node_handlers(handlers)
+            self.translator_key = (base, handlers)
+        return self.translator_class
+
+    def get_reference_target(self, node: Node):
+        """
+        Returns what the translation of an internal reference depends on, other than the reference
+        itself: its entry in the link table, and its page's reference.
+        """
+        if not node.get('internal') or ('refuri' not in node):
+            return None
+        link_table = self.writer.link_table
+        page_name = node['refuri'].split('#')[0]
+        return (link_table.get(node['refuri']), page_name in link_table,
+                self.page_index.references.get(page_name))
+
+    def get_image_name(self, node: Node):
+        """
+        Returns the attachment name of an image (which the translation of the image depends on).
+        """
+        return self.image_names.get(node.get('uri'))
+
+    def get_translation_key(self, doctree: Node) -> str:
+        """
+        Returns the key that the translation of a (resolved) doctree is cached with.
+        """
+        doctree_hash = hash_doctree(doctree, {nodes.reference: self.get_reference_target,
+                                              nodes.image: self.get_image_name})
+        return hash_bytes(("%s %s" % (self.translation_fingerprint, doctree_hash)).encode('utf-8'))
 
     def get_outdated_docs(self) -> Iterator[str]:
+        # if anything in the config changed, every page needs to be rewritten. If only the template
+        # changed, pages that are otherwise up to date are just rendered again from their bodies
+        # (see rerender_pages()).
+        config_changed = (self.manifest.config != self.get_config_fingerprint())
+        template_changed = (self.manifest.template != self.get_template_fingerprint())
+        self.rerender_docnames = set()
         for docname in self.env.found_docs:
-            if docname not in self.env.all_docs:
+            if config_changed or (docname not in self.env.all_docs):
                 yield docname
                 continue
-            targetname = os.path.join(self.outdir, docname + self.format)
-            try:
-                targetmtime = os.path.getmtime(targetname)
-            except Exception:
-                targetmtime = 0
-            try:
-                srcmtime = os.path.getmtime(self.env.doc2path(docname))
-                if srcmtime > targetmtime:
+            if self.manifest.is_outdated(docname, self.get_page_filename(docname),
+                    self.source_hasher, self.srcdir, self.env.doc2path(docname),
+                    self.env.dependencies.get(docname, ())):
+                yield docname
+            elif template_changed:
+                if self.manifest.get(docname, 'body') is not None:
+                    self.rerender_docnames.add(docname)
+                else:
                     yield docname
-            except OSError:
-                # source doesn't exist anymore
-                pass
+
+    def get_body_filename(self, docname: str) -> str:
+        """
+        Returns the path of the file that the translated body of a page is kept in.
+        """
+        return os.path.join(self.doctreedir, BODY_DIRNAME, docname + '.xwiki')
+
+    def load_page_body(self, docname: str):
+        """
+        Returns the stored body of a page, or None if it's missing or isn't the body that the page
+        was last written with.
+        """
+        try:
+            with open(self.get_body_filename(docname), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hash_bytes(data) != self.manifest.get(docname, 'body'):
+            return None
+        return data.decode('utf-8')
 
     def prepare_writing(self, docnames: Set[str]) -> None:
-        self.writer = XWikiWriter(self.app.config)
+        start = self.trace.clock()
+        # pages that are being written anyway don't need rendering again.
+        self.rerender_docnames -= set(docnames)
+        # (re)create the page index now that all of the docs have been read.
+        self.page_index = None
+        self.get_page_index()
+
+        # work out the attachment name of every image (the same image may be used by many pages,
+        # and different images may have the same filename).
+        self.image_names, self.attachments = plan_attachments(self.env.images.keys(),
+            self.srcdir, self.source_hasher)
+        for docname, names in self.get_page_attachments(self.image_names).items():
+            for name in names:
+                self.page_index.add_attachment(docname, name)
+        # page titles, for publishing.
+        for docname, page in self.page_index.pages.items():
+            page['title'] = self.env.titles[docname].astext() if docname in self.env.titles else ''
+
+        self.page_index.save(os.path.join(self.outdir, PAGE_INDEX_FILENAME))
+
+        # work out the XWiki link target of every page and section anchor once, for all pages.
+        link_table = build_link_table(self.page_index, get_section_ids(self.env))
+        # the problems found in each page are collected here, then passed back (with the rest of
+        # the page's results) to be added to self.diagnostics.
+        self.page_diagnostics = Diagnostics()
+        self.writer = XWikiWriter(self.app.config, self.page_index.references, link_table,
+                                  self.image_names, self.page_diagnostics)
+        if self.app.config.xwiki_profile:
+            self.profile = TranslatorProfile()
+        self.writer.translator_class = self.get_translator_class()
+
+        # profiled builds always translate, so that every page written is measured.
+        cache_dir = self.get_translation_cache_dir()
+        if (cache_dir is not None) and (self.profile is None):
+            self.translation_cache = TranslationCache(cache_dir,
+                self.app.config.xwiki_translation_cache_size * 1024 * 1024)
+            self.translation_fingerprint = self.get_translation_fingerprint()
+
+        # the template is only loaded again if its files have changed since it was last loaded
+        # (when the builder is used for more than one build).
+        template_hash = self.get_template_hash()
+        if (self.page_template is None) or (template_hash != self.template_hash):
+            self.page_template = self.load_page_template()
+            self.template_hash = template_hash if self.page_template is not None else None
+        self.trace.add('prepare_writing', start)
+
+
+    def load_page_template(self):
+        """
+        Returns the compiled xwiki_page_template, or None if there isn't one.
 
+        Compiled templates are cached in the doctree directory, so the template is only compiled
+        again when it changes.
+        """
         # Is there a template set using the xwiki_page_template option?
-        if (hasattr(self.app.config, 'xwiki_page_template')
-            and (self.app.config.xwiki_page_template != None)):
+        if (not hasattr(self.app.config, 'xwiki_page_template')
+            or (self.app.config.xwiki_page_template == None)):
+            return None
 
-            # attempt to load Jinja2 and fail if it can't be found.
-            try:
-                from jinja2 import Environment, FileSystemLoader
-            except:
-                print(JINJA2_MISSING_MSG)
-                sys.exit(1)
+        # make sure that the template path exists, at least.
+        if not os.path.exists(self.app.config.xwiki_page_template):
+            print(TEMPLATE_MISSING_MSG % self.app.config.xwiki_page_template)
+            sys.exit(1)
 
-            # make sure that the template path exists, at least.
-            if not os.path.exists(self.app.config.xwiki_page_template):
-                print(TEMPLATE_MISSING_MSG % self.app.config.xwiki_page_template)
-                sys.exit(1)
+        # We'll need the path in two parts (path, filename) for use w/ Jinja.
+        template_path, template_name = os.path.split(self.app.config.xwiki_page_template)
 
-            # We'll need the path in two parts (path, filename) for use w/ Jinja.
-            template_path, template_name = os.path.split(self.app.config.xwiki_page_template)
+        cache_dir = os.path.join(self.doctreedir, TEMPLATE_CACHE_DIRNAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        jinja_env = self.get_template_env(template_path, cache_dir)
 
-            jinja_env = Environment(
-                loader=FileSystemLoader(template_path),
-                # a few thing in the Jinja environment need to be overridden to avoid conflicts w/
-                # XWiki syntax (see the README for more info).
-                block_start_string='<%', block_end_string='%>',
-                variable_start_string='<<', variable_end_string='>>',
-                comment_start_string='<#', comment_end_string='#>')
+        # Get the template for rendering pages in write_doc().
+        return jinja_env.get_template(template_name)
 
-            # Get the template for rendering pages in write_doc().
-            self.page_template = jinja_env.get_template(template_name)
 
+    def get_template_env(self, template_path, cache_dir=None):
+        """
+        Returns a Jinja environment that loads templates from the directory *template_path*
+        (caching compiled templates in *cache_dir*, if it's set).
+        """
+        # attempt to load Jinja2 and fail if it can't be found.
+        try:
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+        except:
+            print(JINJA2_MISSING_MSG)
+            sys.exit(1)
+
+        return Environment(
+            loader=FileSystemLoader(template_path),
+            bytecode_cache=FileSystemBytecodeCache(cache_dir) if cache_dir else None,
+            # a few thing in the Jinja environment need to be overridden to avoid conflicts w/
+            # XWiki syntax (see the README for more info).
+            block_start_string='<%', block_end_string='%>',
+            variable_start_string='<<', variable_end_string='>>',
+            comment_start_string='<#', comment_end_string='#>')
+
+
+    def get_page_toc(self, docname: str) -> list:
+        """
+        Returns the table of contents of a page as a list of {'title', 'anchor', 'level'} dicts, one
+        per section (the page title is level 1).
+        """
+        toc = []
+        if docname not in self.env.tocs:
+            return toc
+        for reference in self.env.tocs[docname].findall(nodes.reference):
+            level = 0
+            parent = reference.parent
+            while parent is not None:
+                if isinstance(parent, nodes.bullet_list):
+                    level += 1
+                parent = parent.parent
+            toc.append({
+                'title': reference.astext(),
+                'anchor': reference.get('anchorname', '').lstrip('#'),
+                'level': level,
+            })
+        return toc
+
+
+    def get_page_context(self, docname: str) -> dict:
+        """
+        Returns the variables (other than page_contents) that xwiki_page_template is rendered with.
+        """
+        page = self.get_page_index().get(docname)
+        title = self.env.titles[docname].astext() if docname in self.env.titles else ''
+        return {
+            'docname': docname,
+            'doc_name': docname,
+            'page_name': page['page_name'],
+            'page_reference': page['reference'],
+            'root_page': self.page_index.root_page,
+            'title': title,
+            'toc': self.get_page_toc(docname),
+        }
+
+
+    def get_page_attachments(self, image_names: dict) -> dict:
+        """
+        Returns a dict of docname -> sorted list of the names of the attachments the page uses.
+        """
+        page_attachments = {}
+        for image_path, (image_docnames, unique_name) in self.env.images.items():
+            if image_path in image_names:
+                for docname in image_docnames:
+                    page_attachments.setdefault(docname, set()).add(image_names[image_path])
+        return dict((docname, sorted(names)) for (docname, names) in page_attachments.items())
 
-    def write_doc(self, docname: str, doctree: Node) -> None:
-        # get the output from the writer
-        writer_output = publish_from_doctree(doctree, writer=self.writer)
 
-        # make it easy to write code that uses config values (we're going to do that more than a few
-        # times...)
+    def get_docs_with_renamed_attachments(self) -> list:
+        """
+        Returns the docnames of pages that weren't changed, but use an image whose attachment name
+        has changed (because an image with the same filename was added elsewhere, for example).
+        """
+        image_names, attachments = plan_attachments(self.env.images.keys(), self.srcdir,
+                                                    self.source_hasher)
+        page_attachments = self.get_page_attachments(image_names)
+        docnames = []
+        for docname in self.manifest.docs:
+            previous_attachments = self.manifest.get(docname, 'attachments', [])
+            if ((docname in self.env.found_docs)
+                and (page_attachments.get(docname, []) != previous_attachments)):
+                docnames.append(docname)
+        return docnames
+
+
+    def get_docs_with_renamed_link_targets(self) -> list:
+        """
+        Returns the docnames of pages that link to a page whose reference has changed (because it
+        was renamed, or its xwiki_page_name_overrides entry changed) or that has been removed, or
+        to an anchor that has been added or removed, so their links need to be written again.
+        """
         config = self.app.config
+        page_index = PageIndex(self.env.found_docs, getattr(config, 'xwiki_root_page', ''),
+                               getattr(config, 'xwiki_page_name_overrides', None))
+        stale = self.link_index.get_stale_referrers(page_index, get_section_ids(self.env))
+        return sorted(docname for docname in stale if docname in self.env.found_docs)
+
+
+    def copy_assets(self) -> None:
+        # copy (or hardlink) the images used by the doc set to the attachments directory, skipping
+        # any that haven't changed since the last build.
+        with self.trace.span('copy_assets', attachments=len(self.attachments)):
+            self.attachment_counts = copy_attachments(self.attachments,
+                os.path.join(self.outdir, ATTACHMENTS_DIRNAME), self.manifest.attachments,
+                hardlink=self.app.config.xwiki_hardlink_attachments)
+        self.manifest.attachments = dict((name, content_hash) for (name, (source, content_hash))
+            in self.attachments.items())
+
+
+    def write_doc_serialized(self, docname: str, doctree: Node) -> None:
+        # pick the best candidate for images with more than one (image.*).
+        self.post_process_images(doctree)
+
+        # the manifest is only updated in the main process (write_doc may be run in a worker).
+        stale_output = self.manifest.record(docname, self.get_page_filename(docname),
+            self.source_hasher, self.srcdir, self.env.doc2path(docname),
+            self.env.dependencies.get(docname, ()))
+        if stale_output:
+            self.stale_outputs.add(stale_output)
+        self.manifest.update(docname, {'attachments': self.page_index.get(docname)['attachments']})
+
+
+    def write_documents(self, docnames: Set[str]) -> None:
+        if self.parallel_ok:
+            # the main process loads and resolves doctrees, so there's one less worker than jobs.
+            self.write_parallel(sorted(docnames), max(self.app.parallel - 1, 1))
+        else:
+            super().write_documents(docnames)
+
+
+    def write_parallel(self, docnames: list, nproc: int) -> None:
+        """
+        Writes pages in a pool of worker processes, in chunks of docnames.
+
+        Doctrees are resolved (and write_doc_serialized called) in the main process, in order.
+        Each worker returns the results of write_page() for its chunk, which are merged back in the
+        main process, so the build's output doesn't depend on the number of workers.
+        """
+        def write_chunk(docs):
+            self.phase = BuildPhase.WRITING
+            # drop the spans inherited from the main process; only this chunk's are sent back.
+            self.trace.clear()
+            # a forked worker can't use the main process's write thread; it gets its own.
+            self.write_queue = self.create_write_queue()
+            results = []
+            for docname, doctree in docs:
+                with self.trace.span('write_doc', docname=docname):
+                    results.append((docname, self.write_page(docname, doctree)))
+            if self.write_queue is not None:
+                self.write_queue.flush()
+            return results, self.trace.drain()
+
+        def merge_chunk(docs, chunk_result):
+            results, spans = chunk_result
+            for docname, result in results:
+                self.merge_page_result(docname, result)
+            self.trace.extend(spans)
+            next(progress)
+
+        tasks = ParallelTasks(nproc)
+        chunks = make_chunks(docnames, nproc)
+        progress = status_iterator(chunks, __('writing output... '), 'darkgreen', len(chunks),
+                                   self.app.verbosity)
+
+        for chunk in chunks:
+            self.phase = BuildPhase.RESOLVING
+            docs = []
+            for docname in chunk:
+                doctree = self.env.get_and_resolve_doctree(docname, self, tags=self.tags)
+                self.write_doc_serialized(docname, doctree)
+                docs.append((docname, doctree))
+            tasks.add_task(write_chunk, docs, merge_chunk)
+
+        # make sure that all of the workers have finished.
+        tasks.join()
+        logger.info('')
+
 
+    def write_doc(self, docname: str, doctree: Node) -> None:
+        with self.trace.span('write_doc', docname=docname):
+            result = self.write_page(docname, doctree)
+        self.merge_page_result(docname, result)
+
+
+    def merge_page_result(self, docname: str, result: dict) -> None:
+        """
+        Merges the result of write_page() into the state of the build. This is always called in
+        the main process.
+        """
+        if result['written']:
+            self.pages_written += 1
+        else:
+            self.pages_unchanged += 1
+        if result['cached'] is not None:
+            if result['cached']:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        self.manifest.update(docname, {'render': result['render'], 'hash': result['hash'],
+                                       'body': result['body']})
+        # pages that are only rendered again keep their links.
+        if result['links'] is not None:
+            self.link_index.set_links(docname, result['links'], self.page_index)
+        if result['profile'] is not None:
+            self.profile.add_document(docname, result['profile'])
+        # only the first occurrence of each problem is logged; the rest are counted, and summarised
+        # at the end of the build.
+        for node_type, message, count, locations in self.diagnostics.merge(result['diagnostics']):
+            logger.warning(message, type='xwiki', subtype=node_type or None,
+                           location=locations[0] if locations else docname)
+
+
+    def get_page_frame(self, docname: str):
+        """
+        Returns the parts of a rendered page that come before and after its contents, as a tuple of
+        (header, footer), so that the contents can be streamed between them. Returns None if the
+        template doesn't include the page contents exactly once, as they are.
+        """
+        if self.page_template is None:
+            return ('', '')
+        page = self.page_template.render(page_contents=PAGE_CONTENTS_MARKER,
+                                         **self.get_page_context(docname))
+        parts = page.split(PAGE_CONTENTS_MARKER)
+        if len(parts) != 2:
+            return None
+        return tuple(parts)
+
+
+    def write_page(self, docname: str, doctree: Node) -> dict:
+        """
+        Translates and writes a page, returning a dict describing what was written. This may be
+        called in a worker process, so it mustn't change the state of the builder.
+        """
+        if self.app.config.xwiki_stream_output:
+            with self.trace.span('render', docname=docname):
+                frame = self.get_page_frame(docname)
+            if frame is not None:
+                return self.write_page_streamed(docname, doctree, frame)
+
+        # use the cached translation of the doctree, if there is one.
+        writer_output = None
+        cache_key = None
+        if self.translation_cache is not None:
+            with self.trace.span('cache', docname=docname):
+                cache_key = self.get_translation_key(doctree)
+                entry = self.translation_cache.get(cache_key)
+            if entry is not None:
+                writer_output, info = entry
+                links = info.get('links', {})
+        cached = (writer_output is not None) if cache_key is not None else None
+
+        profile = None
+        diagnostics = []
+        if writer_output is None:
+            # get the output from the writer. The doctree is translated directly: going through
+            # publish_from_doctree() would set up a new publisher, settings and option parser for
+            # every page, and encode the output to bytes.
+            with self.trace.span('translate', docname=docname):
+                writer_output = self.writer.translate_doctree(doctree)
+            profile = self.writer.visitor.get_profile() if self.profile is not None else None
+            diagnostics = self.page_diagnostics.drain()
+            links = self.writer.visitor.links
+            # pages with problems aren't cached, so that their problems are reported (with their
+            # current locations) every time they're written.
+            if (cache_key is not None) and not diagnostics:
+                self.translation_cache.put(cache_key, writer_output, {'links': links})
+
+        # the body is kept, so that the page can be rendered again without translating it.
+        body_bytes = writer_output.encode('utf-8')
+        body_hash = hash_bytes(body_bytes)
+        self.write_page_body(docname, body_bytes, body_hash)
+
+        result = self.render_page(docname, writer_output, body_hash)
+        result.update({'profile': profile, 'diagnostics': diagnostics, 'cached': cached,
+                       'links': links})
+        return result
+
+
+    def write_page_body(self, docname: str, body_bytes: bytes, body_hash: str) -> None:
+        """
+        Stores the translated body of a page (as bytes), unless it's the body already stored.
+        """
+        body_filename = self.get_body_filename(docname)
+        if ((body_hash == self.manifest.get(docname, 'body'))
+            and os.path.exists(body_filename)):
+            return
+        os.makedirs(os.path.dirname(body_filename), exist_ok=True)
+        if self.write_queue is not None:
+            self.write_queue.put(body_filename, body_bytes, docname)
+        else:
+            with self.trace.span('write', docname=docname):
+                write_bytes_atomic(body_filename, body_bytes)
+
+
+    def render_page(self, docname: str, body: str, body_hash: str) -> dict:
+        """
+        Renders a page's translated *body* through the template (if there is one) and writes it,
+        returning a dict describing what was written. This may be called in a worker process, so it
+        mustn't change the state of the builder.
+        """
         # choose the output filename (either snake2camel, or through the xwiki_page_name_overrides
         # mapping)
-        output_filename = None
-        if (hasattr(config, 'xwiki_page_name_overrides')
-            and (config.xwiki_page_name_overrides != None)
-            and (docname in config.xwiki_page_name_overrides.keys())):
-            # if there was an override, then use it.
-            output_filename = os.path.join(self.outdir, config.xwiki_page_name_overrides[docname])
-        else:
-            # otherwise, do the standard snake2camel mapping.
-            output_filename = os.path.join(self.outdir, snake2camel(docname) + ".xwiki")
+        output_filename = os.path.join(self.outdir, self.get_page_filename(docname))
+        writer_output = body
 
         # check if there's a jinja template. If there is, then pass the page output through that
         # first.
-        if hasattr(self, 'page_template'):
-            writer_output = self.page_template.render(docname=docname, page_contents=writer_output)
+        render_key = None
+        if self.page_template is not None:
+            context = self.get_page_context(docname)
+            # the rendered page only depends on the template, the body and the context: if none
+            # of them changed since the page was last written, the page doesn't need rendering.
+            render_key = hash_bytes(json.dumps([self.template_hash, body_hash, context],
+                                               sort_keys=True).encode('utf-8'))
+            if ((render_key == self.manifest.get(docname, 'render'))
+                and os.path.exists(output_filename)):
+                return {'output': self.get_page_filename(docname), 'written': False,
+                        'render': render_key, 'hash': self.manifest.get(docname, 'hash'),
+                        'body': body_hash}
+            with self.trace.span('render', docname=docname):
+                writer_output = self.page_template.render(page_contents=body, **context)
 
-        # write the file.
-        output_file = codecs.open(output_filename, 'w', encoding="utf-8")
-        output_file.write(writer_output.decode("utf-8"))
-        output_file.close()
+        # write the file, unless it's exactly what was written last time (rewriting it would
+        # only change its mtime, making sync tools process it again).
+        page_bytes = writer_output.encode('utf-8')
+        page_hash = hash_bytes(page_bytes)
+        written = False
+        if ((page_hash != self.manifest.get(docname, 'hash'))
+            or not os.path.exists(output_filename)):
+            if self.write_queue is not None:
+                # written in the background, while the next page is translated.
+                self.write_queue.put(output_filename, page_bytes, docname)
+            else:
+                with self.trace.span('write', docname=docname):
+                    write_bytes_atomic(output_filename, page_bytes)
+            written = True
+
+        return {'output': self.get_page_filename(docname), 'written': written,
+                'render': render_key, 'hash': page_hash, 'body': body_hash}
+
+
+    def rerender_pages(self, docnames: list) -> None:
+        """
+        Renders pages again from their stored bodies, without translating them. Pages whose bodies
+        can't be used are written from their doctrees instead.
+        """
+        for docname in status_iterator(docnames, __('rendering output... '), 'darkgreen',
+                                       len(docnames), self.app.verbosity):
+            body = self.load_page_body(docname)
+            if body is None:
+                doctree = self.env.get_and_resolve_doctree(docname, self, tags=self.tags)
+                self.write_doc_serialized(docname, doctree)
+                self.write_doc(docname, doctree)
+                continue
+            with self.trace.span('write_doc', docname=docname):
+                result = self.render_page(docname, body, self.manifest.get(docname, 'body'))
+            result.update({'profile': None, 'diagnostics': [], 'cached': None, 'links': None})
+            self.merge_page_result(docname, result)
+
+
+    def write_page_streamed(self, docname: str, doctree: Node, frame: tuple) -> dict:
+        """
+        Like write_page(), but the translator writes the page straight to a (temporary) file as it
+        goes, between the *frame* (header, footer) of the rendered template, so the whole page is
+        never held in memory. The file only replaces the existing page if its hash differs.
+        """
+        output_filename = os.path.join(self.outdir, self.get_page_filename(docname))
+        body_filename = self.get_body_filename(docname)
+        os.makedirs(os.path.dirname(body_filename), exist_ok=True)
+        header, footer = frame
+        page_file = HashingFileWriter(output_filename)
+        # the body is written to its own file at the same time.
+        body_file = HashingFileWriter(body_filename)
+        try:
+            page_file.write(header)
+            with self.trace.span('translate', docname=docname):
+                self.writer.translate_doctree(doctree, TeeStream(page_file, body_file))
+            page_file.write(footer)
+            page_hash = page_file.close()
+            body_hash = body_file.close()
+        except BaseException:
+            page_file.discard()
+            body_file.discard()
+            raise
+        profile = self.writer.visitor.get_profile() if self.profile is not None else None
+        diagnostics = self.page_diagnostics.drain()
+        links = self.writer.visitor.links
+
+        written = ((page_hash != self.manifest.get(docname, 'hash'))
+                   or not os.path.exists(output_filename))
+        with self.trace.span('write', docname=docname):
+            if written:
+                page_file.commit()
+            else:
+                page_file.discard()
+            if ((body_hash != self.manifest.get(docname, 'body'))
+                or not os.path.exists(body_filename)):
+                body_file.commit()
+            else:
+                body_file.discard()
+
+        return {'output': self.get_page_filename(docname), 'written': written,
+                'render': None, 'hash': page_hash, 'body': body_hash, 'profile': profile,
+                'diagnostics': diagnostics, 'cached': None, 'links': links}
+
+
+    def finish(self) -> None:
+        # render the pages that only need rendering again (Sphinx doesn't write them).
+        if self.rerender_docnames:
+            self.rerender_pages(sorted(docname for docname in self.rerender_docnames
+                                       if docname in self.env.found_docs))
+
+        # wait for any pages still being written (this raises the first error, if any).
+        if self.write_queue is not None:
+            self.write_queue.flush()
+
+        # forget about (and remove the output of) any docs whose sources have been deleted.
+        for docname in list(self.manifest.docs.keys()):
+            if docname not in self.env.found_docs:
+                self.stale_outputs.add(self.manifest.forget(docname))
+                self.link_index.forget(docname)
+
+        # remove output files that no page is written to anymore (renamed or deleted pages).
+        current_outputs = self.manifest.outputs()
+        for stale_output in self.stale_outputs - current_outputs:
+            try:
+                os.remove(os.path.join(self.outdir, stale_output))
+                self.pages_removed += 1
+            except OSError:
+                pass
+
+        self.manifest.config = self.get_config_fingerprint()
+        self.manifest.template = self.get_template_fingerprint()
+        self.manifest.files = dict((path, info) for (path, info)
+            in self.source_hasher.current.items() if info is not None)
+        self.manifest.links = self.link_index.targets
+        self.manifest.save()
+
+        logger.info(__('%d pages written, %d unchanged, %d removed'),
+                    self.pages_written, self.pages_unchanged, self.pages_removed)
+        if self.attachment_counts is not None:
+            logger.info(__('%d attachments copied, %d unchanged, %d removed'),
+                        *self.attachment_counts)
+        if self.translation_cache is not None:
+            cache_stats = self.translation_cache.collect()
+            lookups = self.cache_hits + self.cache_misses
+            logger.info(__('translation cache: %d hits, %d misses (%.0f%% hit rate); '
+                           '%d entries (%.1f MB), %d evicted'), self.cache_hits, self.cache_misses,
+                        (100.0 * self.cache_hits / lookups) if lookups else 0,
+                        cache_stats['entries'], cache_stats['size'] / 1048576.0,
+                        cache_stats['removed'])
+
+        if len(self.diagnostics) > 0:
+            logger.info(__('problems found while translating (%d distinct):'),
+                        len(self.diagnostics))
+            for line in self.diagnostics.summary():
+                logger.info(line)
+        if self.app.config.xwiki_diagnostics_filename:
+            self.diagnostics.save(os.path.join(self.outdir,
+                                               self.app.config.xwiki_diagnostics_filename))
+
+        if self.profile is not None:
+            self.profile.save(os.path.join(self.outdir, PROFILE_FILENAME))
+            logger.info(__('translator profile (saved to %s):'), PROFILE_FILENAME)
+            for line in self.profile.report():
+                logger.info(line)
+
+        if getattr(self.app.config, 'xwiki_xar_filename', None):
+            with self.trace.span('write_xar'):
+                self.write_xar()
+
+        if getattr(self.app.config, 'xwiki_publish_url', None):
+            with self.trace.span('publish'):
+                self.publish()
+
+        # the trace is only written once, at the very end of the build.
+        if self.app.config.xwiki_trace_filename:
+            self.trace.save(os.path.join(self.outdir, self.app.config.xwiki_trace_filename))
+            logger.info(__('build trace written to %s'), self.app.config.xwiki_trace_filename)
+
+
+    def write_xar(self) -> None:
+        """
+        Writes every page (with its attachments) to a single XAR package that can be imported into
+        XWiki.
+
+        The package is written from the output files once they're all up to date (incremental
+        builds only write the pages that changed), one page at a time and in the order of their
+        references, so the same output always gives the same package.
+        """
+        config = self.app.config
+        xar_path = os.path.join(self.outdir, config.xwiki_xar_filename)
+        attachments_dir = os.path.join(self.outdir, ATTACHMENTS_DIRNAME)
+        pages = sorted(self.get_page_index().pages.values(), key=lambda page: page['reference'])
+        with XarWriter(xar_path, name=config.project, description=config.project,
+                       version=config.release or '') as xar:
+            for page in status_iterator(pages, __('writing XAR package... '), 'darkgreen',
+                                        len(pages), self.app.verbosity,
+                                        stringify_func=lambda page: page['page_name']):
+                with open(os.path.join(self.outdir, page['filename']), encoding='utf-8') as f:
+                    content = f.read()
+                xar.add_page(page['reference'], page.get('title') or page['page_name'], content,
+                    [(name, os.path.join(attachments_dir, name)) for name in page['attachments']])
+        logger.info(__('%d pages (%d attachments) packaged in %s'), len(pages),
+                    xar.attachment_count, config.xwiki_xar_filename)
+
+
+    def publish(self) -> None:
+        """
+        Publishes the pages (and attachments) that have changed since they were last published to
+        the XWiki instance at xwiki_publish_url, through the XWiki REST API.
+        """
+        config = self.app.config
+        publisher = XWikiPublisher(config.xwiki_publish_url,
+            wiki=config.xwiki_publish_wiki,
+            user=config.xwiki_publish_user or os.environ.get('XWIKI_USER'),
+            password=config.xwiki_publish_password or os.environ.get('XWIKI_PASSWORD'),
+            jobs=config.xwiki_publish_jobs,
+            rate=config.xwiki_publish_rate,
+            retries=config.xwiki_publish_retries)
+
+        def on_error(item, error):
+            logger.warning(__('failed to publish %s: %s'), item['reference'], error)
+
+        logger.info(__('publishing to %s'), config.xwiki_publish_url)
+        stats = publish_outdir(publisher, self.outdir, self.get_page_index().pages,
+                               dry_run=config.xwiki_publish_dry_run, log=logger.info,
+                               on_error=on_error)
+        if stats is not None:
+            logger.info(format_stats(stats))
+
+
+def env_get_updated(app, env):
+    """
+    Tells Sphinx to write the pages whose attachment names or link targets have changed (and any
+    that were asked for with ``requested_docnames``), once the changed docs have been read.
+    """
+    if isinstance(app.builder, XWikiBuilder):
+        builder = app.builder
+        requested = set(docname for docname in builder.requested_docnames
+                        if docname in env.found_docs)
+        builder.requested_docnames = set()
+        return sorted(requested | set(builder.get_docs_with_renamed_attachments())
+                      | set(builder.get_docs_with_renamed_link_targets()))
+    return []
 
 
 def setup(app):
     app.add_builder(XWikiBuilder)
+    app.add_env_collector(SectionIdCollector)
+    app.connect('env-get-updated', env_get_updated)
     app.add_config_value('xwiki_root_page', '', 'env')
     app.add_config_value('xwiki_page_template', None, 'env')
-    app.add_config_value('xwiki_page_name_overrides', None, 'env')
+    app.add_config_value('xwiki_page_name_overrides', None, '')
+    app.add_config_value('xwiki_hardlink_attachments', False, '')
+    app.add_config_value('xwiki_stream_output', False, '')
+    app.add_config_value('xwiki_write_behind', False, '')
+    app.add_config_value('xwiki_translation_cache', False, '')
+    app.add_config_value('xwiki_translation_cache_size', CACHE_SIZE, '')
+    app.add_config_value('xwiki_translation_cache_dir', None, '')
+    app.add_config_value('xwiki_diagnostics_filename', None, '')
+    app.add_config_value('xwiki_profile', False, '')
+    app.add_config_value('xwiki_trace_filename', None, '')
+    app.add_config_value('xwiki_xar_filename', None, '')
+    app.add_config_value('xwiki_publish_url', None, '')
+    app.add_config_value('xwiki_publish_wiki', 'xwiki', '')
+    app.add_config_value('xwiki_publish_user', None, '')
+    app.add_config_value('xwiki_publish_password', None, '')
+    app.add_config_value('xwiki_publish_jobs', 4, '')
+    app.add_config_value('xwiki_publish_rate', 0, '')
+    app.add_config_value('xwiki_publish_retries', 3, '')
+    app.add_config_value('xwiki_publish_dry_run', False, '')
     return {
        'version': '1.0',
+       # bump this when the data stored in the environment changes, so the doc set is re-read.
+       'env_version': 1,
        'parallel_read_safe': True,
        'parallel_write_safe': True
     }
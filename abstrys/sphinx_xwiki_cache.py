@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Translation Cache
+#
+# Keeps the translated XWiki text of each page, keyed by a hash of the
+# resolved doctree (and everything else the translation depends on), so that a
+# page whose source was touched but not really changed (by a branch switch, a
+# checkout or a restored CI cache) doesn't need to be translated again.
+#
+# Entries are plain files named by their key. Each time an entry is used, its
+# mtime is updated, so the least recently used entries can be removed first
+# when the cache grows past its size limit.
+#
+# The cache directory can be shared by several builds at once (on different CI
+# runners, through NFS or a restored CI cache): entries are written to unique
+# temporary files and renamed into place, each entry carries a hash of its
+# text so that damaged entries are ignored, and a file that disappears (because
+# another build removed it) is just a miss.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+from docutils import nodes
+
+# the name of the directory (in the doctree directory) that translations are cached in.
+CACHE_DIRNAME = "xwiki-cache"
+
+# the default size limit of the cache, in megabytes.
+CACHE_SIZE = 256
+
+# the first line of each entry is this, followed by the hash of the rest of the entry: a line of
+# JSON with what's known about the translation (the links on the page, for example), then the text.
+ENTRY_HEADER = b"xwiki-cache 2 "
+
+# temporary files older than this (in seconds) were left by a build that was interrupted, and are
+# removed by collect().
+STALE_TMP_AGE = 3600
+
+
+def hash_doctree(doctree, dependencies=None):
+    """
+    Returns a hex digest of a (resolved) doctree: the type, attributes and number of children of
+    each element and the text of each text node, in document order. The source path isn't included,
+    so the same doctree gives the same digest wherever it was built.
+
+    dependencies:
+       An optional dict of node class -> function(node). The value returned for each node of those
+       classes is added to the digest, for the things that the translation of the node depends on
+       that aren't in the doctree (the link table, for example).
+    """
+    dependencies = dependencies or {}
+    Text = nodes.Text
+    parts = []
+    add = parts.append
+    stack = [doctree]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        node = pop()
+        if node.__class__ is Text:
+            add('\x00t')
+            add(node)
+            continue
+        attributes = node.attributes
+        if 'source' in attributes:
+            attributes = dict(attributes)
+            del attributes['source']
+        # attributes are added in the order they were set, which is the same for the same source.
+        add('\x00e%s %d %r' % (node.tagname, len(node.children), attributes))
+        depends = dependencies.get(node.__class__)
+        if depends is not None:
+            add('\x00d%r' % (depends(node),))
+        children = node.children
+        if children:
+            extend(reversed(children))
+    return hashlib.sha1(''.join(parts).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class TranslationCache(object):
+    """
+    A directory of cached translations, each stored (as UTF-8 text, with a dict of information
+    about it) in a file named by its key.
+    """
+
+    def __init__(self, directory, max_size=CACHE_SIZE * 1024 * 1024):
+        """
+        directory:
+           The directory to keep the cache in. It's created if it doesn't exist.
+        max_size:
+           The size (in bytes) that collect() trims the cache to.
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns the cached (text, info) for *key*, or None if there isn't any (or the entry is
+        damaged). The entry is marked as used.
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = f.readline()
+                data = f.read()
+        except OSError:
+            return None
+        if (not header.startswith(ENTRY_HEADER)
+            or header[len(ENTRY_HEADER):].strip().decode('ascii', 'replace')
+               != hashlib.sha1(data).hexdigest()):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # the entry can still be used, even if it can't be marked (a read-only cache, say).
+            pass
+        info, _, text = data.partition(b'\n')
+        return text.decode('utf-8'), json.loads(info.decode('utf-8'))
+
+    def put(self, key, text, info=None):
+        """
+        Caches *text* for *key*, along with *info* (a dict that can be stored as JSON). Returns
+        False if the entry couldn't be written: the cache is only an optimization, so that doesn't
+        stop the build.
+
+        The entry is written to a temporary file with a unique name, then renamed into place, so
+        other builds using the cache never see a half-written entry. If two builds write the same
+        entry at once, they write the same text, so it doesn't matter which one wins.
+        """
+        path = self.get_path(key)
+        data = (json.dumps(info or {}, sort_keys=True) + '\n' + text).encode('utf-8')
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % key, suffix='.tmp',
+                                            dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(ENTRY_HEADER + hashlib.sha1(data).hexdigest().encode('ascii') + b'\n')
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+        return True
+
+    def collect(self):
+        """
+        Removes the least recently used entries until the cache is no larger than its size limit,
+        along with any temporary files left by interrupted builds. Returns a dict of 'entries' (the
+        number of entries left), 'size' (the size of the cache, in bytes) and 'removed' (the number
+        of entries removed).
+
+        Several builds may collect the same cache at once; entries that have already gone are
+        skipped.
+        """
+        entries = []
+        total = 0
+        stale_time = time.time() - STALE_TMP_AGE
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    info = os.stat(path)
+                    if filename.endswith('.tmp'):
+                        # another build may be writing this one.
+                        if info.st_mtime < stale_time:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, path, info.st_size))
+                total += info.st_size
+        removed = 0
+        for mtime, path, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return {'entries': len(entries) - removed, 'size': total, 'removed': removed}
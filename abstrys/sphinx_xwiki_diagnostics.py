@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Diagnostics
+#
+# Collects the problems found by the translator (unknown nodes, problematic
+# nodes, links to missing anchors and so on), counting repeats of the same
+# problem rather than reporting every occurrence.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+from abstrys.sphinx_xwiki_manifest import write_json_atomic
+
+# the number of locations kept for each distinct diagnostic.
+MAX_LOCATIONS = 5
+
+
+def get_node_location(node):
+    """
+    Returns "source:line" for a node (or as much of that as is known), or None.
+    """
+    while node is not None and node.source is None and node.line is None:
+        node = node.parent
+    if node is None:
+        return None
+    if node.line is None:
+        return node.source
+    return "%s:%s" % (node.source or '<unknown>', node.line)
+
+
+class Diagnostics(object):
+    """
+    A collection of diagnostics, deduplicated by (node type, message). Each distinct diagnostic
+    has a count and the first few locations it was found at.
+    """
+
+    def __init__(self, max_locations=MAX_LOCATIONS):
+        self.max_locations = max_locations
+        # (node type, message) -> {'count', 'locations'}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, message, node=None):
+        """
+        Records a diagnostic for *node* (if there is one).
+        """
+        key = (node.__class__.__name__ if node is not None else '', message)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {'count': 0, 'locations': []}
+        entry['count'] += 1
+        if len(entry['locations']) < self.max_locations:
+            location = get_node_location(node) if node is not None else None
+            if location is not None:
+                entry['locations'].append(location)
+
+    def drain(self):
+        """
+        Returns the entries (as a list of (node type, message, count, locations) tuples, which can
+        be pickled) and empties the collection.
+        """
+        entries = [key + (entry['count'], entry['locations'])
+                   for key, entry in self.entries.items()]
+        self.entries = {}
+        return entries
+
+    def merge(self, entries):
+        """
+        Adds entries (from drain(), perhaps in another process). Returns the entries that hadn't
+        been seen before.
+        """
+        new_entries = []
+        for node_type, message, count, locations in entries:
+            entry = self.entries.get((node_type, message))
+            if entry is None:
+                entry = self.entries[(node_type, message)] = {'count': 0, 'locations': []}
+                new_entries.append((node_type, message, count, locations))
+            entry['count'] += count
+            room = self.max_locations - len(entry['locations'])
+            entry['locations'].extend(locations[:max(room, 0)])
+        return new_entries
+
+    def summary(self):
+        """
+        Returns the lines of a summary of the diagnostics, most frequent first.
+        """
+        lines = []
+        for (node_type, message), entry in sorted(self.entries.items(),
+                                                  key=lambda item: (-item[1]['count'], item[0])):
+            line = "%6d x %s" % (entry['count'], message)
+            if node_type:
+                line += " (%s)" % node_type
+            if entry['locations']:
+                line += ", first at %s" % entry['locations'][0]
+            lines.append(line)
+        return lines
+
+    def save(self, path):
+        """
+        Writes every diagnostic to *path* as JSON.
+        """
+        write_json_atomic(path, [{'node_type': node_type, 'message': message,
+                                  'count': entry['count'], 'locations': entry['locations']}
+                                 for (node_type, message), entry in sorted(self.entries.items())])
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Links
+#
+# Collects the anchors (section ids) of every page while Sphinx reads the doc
+# set, builds the table of finished XWiki link targets used by the
+# translator, and keeps the index of which pages link to which, so that the
+# pages linking to a renamed page can be written again.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+from docutils import nodes
+from sphinx.environment.collectors import EnvironmentCollector
+
+
+def get_section_ids(env):
+    """
+    Returns the dict of docname -> list of section ids stored in the Sphinx environment.
+    """
+    if not hasattr(env, 'xwiki_section_ids'):
+        env.xwiki_section_ids = {}
+    return env.xwiki_section_ids
+
+
+class SectionIdCollector(EnvironmentCollector):
+    """
+    Records the ids of each page's sections. These are the only anchors that the translator writes
+    (as ``(% id="..." %)``), so they're the only ones a link can point to.
+    """
+
+    def clear_doc(self, app, env, docname):
+        get_section_ids(env).pop(docname, None)
+
+    def merge_other(self, app, env, docnames, other):
+        section_ids = get_section_ids(env)
+        other_section_ids = get_section_ids(other)
+        for docname in docnames:
+            if docname in other_section_ids:
+                section_ids[docname] = other_section_ids[docname]
+
+    def process_doc(self, app, doctree):
+        section_ids = []
+        for section in doctree.findall(nodes.section):
+            section_ids.extend(section['ids'])
+        get_section_ids(app.env)[app.env.docname] = section_ids
+
+
+def build_link_table(page_index, section_ids):
+    """
+    Returns a dict mapping every internal refuri that can appear in the doc set ("PageName" or
+    "PageName#anchor") to the finished XWiki link target for it.
+
+    page_index:
+       The PageIndex for the doc set.
+    section_ids:
+       A dict of docname -> list of section ids (see get_section_ids()).
+    """
+    link_table = {}
+    for docname, page in page_index.pages.items():
+        page_name = page['page_name']
+        reference = page['reference']
+        link_table[page_name] = reference
+        for section_id in section_ids.get(docname, ()):
+            link_table['%s#%s' % (page_name, section_id)] = '{0}||anchor="{1}"'.format(
+                reference, section_id)
+    return link_table
+
+
+class LinkIndex(object):
+    """
+    The reverse index of the links between pages: for each target docname, the docnames of the
+    pages that link to it. For each referring page, the index keeps the reference the target had
+    when the page was written and the anchors it links to ('' for a link to the page itself), each
+    with whether it was found in the link table, so that the pages whose links would now be written
+    differently can be found without translating them.
+    """
+
+    def __init__(self, targets=None):
+        """
+        targets:
+           The index as stored: a dict of target docname -> {referring docname -> {'reference',
+           'anchors': {anchor -> found}}}.
+        """
+        self.targets = targets or {}
+        # referring docname -> set of target docnames, to update the index page by page.
+        self.referrers = {}
+        for target, referrers in self.targets.items():
+            for docname in referrers:
+                self.referrers.setdefault(docname, set()).add(target)
+
+    def forget(self, docname):
+        """
+        Removes the links from the page *docname*.
+        """
+        for target in self.referrers.pop(docname, ()):
+            referrers = self.targets.get(target)
+            if referrers is not None:
+                referrers.pop(docname, None)
+                if not referrers:
+                    del self.targets[target]
+
+    def set_links(self, docname, links, page_index):
+        """
+        Replaces the links from the page *docname*.
+
+        links:
+           A dict of internal refuri -> True if it was found in the link table (the translator's
+           ``links``).
+        page_index:
+           The PageIndex the page was written with. Links to pages that aren't in it aren't
+           indexed.
+        """
+        self.forget(docname)
+        for refuri, found in links.items():
+            page_name, _, anchor = refuri.partition('#')
+            target = page_index.docnames.get(page_name)
+            if target is None:
+                continue
+            entry = self.targets.setdefault(target, {}).setdefault(docname,
+                {'reference': page_index.get(target)['reference'], 'anchors': {}})
+            entry['anchors'][anchor] = found
+            self.referrers.setdefault(docname, set()).add(target)
+
+    def get_referrers(self, docname):
+        """
+        Returns the docnames of the pages that link to *docname*.
+        """
+        return sorted(self.targets.get(docname, ()))
+
+    def get_stale_referrers(self, page_index, section_ids):
+        """
+        Returns the set of docnames of pages whose links would now be written differently: those
+        linking to a page whose reference has changed (or that has been removed), and those linking
+        to an anchor that has been added to or removed from its page.
+
+        page_index:
+           The current PageIndex.
+        section_ids:
+           A dict of docname -> list of section ids (see get_section_ids()).
+        """
+        stale = set()
+        for target, referrers in self.targets.items():
+            if target not in page_index.pages:
+                stale.update(referrers)
+                continue
+            reference = page_index.get(target)['reference']
+            anchors = set(section_ids.get(target, ()))
+            for docname, entry in referrers.items():
+                if ((entry['reference'] != reference)
+                    or any(anchor and ((anchor in anchors) != found)
+                           for anchor, found in entry['anchors'].items())):
+                    stale.add(docname)
+        return stale
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Build Manifest
+#
+# Keeps track of what the xwiki builder wrote on previous builds, so that
+# incremental builds only rewrite the pages that have actually changed.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import os
+import json
+import hashlib
+
+# bump this whenever the layout of the manifest changes; older manifests are
+# then discarded (and everything is rebuilt).
+MANIFEST_VERSION = 2
+
+MANIFEST_FILENAME = ".xwiki-manifest.json"
+
+
+def hash_bytes(data):
+    """
+    Returns a hex digest for a bytes object.
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_file(path):
+    """
+    Returns a hex digest of the contents of the file at *path*, or None if the
+    file can't be read.
+    """
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def write_bytes_atomic(path, data):
+    """
+    Writes *data* (bytes) to *path* through a temporary file that then replaces
+    the existing file, so readers never see a half-written file.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class HashingFileWriter(object):
+    """
+    Writes text to a temporary file (encoded as UTF-8), hashing it on the way, so that it can be
+    compared with what was written before. Call commit() to move the file into place, or discard()
+    to throw it away.
+    """
+
+    def __init__(self, path, buffer_size=65536):
+        self.path = path
+        self.tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        self.file = open(self.tmp_path, 'wb', buffering=buffer_size)
+        self.digest = hashlib.sha1()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.digest.update(data)
+        self.file.write(data)
+
+    def close(self):
+        """
+        Finishes writing, and returns the hash of the contents (as hash_bytes() would).
+        """
+        self.file.close()
+        return self.digest.hexdigest()
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+def write_json_atomic(path, data):
+    """
+    Writes *data* as JSON to *path*, replacing any existing file atomically so
+    that an interrupted build never leaves a half-written file behind.
+    """
+    write_bytes_atomic(path, json.dumps(data, indent=1, sort_keys=True).encode('utf-8'))
+
+
+class SourceHasher(object):
+    """
+    Hashes source files, reusing a previous hash whenever a file's mtime and
+    size haven't changed (so unchanged files are never re-read).
+    """
+
+    def __init__(self, previous=None):
+        """
+        previous:
+           A dict of {path: {'mtime': ..., 'size': ..., 'hash': ...}} from an
+           earlier build.
+        """
+        self.previous = previous or {}
+        self.current = {}
+
+    def stat(self, path):
+        """
+        Returns a {'mtime', 'size', 'hash'} dict for the file at *path*, or None
+        if it doesn't exist.
+        """
+        path = str(path)
+        if path in self.current:
+            return self.current[path]
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.current[path] = None
+            return None
+        info = self.previous.get(path)
+        if not (info and info['mtime'] == st.st_mtime and info['size'] == st.st_size):
+            info = {'mtime': st.st_mtime, 'size': st.st_size, 'hash': hash_file(path)}
+        self.current[path] = info
+        return info
+
+    def hash(self, path):
+        info = self.stat(path)
+        return info['hash'] if info else None
+
+
+class BuildManifest(object):
+    """
+    The persistent record of a previous build.
+
+    For each docname, the manifest stores the output filename the page was
+    written to, the hash of its source file and the hashes of its
+    dependencies. It also stores the fingerprints of the configuration and the
+    template the pages were written with, the content hash of each attachment
+    that was copied, and the index of the links between pages (see LinkIndex).
+    """
+
+    def __init__(self, outdir):
+        self.path = os.path.join(outdir, MANIFEST_FILENAME)
+        self.config = None
+        self.template = None
+        self.docs = {}
+        self.files = {}
+        self.attachments = {}
+        self.links = {}
+
+    @classmethod
+    def load(cls, outdir):
+        """
+        Loads the manifest stored in *outdir*. If there isn't one (or it can't
+        be read), an empty manifest is returned.
+        """
+        manifest = cls(outdir)
+        try:
+            with open(manifest.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+        if data.get('version') != MANIFEST_VERSION:
+            return manifest
+        manifest.config = data.get('config')
+        manifest.template = data.get('template')
+        manifest.docs = data.get('docs', {})
+        manifest.files = data.get('files', {})
+        manifest.attachments = data.get('attachments', {})
+        manifest.links = data.get('links', {})
+        return manifest
+
+    def save(self):
+        """
+        Writes the manifest back to the output directory.
+        """
+        write_json_atomic(self.path, {
+            'version': MANIFEST_VERSION,
+            'config': self.config,
+            'template': self.template,
+            'docs': self.docs,
+            'files': self.files,
+            'attachments': self.attachments,
+            'links': self.links,
+        })
+
+    def is_outdated(self, docname, output_filename, hasher, srcdir, source, dependencies):
+        """
+        Returns True if *docname* needs to be written again.
+
+        output_filename:
+           The name (relative to the output directory) that the page would be
+           written to now.
+        hasher:
+           The SourceHasher used for this build.
+        source:
+           The path to the document's source file.
+        dependencies:
+           The paths (relative to *srcdir*) of files the document depends on.
+        """
+        entry = self.docs.get(docname)
+        if entry is None:
+            return True
+        # the page has been renamed (or an override was added or removed).
+        if entry['output'] != output_filename:
+            return True
+        if not os.path.exists(os.path.join(os.path.dirname(self.path), output_filename)):
+            return True
+        if entry['source'] != hasher.hash(source):
+            return True
+        deps = {}
+        for dep in dependencies:
+            deps[str(dep)] = hasher.hash(os.path.join(srcdir, dep))
+        return entry['deps'] != deps
+
+    def record(self, docname, output_filename, hasher, srcdir, source, dependencies):
+        """
+        Records that *docname* was written to *output_filename*. Returns the
+        output filename that was previously used for the page if it's different
+        (so the stale file can be removed), or None.
+        """
+        previous = self.docs.get(docname)
+        deps = {}
+        for dep in dependencies:
+            deps[str(dep)] = hasher.hash(os.path.join(srcdir, dep))
+        entry = dict(previous or {})
+        entry.update({
+            'output': output_filename,
+            'source': hasher.hash(source),
+            'deps': deps,
+        })
+        self.docs[docname] = entry
+        if previous and previous['output'] != output_filename:
+            return previous['output']
+        return None
+
+    def get(self, docname, key, default=None):
+        """
+        Returns a value stored for *docname*, or *default*.
+        """
+        return self.docs.get(docname, {}).get(key, default)
+
+    def update(self, docname, values):
+        """
+        Stores extra values (from a dict) for *docname*, which must already
+        have been recorded.
+        """
+        self.docs[docname].update(values)
+
+    def forget(self, docname):
+        """
+        Removes *docname* from the manifest, returning its output filename.
+        """
+        entry = self.docs.pop(docname, None)
+        return entry['output'] if entry else None
+
+    def outputs(self):
+        """
+        Returns the set of all output filenames in the manifest.
+        """
+        return set(entry['output'] for entry in self.docs.values())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Translator Profiler
+#
+# An instrumented version of the XWiki translator that counts and times every
+# node visit and handler call, and tracks how groups are used, plus the code
+# to aggregate the results over a build and report on them.
+#
+# It's only used when the xwiki_profile option is set; otherwise the plain
+# translator is used and nothing is measured.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import time
+from abstrys.sphinx_xwiki_manifest import write_json_atomic
+from abstrys.sphinx_xwiki_writer import XWikiTranslator
+
+
+class ProfilingXWikiTranslator(XWikiTranslator):
+    """
+    An XWikiTranslator that records, for the document it translates:
+
+    * the number of visits to, and the time spent in the handlers of, each node type.
+    * the number of calls to, and the time spent in, each handler (several node types can share a
+      handler).
+    * the number of groups pushed and popped, and the deepest the group stack got.
+
+    Handler times are exclusive: the time spent on a node's children isn't included.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.start_time = time.perf_counter()
+        XWikiTranslator.__init__(self, *args, **kwargs)
+        # node type -> [visits, seconds]
+        self.node_stats = {}
+        # handler name -> [calls, seconds]
+        self.handler_stats = {}
+        self.group_pushes = 0
+        self.group_pops = 0
+        self.max_group_depth = 0
+
+
+    def _record(self, node, handler, elapsed):
+        node_stats = self.node_stats.setdefault(node.__class__.__name__, [0, 0.0])
+        node_stats[1] += elapsed
+        handler_stats = self.handler_stats.setdefault(handler.__name__, [0, 0.0])
+        handler_stats[0] += 1
+        handler_stats[1] += elapsed
+        return node_stats
+
+
+    def dispatch_visit(self, node):
+        try:
+            visit = self._dispatch_table[node.__class__][0]
+        except KeyError:
+            visit = self._add_dispatch_entry(node.__class__)[0]
+        start = time.perf_counter()
+        try:
+            return visit(self, node)
+        finally:
+            self._record(node, visit, time.perf_counter() - start)[0] += 1
+
+
+    def dispatch_departure(self, node):
+        try:
+            depart = self._dispatch_table[node.__class__][1]
+        except KeyError:
+            depart = self._add_dispatch_entry(node.__class__)[1]
+        start = time.perf_counter()
+        try:
+            return depart(self, node)
+        finally:
+            self._record(node, depart, time.perf_counter() - start)
+
+
+    def _push_group(self, node, prefix=""):
+        XWikiTranslator._push_group(self, node, prefix)
+        self.group_pushes += 1
+        self.max_group_depth = max(self.max_group_depth, len(self.group_stack))
+
+
+    def _pop_group(self, postfix=""):
+        self.group_pops += 1
+        return XWikiTranslator._pop_group(self, postfix)
+
+
+    def get_profile(self):
+        """
+        Returns the measurements for the document as a dict (which can be pickled, so that it can
+        be passed back from a worker process). Call it once the document has been translated: its
+        'seconds' is the time taken since the translator was created.
+        """
+        return {
+            'seconds': time.perf_counter() - self.start_time,
+            'nodes': self.node_stats,
+            'handlers': self.handler_stats,
+            'group_pushes': self.group_pushes,
+            'group_pops': self.group_pops,
+            'max_group_depth': self.max_group_depth,
+        }
+
+
+class TranslatorProfile(object):
+    """
+    The profiles of all of the documents translated during a build, added up.
+    """
+
+    def __init__(self):
+        # node type -> [visits, seconds]
+        self.nodes = {}
+        # handler name -> [calls, seconds]
+        self.handlers = {}
+        # docname -> {'seconds', 'group_pushes', 'group_pops', 'max_group_depth'}
+        self.documents = {}
+
+
+    def add_document(self, docname, profile):
+        """
+        Adds the profile of one document (from ProfilingXWikiTranslator.get_profile()).
+        """
+        for totals, stats in ((self.nodes, profile['nodes']),
+                              (self.handlers, profile['handlers'])):
+            for name, (count, elapsed) in stats.items():
+                total = totals.setdefault(name, [0, 0.0])
+                total[0] += count
+                total[1] += elapsed
+        self.documents[docname] = {
+            'seconds': profile['seconds'],
+            'group_pushes': profile['group_pushes'],
+            'group_pops': profile['group_pops'],
+            'max_group_depth': profile['max_group_depth'],
+        }
+
+
+    def report(self, limit=15):
+        """
+        Returns the lines of a report of the most expensive node types, handlers and documents.
+        """
+        lines = []
+        for title, stats in (("node type", self.nodes), ("handler", self.handlers)):
+            lines.append("%-32s %10s %12s %10s" % (title, "count", "total (ms)", "us each"))
+            by_time = sorted(stats.items(), key=lambda item: -item[1][1])
+            for name, (count, elapsed) in by_time[:limit]:
+                lines.append("%-32s %10d %12.2f %10.2f" % (name, count, elapsed * 1e3,
+                                                           (elapsed * 1e6 / count) if count else 0))
+            lines.append("")
+        lines.append("%-32s %12s %8s %8s %10s" % ("document", "total (ms)", "pushes", "pops",
+                                                  "max depth"))
+        for docname, doc in sorted(self.documents.items(),
+                                   key=lambda item: -item[1]['seconds'])[:limit]:
+            lines.append("%-32s %12.2f %8d %8d %10d" % (docname, doc['seconds'] * 1e3,
+                doc['group_pushes'], doc['group_pops'], doc['max_group_depth']))
+        return lines
+
+
+    def save(self, path):
+        """
+        Writes the profile to *path* as JSON.
+        """
+        write_json_atomic(path, {
+            'nodes': dict((name, {'count': count, 'seconds': elapsed})
+                          for name, (count, elapsed) in self.nodes.items()),
+            'handlers': dict((name, {'count': count, 'seconds': elapsed})
+                             for name, (count, elapsed) in self.handlers.items()),
+            'documents': self.documents,
+        })
@@ -0,0 +1,648 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Publisher
+#
+# Publishes the pages (and attachments) written by the xwiki builder to an
+# XWiki instance through its REST API:
+#
+# * https://www.xwiki.org/xwiki/bin/view/Documentation/UserGuide/Features/XWikiRESTfulAPI
+#
+# Requests go through persistent (keep-alive) connections, one per worker
+# thread, with a bounded number of workers, retries with exponential backoff
+# and an optional rate limit.
+#
+# What was last published is kept in a publish manifest, so that only the
+# pages and attachments that were created, changed or deleted since then are
+# sent again.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import os, sys, time, json
+import base64
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, quote
+from xml.sax.saxutils import escape
+from abstrys.sphinx_xwiki_assets import ATTACHMENTS_DIRNAME
+from abstrys.sphinx_xwiki_manifest import hash_bytes, hash_file, write_json_atomic
+
+# HTTP status codes that are worth retrying.
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# bump this whenever the layout of the publish manifest changes.
+PUBLISH_MANIFEST_VERSION = 1
+
+PUBLISH_MANIFEST_FILENAME = ".xwiki-published.json"
+
+PAGE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<page xmlns="http://www.xwiki.org">
+<title>{title}</title>
+<syntax>xwiki/2.1</syntax>
+<content>{content}</content>
+</page>
+"""
+
+
+class PublishError(Exception):
+    """
+    Raised when a request to XWiki fails (after any retries).
+    """
+    pass
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() so that no more than *rate* happen per second. A rate of 0 means
+    there's no limit.
+    """
+
+    def __init__(self, rate=0):
+        self.interval = (1.0 / rate) if rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class XWikiPublisher(object):
+    """
+    Publishes pages to XWiki through its REST API.
+    """
+
+    def __init__(self, url, wiki='xwiki', user=None, password=None, jobs=4, rate=0, retries=3,
+                 backoff=0.5, timeout=30):
+        """
+        url:
+           The base URL of the XWiki instance (for example, ``http://localhost:8080/xwiki``).
+        wiki:
+           The name of the wiki to publish to.
+        user, password:
+           The credentials used for HTTP basic authentication, if any.
+        jobs:
+           The maximum number of concurrent requests.
+        rate:
+           The maximum number of requests per second (0 for no limit).
+        retries:
+           How many times a failed request is retried.
+        backoff:
+           The delay before the first retry, in seconds. It's doubled for each retry after that.
+        """
+        self.url = url
+        self.wiki = wiki
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or 'http'
+        self.netloc = parts.netloc
+        self.base_path = parts.path.rstrip('/') + '/rest/wikis/' + quote(wiki, safe='')
+        self.jobs = max(jobs, 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate)
+        self.headers = {}
+        if user:
+            credentials = ('%s:%s' % (user, password or '')).encode('utf-8')
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        # each worker thread keeps its own persistent connection.
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    #
+    # connection handling
+    #
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.scheme == 'https':
+                connection = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _drop_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def close(self):
+        """
+        Closes all of the connections opened by the publisher.
+        """
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    def request(self, method, path, body=None, headers=None, missing_ok=False):
+        """
+        Sends a request (retrying it if needed), returning a tuple of (status, response body).
+        Raises PublishError if the request fails. A 304 (Not Modified) response to a PUT is a
+        success: XWiki sends it when the content is the same as what's already there.
+
+        missing_ok:
+           If True, a 404 (Not Found) response is returned rather than raised.
+        """
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                connection = self._get_connection()
+                connection.request(method, path, body=body, headers=all_headers)
+                response = connection.getresponse()
+                data = response.read()
+                status = response.status
+                retry_after = response.getheader('Retry-After')
+                if response.will_close:
+                    self._drop_connection()
+            except (OSError, http.client.HTTPException) as e:
+                # the connection was dropped (or never made); start a new one.
+                self._drop_connection()
+                status, data, retry_after = None, str(e), None
+            if (status is not None) and ((status < 300) or (missing_ok and status == 404)
+                                         or (method == 'PUT' and status == 304)):
+                return (status, data)
+            if (status is not None and status not in RETRY_STATUSES) or attempt == self.retries:
+                raise PublishError("%s %s failed: %s" % (method, path, status or data))
+            if retry_after and retry_after.isdigit():
+                time.sleep(max(int(retry_after), delay))
+            else:
+                time.sleep(delay)
+            delay *= 2
+
+    #
+    # XWiki REST resources
+    #
+    def get_page_path(self, reference):
+        """
+        Returns the REST path for a page reference ("Space.SubSpace.Page"). Every page is published
+        as the WebHome of a nested page, so that other pages can be nested beneath it.
+        """
+        spaces = ''.join('/spaces/' + quote(part, safe='') for part in reference.split('.') if part)
+        return self.base_path + spaces + '/pages/WebHome'
+
+    def put_page(self, reference, title, content):
+        body = PAGE_XML.format(title=escape(title), content=escape(content)).encode('utf-8')
+        return self.request('PUT', self.get_page_path(reference), body,
+                            {'Content-Type': 'application/xml; charset=utf-8'})
+
+    def put_attachment(self, reference, name, data):
+        path = self.get_page_path(reference) + '/attachments/' + quote(name, safe='')
+        return self.request('PUT', path, data, {'Content-Type': 'application/octet-stream'})
+
+    def delete_page(self, reference):
+        return self.request('DELETE', self.get_page_path(reference), missing_ok=True)
+
+    def delete_attachment(self, reference, name):
+        path = self.get_page_path(reference) + '/attachments/' + quote(name, safe='')
+        return self.request('DELETE', path, missing_ok=True)
+
+    def get_json(self, path):
+        """
+        Returns the decoded JSON representation of a REST resource, or None if it doesn't exist.
+        """
+        status, data = self.request('GET', path, headers={'Accept': 'application/json'},
+                                    missing_ok=True)
+        if status == 404:
+            return None
+        return json.loads(data.decode('utf-8'))
+
+    def fetch_page(self, reference):
+        """
+        Returns the page (as decoded JSON) and the list of its attachments (from the attachment
+        listing), or None if the page doesn't exist.
+        """
+        page_path = self.get_page_path(reference)
+        page = self.get_json(page_path)
+        if page is None:
+            return None
+        listing = self.get_json(page_path + '/attachments') or {}
+        return page, listing.get('attachments', [])
+
+    def fetch_attachment_hash(self, reference, name):
+        """
+        Returns the hash of the contents of an attachment, as it is on the server.
+        """
+        path = self.get_page_path(reference) + '/attachments/' + quote(name, safe='')
+        status, data = self.request('GET', path)
+        return hash_bytes(data)
+
+    #
+    # publishing
+    #
+    def _map(self, func, items):
+        """
+        Calls *func* on each item with up to *jobs* calls at once, yielding (item, result, error)
+        tuples in the order of *items*.
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [(item, executor.submit(func, item)) for item in items]
+            for item, future in futures:
+                try:
+                    yield (item, future.result(), None)
+                except (PublishError, OSError) as e:
+                    yield (item, None, e)
+
+    def publish_change(self, change):
+        """
+        Sends a single change (from plan_changes()) to XWiki, returning the number of attachments
+        uploaded.
+        """
+        if change['action'] == 'delete':
+            self.delete_page(change['reference'])
+            return 0
+        page = change['page']
+        if change['content']:
+            self.put_page(change['reference'], page['title'], page['content'])
+        for name, path in change['upload']:
+            with open(path, 'rb') as f:
+                self.put_attachment(change['reference'], name, f.read())
+        for name in change['remove']:
+            self.delete_attachment(change['reference'], name)
+        if change['old_reference']:
+            # the page has moved; remove it from its old place.
+            self.delete_page(change['old_reference'])
+        return len(change['upload'])
+
+    def publish(self, changes, published=None, on_error=None):
+        """
+        Sends changes (from plan_changes()) to XWiki concurrently, with up to *jobs* requests at
+        once.
+
+        published:
+           The publish manifest's dict of page name -> published state. It's updated as each change
+           succeeds, so a failed change is tried again the next time.
+        on_error:
+           Called with (change, exception) for each change that fails. If it isn't set, the first
+           failure is raised once all of the changes have been tried.
+
+        Returns a dict of statistics: the number of pages 'created', 'updated' and 'deleted', the
+        number of 'attachments' uploaded, the number of 'failed' changes, the 'elapsed' time and the
+        throughput in 'pages_per_second'.
+        """
+        published = {} if published is None else published
+        stats = {'created': 0, 'updated': 0, 'deleted': 0, 'attachments': 0, 'failed': 0}
+        first_error = None
+        start = time.perf_counter()
+        try:
+            for change, uploaded, error in self._map(self.publish_change, changes):
+                if error is not None:
+                    stats['failed'] += 1
+                    if on_error is not None:
+                        on_error(change, error)
+                    elif first_error is None:
+                        first_error = error
+                    continue
+                stats[change['action'] + 'd'] += 1
+                stats['attachments'] += uploaded
+                if change['action'] == 'delete':
+                    published.pop(change['page_name'], None)
+                else:
+                    published[change['page_name']] = change['state']
+        finally:
+            self.close()
+        stats['elapsed'] = time.perf_counter() - start
+        done = stats['created'] + stats['updated'] + stats['deleted']
+        stats['pages_per_second'] = (done / stats['elapsed']) if stats['elapsed'] else 0.0
+        if first_error is not None:
+            raise first_error
+        return stats
+
+    def fetch_published(self, pages, on_error=None):
+        """
+        Rebuilds the publish manifest's dict of page name -> published state (see
+        get_page_state()) from the server, for the pages in *pages* (from load_pages()).
+
+        Each page and its attachment listing is fetched (concurrently). XWiki's listing doesn't
+        include a hash of each attachment's contents, so an attachment can only be known to be the
+        same as the local file by downloading it; that's only done (again concurrently) when its
+        size matches the local file's. Any other attachment is recorded as changed, so it's
+        uploaded again.
+
+        on_error:
+           Called with (page, exception) for each page that can't be fetched; if it isn't set, the
+           first error is raised.
+        """
+        published = {}
+        downloads = []
+        try:
+            for page, fetched, error in self._map(
+                    lambda page: self.fetch_page(page['reference']), pages):
+                if error is not None:
+                    if on_error is None:
+                        raise error
+                    on_error(page, error)
+                    continue
+                if fetched is None:
+                    continue
+                remote_page, listing = fetched
+                local_paths = dict(page['attachments'])
+                attachments = {}
+                for attachment in listing:
+                    name = attachment['name']
+                    size = attachment.get('longSize', attachment.get('size'))
+                    path = local_paths.get(name)
+                    # None never matches a local file's hash.
+                    attachments[name] = None
+                    if (path is not None) and os.path.exists(path) and (
+                        (size is None) or (int(size) == os.path.getsize(path))):
+                        downloads.append((page, name))
+                published[page['page_name']] = {
+                    'reference': page['reference'],
+                    'hash': hash_page(remote_page.get('title') or '',
+                                      remote_page.get('content') or ''),
+                    'attachments': attachments,
+                }
+
+            for (page, name), content_hash, error in self._map(
+                    lambda item: self.fetch_attachment_hash(item[0]['reference'], item[1]),
+                    downloads):
+                if error is not None:
+                    # the page's state isn't known, so it's published again.
+                    published.pop(page['page_name'], None)
+                    if on_error is None:
+                        raise error
+                    on_error(page, error)
+                elif page['page_name'] in published:
+                    published[page['page_name']]['attachments'][name] = content_hash
+        finally:
+            self.close()
+        return published
+
+
+def hash_page(title, content):
+    """
+    Returns the hash of a page's published title and content.
+    """
+    return hash_bytes(json.dumps([title, content]).encode('utf-8'))
+
+
+def get_page_state(page):
+    """
+    Returns the state a page will have on the server once it's published: a dict with its
+    'reference', the 'hash' of its title and content, and a dict of attachment name -> content hash
+    ('attachments').
+    """
+    return {
+        'reference': page['reference'],
+        'hash': hash_page(page['title'], page['content']),
+        'attachments': dict((name, hash_file(path)) for (name, path) in page['attachments']),
+    }
+
+
+class PublishManifest(object):
+    """
+    The record of what was last published to an XWiki instance: the state (see get_page_state())
+    of each page, keyed by page name.
+    """
+
+    def __init__(self, outdir, url, wiki='xwiki'):
+        self.path = os.path.join(outdir, PUBLISH_MANIFEST_FILENAME)
+        self.url = url
+        self.wiki = wiki
+        # None if there's no record of publishing to this url and wiki.
+        self.pages = None
+
+    @classmethod
+    def load(cls, outdir, url, wiki='xwiki'):
+        """
+        Loads the publish manifest stored in *outdir*. If there isn't one, it can't be read or it
+        records publishing somewhere else, the manifest's pages are None.
+        """
+        manifest = cls(outdir, url, wiki)
+        try:
+            with open(manifest.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+        if ((data.get('version') == PUBLISH_MANIFEST_VERSION) and (data.get('url') == url)
+            and (data.get('wiki') == wiki)):
+            manifest.pages = data.get('pages', {})
+        return manifest
+
+    def save(self):
+        write_json_atomic(self.path, {
+            'version': PUBLISH_MANIFEST_VERSION,
+            'url': self.url,
+            'wiki': self.wiki,
+            'pages': self.pages or {},
+        })
+
+
+def plan_changes(pages, published):
+    """
+    Works out what needs to be sent to XWiki to bring it up to date with *pages*.
+
+    pages:
+       The pages to publish, from load_pages().
+    published:
+       The publish manifest's dict of page name -> published state.
+
+    Returns a list of changes: dicts with the 'action' ('create', 'update' or 'delete'), the
+    'page_name', the 'reference' to publish to, the 'page' and its new 'state', whether the page
+    'content' needs to be sent, the attachments to 'upload' (as (name, path) tuples) and the
+    attachments to 'remove'. If a page has moved, its 'old_reference' is set.
+    """
+    changes = []
+    page_names = set()
+    for page in pages:
+        page_names.add(page['page_name'])
+        state = get_page_state(page)
+        old_state = published.get(page['page_name'])
+        change = {
+            'action': 'update',
+            'page_name': page['page_name'],
+            'reference': page['reference'],
+            'page': page,
+            'state': state,
+            'content': True,
+            'upload': list(page['attachments']),
+            'remove': [],
+            'old_reference': None,
+        }
+        if old_state is None:
+            change['action'] = 'create'
+        elif old_state['reference'] != state['reference']:
+            change['old_reference'] = old_state['reference']
+        else:
+            old_attachments = old_state['attachments']
+            change['content'] = (old_state['hash'] != state['hash'])
+            change['upload'] = [(name, path) for (name, path) in page['attachments']
+                                if old_attachments.get(name) != state['attachments'][name]]
+            change['remove'] = sorted(name for name in old_attachments
+                                      if name not in state['attachments'])
+            if not (change['content'] or change['upload'] or change['remove']):
+                continue
+        changes.append(change)
+
+    for page_name in sorted(published):
+        if page_name not in page_names:
+            changes.append({
+                'action': 'delete',
+                'page_name': page_name,
+                'reference': published[page_name]['reference'],
+                'page': None,
+                'state': None,
+                'content': False,
+                'upload': [],
+                'remove': [],
+                'old_reference': None,
+            })
+    return changes
+
+
+def format_change(change):
+    """
+    Returns a one-line description of a change, for dry runs.
+    """
+    details = []
+    if change['old_reference']:
+        details.append("moved from %s" % change['old_reference'])
+    elif change['action'] == 'update' and change['content']:
+        details.append("content")
+    if change['upload']:
+        details.append("upload %s" % ", ".join(name for (name, path) in change['upload']))
+    if change['remove']:
+        details.append("remove %s" % ", ".join(change['remove']))
+    line = "%s %s (%s)" % (change['action'], change['page_name'], change['reference'])
+    if details:
+        line += ": " + "; ".join(details)
+    return line
+
+
+def format_stats(stats):
+    """
+    Returns a summary of the statistics from XWikiPublisher.publish().
+    """
+    return ("%d pages created, %d updated, %d deleted, %d unchanged (%d attachments) in %.2fs: "
+            "%.1f pages/s, %d failed" % (stats['created'], stats['updated'], stats['deleted'],
+            stats.get('unchanged', 0), stats['attachments'], stats['elapsed'],
+            stats['pages_per_second'], stats['failed']))
+
+
+def load_pages(outdir, page_index=None, docnames=None):
+    """
+    Returns the pages written to *outdir* (as dicts for plan_changes()), using the page index
+    (xwiki-pages.json) stored there.
+
+    page_index:
+       The page index (as a dict); if None, it's read from *outdir*.
+    docnames:
+       If set, only these docnames are returned.
+    """
+    if page_index is None:
+        with open(os.path.join(outdir, 'xwiki-pages.json'), encoding='utf-8') as f:
+            page_index = json.load(f)
+    pages = []
+    for docname in sorted(page_index):
+        if (docnames is not None) and (docname not in docnames):
+            continue
+        entry = page_index[docname]
+        with open(os.path.join(outdir, entry['filename']), encoding='utf-8') as f:
+            content = f.read()
+        pages.append({
+            'docname': docname,
+            'page_name': entry['page_name'],
+            'reference': entry['reference'],
+            'title': entry.get('title') or entry['page_name'],
+            'content': content,
+            'attachments': [(name, os.path.join(outdir, ATTACHMENTS_DIRNAME, name))
+                            for name in entry.get('attachments', [])],
+        })
+    return pages
+
+
+def publish_outdir(publisher, outdir, page_index=None, dry_run=False, rebuild=False, log=print,
+                   on_error=None):
+    """
+    Publishes the pages in a builder output directory, sending only what has changed since the
+    last time they were published (according to the publish manifest stored there).
+
+    rebuild:
+       If True, the publish manifest is rebuilt from the server first. This also happens when
+       there's no publish manifest for the publisher's url and wiki.
+    dry_run:
+       If True, the changes are logged rather than sent.
+    log:
+       Called with each line of output.
+
+    Returns the statistics from XWikiPublisher.publish() (or None for a dry run).
+    """
+    pages = load_pages(outdir, page_index)
+    manifest = PublishManifest.load(outdir, publisher.url, publisher.wiki)
+    if rebuild or manifest.pages is None:
+        log("fetching the published state of %d pages from %s" % (len(pages), publisher.url))
+        manifest.pages = publisher.fetch_published(pages, on_error=on_error)
+        if not dry_run:
+            manifest.save()
+
+    changes = plan_changes(pages, manifest.pages)
+    unchanged = len(pages) - sum(1 for change in changes if change['action'] != 'delete')
+    if dry_run:
+        for change in changes:
+            log(format_change(change))
+        log("%d changes, %d pages unchanged (dry run)" % (len(changes), unchanged))
+        return None
+
+    try:
+        stats = publisher.publish(changes, manifest.pages, on_error=on_error)
+    finally:
+        # record whatever was published, even if publishing was interrupted.
+        manifest.save()
+    stats['unchanged'] = unchanged
+    return stats
+
+
+def main(argv=None):
+    """
+    Publishes the output of an earlier xwiki build from the command line.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Publish xwiki builder output to XWiki.")
+    parser.add_argument('outdir', help="the output directory of the xwiki builder")
+    parser.add_argument('--url', required=True, help="the base URL of the XWiki instance")
+    parser.add_argument('--wiki', default='xwiki')
+    parser.add_argument('--user', default=os.environ.get('XWIKI_USER'))
+    parser.add_argument('--password', default=os.environ.get('XWIKI_PASSWORD'))
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0, help="maximum requests per second")
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the changes that would be published, without sending them")
+    parser.add_argument('--rebuild-manifest', action='store_true',
+                        help="rebuild the publish manifest from the pages on the server")
+    args = parser.parse_args(argv)
+
+    publisher = XWikiPublisher(args.url, args.wiki, args.user, args.password, args.jobs,
+                               args.rate, args.retries)
+
+    def on_error(item, error):
+        sys.stderr.write("failed to publish %s: %s\n" % (item['reference'], error))
+
+    stats = publish_outdir(publisher, args.outdir, dry_run=args.dry_run,
+                           rebuild=args.rebuild_manifest, on_error=on_error)
+    if stats is None:
+        return 0
+    print(format_stats(stats))
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Build Trace
+#
+# Records timed spans for the phases of a build (preparing, translating,
+# rendering and writing each page, copying assets, publishing) in an
+# in-memory ring buffer, and writes them out once at the end of the build in
+# the Chrome trace event format, which can be loaded into chrome://tracing or
+# https://ui.perfetto.dev:
+#
+# * https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import os
+import time
+import threading
+import collections
+from contextlib import contextmanager, nullcontext
+from abstrys.sphinx_xwiki_manifest import write_json_atomic
+
+# the number of spans kept; once the buffer is full, the oldest spans are dropped.
+TRACE_BUFFER_SIZE = 200000
+
+
+class TraceBuffer(object):
+    """
+    A ring buffer of timed spans. Each span is stored as a (name, start, end, pid, tid, args)
+    tuple, with times from a clock that's shared by forked worker processes, so spans recorded in
+    workers can be merged into the main buffer.
+    """
+
+    def __init__(self, capacity=TRACE_BUFFER_SIZE):
+        self.spans = collections.deque(maxlen=capacity)
+        self.origin = self.clock()
+        self.main_pid = os.getpid()
+
+    @staticmethod
+    def clock():
+        """
+        Returns the current time in nanoseconds.
+        """
+        return time.monotonic_ns()
+
+    def add(self, name, start, end=None, **args):
+        """
+        Records a span that started at *start* (from clock()) and ended at *end* (or now).
+        """
+        if end is None:
+            end = self.clock()
+        self.spans.append((name, start, end, os.getpid(), threading.get_native_id(), args))
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Records a span for the body of a ``with`` statement.
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, start, **args)
+
+    def clear(self):
+        self.spans.clear()
+
+    def drain(self):
+        """
+        Returns the recorded spans (as a list) and empties the buffer.
+        """
+        spans = list(self.spans)
+        self.spans.clear()
+        return spans
+
+    def extend(self, spans):
+        """
+        Adds spans (from drain(), perhaps in another process) to the buffer.
+        """
+        self.spans.extend(spans)
+
+    def save(self, path):
+        """
+        Writes the spans to *path* as a Chrome trace event file.
+        """
+        events = []
+        pids = set()
+        for name, start, end, pid, tid, args in self.spans:
+            pids.add(pid)
+            events.append({'name': name, 'cat': 'xwiki', 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': (start - self.origin) / 1000.0, 'dur': (end - start) / 1000.0,
+                           'args': args})
+        for pid in sorted(pids):
+            process_name = 'sphinx-build' if pid == self.main_pid else 'worker %d' % pid
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                           'args': {'name': process_name}})
+        write_json_atomic(path, {'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+
+class NullTrace(object):
+    """
+    Stands in for a TraceBuffer when tracing is off; nothing is recorded.
+    """
+
+    @staticmethod
+    def clock():
+        return 0
+
+    def add(self, name, start, end=None, **args):
+        pass
+
+    def span(self, name, **args):
+        return nullcontext()
+
+    def clear(self):
+        pass
+
+    def drain(self):
+        return []
+
+    def extend(self, spans):
+        pass
+
+
+NULL_TRACE = NullTrace()
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Watch Mode
+#
+# Builds a doc set with the xwiki builder, then watches its sources and
+# rebuilds whatever changes, in the same process: the Sphinx environment, the
+# compiled page template and the translator's dispatch tables are kept between
+# builds, so a change to one page only costs reading and writing that page
+# (and the pages that link to it).
+#
+# Changes are picked up with inotify where it's available (Linux), or by
+# polling the source files otherwise. Optionally, the output can be served
+# over HTTP, for previewing pages while writing them.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import sys, os
+import time
+import json
+import select
+import struct
+import threading
+import traceback
+from contextlib import ExitStack
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+# once a change has been seen, changes are collected until there's been none for this long (in
+# seconds), so that saving several files at once only causes one build.
+SETTLE_TIME = 0.05
+
+# how often (in seconds) the sources are checked for changes when polling.
+POLL_INTERVAL = 0.5
+
+# inotify event flags (see inotify(7)).
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def is_ignored(path, excluded):
+    """
+    Returns True if changes to *path* should be ignored: hidden files and directories, editor
+    backup files and anything in one of the *excluded* directories (the output directory, say).
+    """
+    name = os.path.basename(path)
+    if name.startswith('.') or name.endswith('~') or name.endswith('.swp'):
+        return True
+    return any(path == directory or path.startswith(directory + os.sep)
+               for directory in excluded)
+
+
+class PollingWatcher(object):
+    """
+    Finds changed files by comparing the mtime and size of every file in a set of directories
+    (and of a few other files) with what they were when last checked.
+    """
+
+    def __init__(self, directories, files=(), excluded=(), interval=POLL_INTERVAL):
+        """
+        directories:
+           The directories to watch, with all of their subdirectories.
+        files:
+           Other files to watch.
+        excluded:
+           Directories (within *directories*) to ignore.
+        interval:
+           The time to wait between checks, in seconds.
+        """
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.files = [os.path.abspath(path) for path in files]
+        self.excluded = [os.path.abspath(directory) for directory in excluded]
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """
+        Returns a dict of path -> (mtime, size) for every watched file.
+        """
+        snapshot = {}
+        paths = list(self.files)
+        for directory in self.directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                dirnames[:] = [name for name in dirnames
+                               if not is_ignored(os.path.join(dirpath, name), self.excluded)]
+                paths.extend(os.path.join(dirpath, name) for name in filenames)
+        for path in paths:
+            if is_ignored(path, self.excluded):
+                continue
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (info.st_mtime_ns, info.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Waits for files to change, returning the set of paths that changed (created, changed or
+        removed), or an empty set if nothing changed within *timeout* seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self.scan()
+            changed = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed:
+                return changed
+            if (deadline is not None) and (time.monotonic() >= deadline):
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Finds changed files through inotify, watching every directory in a set of directories (and the
+    directories containing a few other files). Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self, directories, files=(), excluded=()):
+        """
+        directories:
+           The directories to watch, with all of their subdirectories.
+        files:
+           Other files to watch.
+        excluded:
+           Directories (within *directories*) to ignore.
+        """
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify isn't available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.files = set(os.path.abspath(path) for path in files)
+        self.excluded = [os.path.abspath(directory) for directory in excluded]
+        # watch descriptor -> (directory, whether its subdirectories are watched)
+        self.watches = {}
+        for directory in directories:
+            self.add_tree(os.path.abspath(directory))
+        for directory in set(os.path.dirname(path) for path in self.files):
+            self.add_watch(directory, False)
+
+    def add_watch(self, directory, recursive):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            # a directory that's watched for its files and as part of a tree is watched as a tree.
+            recursive = recursive or self.watches.get(wd, (None, False))[1]
+            self.watches[wd] = (directory, recursive)
+
+    def add_tree(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [name for name in dirnames
+                           if not is_ignored(os.path.join(dirpath, name), self.excluded)]
+            self.add_watch(dirpath, True)
+
+    def read_events(self):
+        """
+        Returns the set of paths in the events that are waiting to be read.
+        """
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost: report the watched trees themselves as changed.
+                    changed.update(directory for directory, recursive in self.watches.values()
+                                   if recursive)
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if wd not in self.watches:
+                    continue
+                directory, recursive = self.watches[wd]
+                path = os.path.join(directory, name) if name else directory
+                if not (recursive or path in self.files) or is_ignored(path, self.excluded):
+                    continue
+                if recursive and (mask & IN_ISDIR) and (mask & (IN_CREATE | IN_MOVED_TO)):
+                    self.add_tree(path)
+                changed.add(path)
+
+    def wait(self, timeout=None):
+        """
+        Waits for files to change, returning the set of paths that changed (created, changed or
+        removed), or an empty set if nothing changed within *timeout* seconds.
+        """
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return set()
+        return self.read_events()
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(directories, files=(), excluded=(), poll=False):
+    """
+    Returns an InotifyWatcher, or a PollingWatcher if *poll* is set or inotify isn't available.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(directories, files, excluded)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directories, files, excluded)
+
+
+def wait_for_changes(watcher, settle_time=SETTLE_TIME):
+    """
+    Waits for files to change, then keeps collecting changes until there's been none for
+    *settle_time* seconds. Returns (the set of changed paths, the time the first change was seen).
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.wait(None)
+    first_seen = time.monotonic()
+    while True:
+        more = watcher.wait(settle_time)
+        if not more:
+            return changed, first_seen
+        changed |= more
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    """
+    Serves the output of the xwiki builder: ``/`` lists the pages (from xwiki-pages.json, as JSON)
+    and ``/<PageName>`` (or ``/<docname>``) returns the XWiki text of a page.
+    """
+
+    def reply(self, status, data, content_type='text/plain; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def load_pages(self):
+        try:
+            with open(os.path.join(self.server.outdir, 'xwiki-pages.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def do_GET(self):
+        pages = self.load_pages()
+        name = unquote(self.path.split('?')[0]).strip('/')
+        if name == '':
+            listing = [{'docname': docname, 'page_name': page['page_name'],
+                        'reference': page['reference'], 'title': page.get('title', ''),
+                        'url': '/' + page['page_name']}
+                       for docname, page in sorted(pages.items())]
+            return self.reply(200, json.dumps(listing, indent=1).encode('utf-8'),
+                              'application/json')
+        if name.endswith('.xwiki'):
+            name = name[:-len('.xwiki')]
+        for docname, page in pages.items():
+            if name in (docname, page['page_name']):
+                try:
+                    with open(os.path.join(self.server.outdir, page['filename']), 'rb') as f:
+                        return self.reply(200, f.read())
+                except OSError:
+                    break
+        self.reply(404, ("no page named %s\n" % name).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_output(outdir, host='127.0.0.1', port=8000):
+    """
+    Serves the output directory over HTTP in a background thread, returning the server.
+    """
+    server = ThreadingHTTPServer((host, port), PreviewHandler)
+    server.outdir = outdir
+    thread = threading.Thread(target=server.serve_forever, name='xwiki-preview', daemon=True)
+    thread.start()
+    return server
+
+
+class Watcher(object):
+    """
+    Keeps a Sphinx application (with the xwiki builder) for a doc set, and rebuilds it when its
+    sources change.
+    """
+
+    def __init__(self, srcdir, outdir, confdir=None, doctreedir=None, confoverrides=None,
+                 status=sys.stdout, warning=sys.stderr):
+        self.srcdir = os.path.abspath(srcdir)
+        self.outdir = os.path.abspath(outdir)
+        self.confdir = os.path.abspath(confdir or srcdir)
+        self.doctreedir = os.path.abspath(doctreedir or os.path.join(outdir, '.doctrees'))
+        self.confoverrides = confoverrides or {}
+        self.status = status
+        self.warning = warning
+        self.app = None
+        # the docutils registrations made by the application, which are undone when it's replaced.
+        self.namespace = ExitStack()
+
+    def create_app(self):
+        """
+        Creates (or replaces) the Sphinx application. As in sphinx-build, the directives, roles and
+        nodes it registers with docutils are kept in their own namespace, so that a new application
+        can register them again.
+        """
+        from sphinx.application import Sphinx
+        from sphinx.util.docutils import docutils_namespace, patch_docutils
+        self.app = None
+        self.namespace.close()
+        self.namespace = ExitStack()
+        self.namespace.enter_context(patch_docutils(self.confdir))
+        self.namespace.enter_context(docutils_namespace())
+        self.app = Sphinx(self.srcdir, self.confdir, self.outdir, self.doctreedir, 'xwiki',
+                          confoverrides=dict(self.confoverrides), status=self.status,
+                          warning=self.warning, freshenv=False)
+
+    def close(self):
+        self.app = None
+        self.namespace.close()
+
+    def get_watched_files(self):
+        """
+        Returns the files outside of the source directory that the build depends on: conf.py and
+        the page template.
+        """
+        files = [os.path.join(self.confdir, 'conf.py')]
+        template = self.app.config.xwiki_page_template if self.app is not None else None
+        if template:
+            files.append(os.path.abspath(os.path.join(self.confdir, template)))
+        return files
+
+    def get_referrers(self, changed):
+        """
+        Returns the docnames of the pages that link to the pages whose sources are in *changed*.
+        """
+        builder = self.app.builder
+        referrers = set()
+        for path in changed:
+            docname = self.app.env.path2doc(path)
+            if docname is not None:
+                referrers.update(builder.link_index.get_referrers(docname))
+        return referrers
+
+    def build(self, changed=()):
+        """
+        Builds the doc set, rebuilding the pages whose sources are in *changed* along with the
+        pages that link to them. The application is created again if conf.py has changed (or
+        the last build failed). Returns the builder's counts for the build.
+        """
+        conf_path = os.path.join(self.confdir, 'conf.py')
+        if (self.app is None) or (conf_path in changed):
+            self.create_app()
+        else:
+            self.app.builder.reset()
+            # links to a changed page may now have different text (its title, for example).
+            self.app.builder.requested_docnames = self.get_referrers(changed)
+        try:
+            self.app.build()
+        except BaseException:
+            # start from scratch next time.
+            self.app = None
+            raise
+        builder = self.app.builder
+        return {'written': builder.pages_written, 'unchanged': builder.pages_unchanged,
+                'removed': builder.pages_removed}
+
+    def watch(self, poll=False, log=print):
+        """
+        Rebuilds the doc set each time its sources change, until interrupted, logging how long
+        each change took to reach the output.
+        """
+        excluded = [self.outdir, self.doctreedir]
+        watcher = None
+        try:
+            while True:
+                if watcher is None:
+                    watcher = create_watcher([self.srcdir], self.get_watched_files(), excluded,
+                                             poll=poll)
+                    log("watching %s for changes (%s)" % (self.srcdir,
+                        "polling" if isinstance(watcher, PollingWatcher) else "inotify"))
+                changed, first_seen = wait_for_changes(watcher)
+                # leave out files that came and went (an editor's temporary files, say).
+                changed = set(path for path in changed if os.path.exists(path)
+                              or (self.app is not None and self.app.env.path2doc(path)))
+                if not changed:
+                    continue
+                start = time.monotonic()
+                try:
+                    counts = self.build(changed)
+                except (Exception, SystemExit):
+                    log("build failed:\n%s" % traceback.format_exc())
+                    continue
+                end = time.monotonic()
+                names = sorted(os.path.relpath(path, self.srcdir) for path in changed)
+                log("%d changed (%s): %d pages written, %d unchanged, %d removed in %.0f ms "
+                    "(%.0f ms from change to output)" % (len(changed), ", ".join(names[:5])
+                    + (", ..." if len(names) > 5 else ""), counts['written'],
+                    counts['unchanged'], counts['removed'], (end - start) * 1e3,
+                    (end - first_seen) * 1e3))
+                # conf.py may have changed the template (or the watcher may have missed files).
+                if os.path.join(self.confdir, 'conf.py') in changed:
+                    watcher.close()
+                    watcher = None
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+
+def main(argv=None):
+    """
+    Builds a doc set with the xwiki builder, then rebuilds it whenever its sources change.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Build XWiki output, and rebuild it on changes.")
+    parser.add_argument('sourcedir')
+    parser.add_argument('outdir')
+    parser.add_argument('-c', dest='confdir', help="the directory containing conf.py")
+    parser.add_argument('-d', dest='doctreedir', help="the directory for the doctrees")
+    parser.add_argument('-D', dest='define', action='append', default=[],
+                        metavar='setting=value', help="override a setting in conf.py")
+    parser.add_argument('-q', dest='quiet', action='store_true',
+                        help="only show warnings, errors and the changes built")
+    parser.add_argument('--poll', action='store_true',
+                        help="poll for changes, rather than using inotify")
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help="serve the output over HTTP on this port")
+    parser.add_argument('--host', default='127.0.0.1', help="the address to serve the output on")
+    args = parser.parse_args(argv)
+
+    confoverrides = {}
+    for define in args.define:
+        name, _, value = define.partition('=')
+        confoverrides[name] = value
+
+    watcher = Watcher(args.sourcedir, args.outdir, args.confdir, args.doctreedir, confoverrides,
+                      status=None if args.quiet else sys.stdout)
+    start = time.monotonic()
+    try:
+        watcher.build()
+    except (Exception, SystemExit):
+        print("build failed:\n%s" % traceback.format_exc())
+    else:
+        print("built in %.0f ms" % ((time.monotonic() - start) * 1e3))
+    if args.serve is not None:
+        server = serve_output(watcher.outdir, args.host, args.serve)
+        print("serving %s at http://%s:%d/" % (watcher.outdir, args.host,
+                                               server.server_address[1]))
+    try:
+        watcher.watch(poll=args.poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
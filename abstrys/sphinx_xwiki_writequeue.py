@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki Write Queue
+#
+# A write-behind queue: pages are handed to a background thread that writes
+# them to disk, so the next page can be translated while the last one is being
+# written. The queue is bounded, so translation can't get more than a few
+# pages ahead of the disk.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import queue
+import threading
+from abstrys.sphinx_xwiki_manifest import write_bytes_atomic
+from abstrys.sphinx_xwiki_trace import NULL_TRACE
+
+# the number of pages that can be waiting to be written before put() blocks.
+WRITE_QUEUE_SIZE = 32
+
+
+class WriteQueue(object):
+    """
+    Writes files in a background thread.
+
+    The first error raised while writing is raised by every later call to put() or flush(), so it
+    fails the build; nothing more is written after it.
+    """
+
+    def __init__(self, maxsize=WRITE_QUEUE_SIZE, trace=NULL_TRACE):
+        """
+        maxsize:
+           The number of files that can be waiting to be written before put() blocks.
+        trace:
+           A TraceBuffer to record a span for each write in.
+        """
+        self.queue = queue.Queue(maxsize)
+        self.trace = trace
+        # the first error raised while writing; once it's set, the queue has failed for good.
+        self.error = None
+        self.thread = None
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, data, docname = item
+            if self.error is not None:
+                # drain the queue without writing anything more.
+                continue
+            start = self.trace.clock()
+            try:
+                write_bytes_atomic(path, data)
+            except BaseException as e:
+                self.error = e
+            self.trace.add('write', start, docname=docname)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, path, data, docname=None):
+        """
+        Queues *data* (bytes) to be written to *path*, waiting if the queue is full.
+        """
+        self._raise_error()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='xwiki-write-queue',
+                                           daemon=True)
+            self.thread.start()
+        self.queue.put((path, data, docname))
+
+    def flush(self):
+        """
+        Waits for every queued file to be written, then stops the background thread (it's started
+        again by the next put()).
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
@@ -17,25 +17,23 @@
 #
 #===============================================================================
 
-import sys, os
+import os
 import re
 from docutils import nodes, writers
 
-def print_error(text, node=None):
-    """
-    Prints an error string and optionally, the node being worked on.
-    """
-    sys.stderr.write("\n%s: %s\n" % (__name__, text))
-    if node:
-        sys.stderr.write("  node: %s\n" % str(node))
+# bump this whenever a change to the translator changes its output, so that translations cached by
+# an earlier version aren't used.
+WRITER_VERSION = 1
 
-def test_popped_node(expected, popped, list_type="group"):
+def get_page_reference(page_name, root_page=''):
     """
-    Tests two nodes and complains if they're not the same.
+    Returns the fully qualified XWiki reference for a page in this doc set: a sub-page of the root
+    page, or the root page itself for the "Index" page.
     """
-    if (expected != popped):
-        print_error("A different %s node was popped than expected!\nexpected: %s\npopped: %s" %
-           (list_type, expected, popped))
+    if (root_page != '') and (page_name == 'Index'): # special case for the index page.
+        return root_page # the root page *is* the "index".
+    # make it a sub-page of the root.
+    return '.'.join([root_page, page_name])
 
 
 def node_is_inline(node):
@@ -54,19 +52,58 @@ class XWikiWriter(writers.Writer):
     supported = ('markdown',)
     output = None
 
-    def __init__(self, sphinx_config=None):
+    def __init__(self, sphinx_config=None, page_references=None, link_table=None,
+                 image_names=None, diagnostics=None):
         """
         Initialize the writer. Takes the root element of the resulting XWiki output as its sole
         argument.
+
+        page_references:
+           An optional dict mapping page names (as used in internal refuris) to fully qualified
+           XWiki references.
+        link_table:
+           An optional dict mapping internal refuris to finished XWiki link targets.
+        image_names:
+           An optional dict mapping local image URIs to attachment names.
+        diagnostics:
+           An optional Diagnostics collection that problems found while translating are added to.
         """
         writers.Writer.__init__(self)
         self.translator_class = XWikiTranslator
         self.sphinx_config = sphinx_config
+        self.page_references = page_references
+        self.link_table = link_table
+        self.image_names = image_names
+        self.diagnostics = diagnostics
 
     def translate(self):
-        visitor = self.translator_class(self.document, self.sphinx_config)
-        self.document.walkabout(visitor)
-        self.output = visitor.astext()
+        self.output = self.translate_doctree(self.document)
+
+    def translate_doctree(self, doctree, stream=None):
+        """
+        Translates a doctree straight to XWiki text (a str), without going through a docutils
+        publisher. The doctree's own settings and reporter are used as they are. The translator is
+        kept as ``self.visitor`` until the next doctree is translated.
+
+        stream:
+           If set, the text is written to this (text) stream as it's produced, and None is
+           returned. Only the text of the group being translated is held in memory.
+        """
+        self.visitor = visitor = self.translator_class(doctree, self.sphinx_config,
+            self.page_references, self.link_table, self.image_names, self.diagnostics, stream)
+        doctree.walkabout(visitor)
+        if stream is None:
+            return visitor.astext()
+        return None
+
+
+class StreamOutput(object):
+    """
+    Lets the translator add its output to a stream in the same way that it adds it to a list.
+    """
+
+    def __init__(self, stream):
+        self.append = stream.write
 
 
 class XWikiTranslator(nodes.NodeVisitor):
@@ -74,31 +111,169 @@ class XWikiTranslator(nodes.NodeVisitor):
     A docutils translator for XWiki.
     """
 
-    def __init__(self, document, sphinx_config=None):
+    # node types that are translated exactly like another node type.
+    node_aliases = {
+        'caption': 'paragraph',
+        'hlistcol': 'entry',
+        'title_reference': 'emphasis',
+    }
+
+    # handlers for node types added by extensions, keyed by node class name (see
+    # with_node_handlers()).
+    node_handlers = {}
+
+    # inline classes that are translated like a standard inline, in order of precedence, with the
+    # markup used for each.
+    inline_class_markup = (
+        ('guilabel', "**"),      # treat it like a **strong** element.
+        ('menuselection', "**"), # treat it like a **strong** element.
+        ('std-ref', "//"),       # treat it like an //italic// element.
+        ('doc', "//"),           # treat it like an //italic// element.
+    )
+
+    def __init__(self, document, sphinx_config=None, page_references=None, link_table=None,
+                 image_names=None, diagnostics=None, stream=None):
         """
         Initialize the translator.
+
+        page_references:
+           An optional dict mapping page names (as used in internal refuris) to fully qualified
+           XWiki references. Pages that aren't in it are referenced as sub-pages of the root page.
+        link_table:
+           An optional dict mapping internal refuris ("PageName" or "PageName#anchor") to finished
+           XWiki link targets. If it's given, links to anchors that aren't in it are reported.
+        image_names:
+           An optional dict mapping local image URIs to attachment names. Images that aren't in it
+           are referred to by their filename.
+        diagnostics:
+           An optional Diagnostics collection that problems found while translating are added to.
+           If it isn't given, they're reported as warnings through the document's reporter.
+        stream:
+           An optional (text) stream that finished top-level blocks are written to, rather than
+           being kept for astext().
         """
         nodes.NodeVisitor.__init__(self, document)
-        self.body_content = ""
-        self.para_text = ""
+        # output is accumulated as lists of text chunks, which are only joined when they're needed
+        # (appending to a string over and over is quadratic for large documents).
+        self.body_content = [] if stream is None else StreamOutput(stream)
+        self.para_text = []
         self.para_level = 0
         self.group_stack = [] # a list of group nodes
         self.list_glyph_stack = [] # a stack of list glyphs.
         self.section_level = 0
         self.sphinx_config = sphinx_config
+        self.xwiki_root_page = getattr(sphinx_config, 'xwiki_root_page', '')
+        self.page_references = page_references or {}
+        self.link_table = link_table or {}
+        self.image_names = image_names or {}
+        self.diagnostics = diagnostics
+        # internal refuri -> True if it was found in the link table, for each link on the page.
+        self.links = {}
         self.force_inline = False
+        self._dispatch_table = type(self)._get_dispatch_table()
+
+
+    #
+    # node dispatch
+    #
+    @classmethod
+    def with_node_handlers(cls, node_handlers):
+        """
+        Returns a subclass of this translator that translates nodes with *node_handlers*, so that
+        extensions can add support for their own nodes. The subclass has its own dispatch table,
+        so the handlers are never seen by other translators (those of another Sphinx application
+        in the same process, say).
+
+        node_handlers:
+           A dict mapping node class names to (visit, depart) tuples of functions, which are
+           called as ``visit(translator, node)`` and ``depart(translator, node)``. If *depart* is
+           None, departing the node does nothing.
+        """
+        if not node_handlers:
+            return cls
+        handlers = dict(cls.node_handlers)
+        handlers.update(node_handlers)
+        return type(cls.__name__, (cls,), {'node_handlers': handlers})
+
+
+    @classmethod
+    def _get_dispatch_table(cls):
+        """
+        Returns the dispatch table for this class: a dict mapping node classes to a (visit, depart)
+        tuple of functions. Entries are added the first time a node class is seen.
+        """
+        if '_dispatch_table' not in cls.__dict__:
+            cls._dispatch_table = {}
+        return cls._dispatch_table
+
+
+    def _add_dispatch_entry(self, node_class):
+        """
+        Finds the handlers for a node class and adds them to the dispatch table. Handlers in
+        node_handlers win over visit_/depart_ methods, which win over aliases.
+        """
+        cls = type(self)
+        node_name = node_class.__name__
+        if node_name in cls.node_handlers:
+            visit, depart = cls.node_handlers[node_name]
+            entry = (visit, depart or (lambda translator, node: None))
+        else:
+            handler_name = node_name
+            if (not hasattr(cls, 'visit_' + node_name)) and (node_name in cls.node_aliases):
+                handler_name = cls.node_aliases[node_name]
+            entry = (getattr(cls, 'visit_' + handler_name, cls.unknown_visit),
+                     getattr(cls, 'depart_' + handler_name, cls.unknown_departure))
+        self._dispatch_table[node_class] = entry
+        return entry
+
+
+    def dispatch_visit(self, node):
+        try:
+            visit = self._dispatch_table[node.__class__][0]
+        except KeyError:
+            visit = self._add_dispatch_entry(node.__class__)[0]
+        return visit(self, node)
+
+
+    def dispatch_departure(self, node):
+        try:
+            depart = self._dispatch_table[node.__class__][1]
+        except KeyError:
+            depart = self._add_dispatch_entry(node.__class__)[1]
+        return depart(self, node)
+
+
+    def _report(self, message, node=None):
+        """
+        Reports a problem found while translating *node*: it's added to the diagnostics, or if
+        there aren't any, reported as a warning through the document's reporter.
+        """
+        if self.diagnostics is None:
+            self.document.reporter.warning(message, base_node=node)
+        else:
+            self.diagnostics.add(message, node)
 
 
-    def _add_text(self, text):
+    def _check_popped_group(self, expected, popped):
         """
-        Called to add text to the document.
+        Reports a problem if the group that was popped isn't the one for the *expected* node.
+        """
+        if (expected != popped):
+            self._report("a different group was popped than expected (%s, expected %s)" %
+                         (popped.tagname, expected.tagname), expected)
+
+
+    def add_text(self, text):
+        """
+        Adds text to the document. This is how the handlers of extension node types add their
+        output.
         """
         if self.para_level > 0:
-            self.para_text += text
+            self.para_text.append(text)
         elif len(self.group_stack) > 0:
             self._add_text_block_to_group(text)
         else:
-            self.body_content += text
+            self.body_content.append(text)
 
 
     #
@@ -123,27 +298,61 @@ class XWikiTranslator(nodes.NodeVisitor):
     def _pop_group(self, postfix=""):
         """
         pops the current group off the group stack, and ends the group.
+
+        A group nested in another group isn't rendered here; it's added to its parent's blocks as
+        is, and the whole tree of groups is rendered once, when the outermost group is popped.
         """
         popped_group = self.group_stack.pop()
-        group_text = popped_group['prefix'] + "((( "
-        for block in popped_group['blocks']:
-            group_text += block
+        popped_group['postfix'] = postfix
+        if self.para_level > 0:
+            self._render_group(popped_group, self.para_text)
+        elif len(self.group_stack) > 0:
+            self.group_stack[-1]['blocks'].append(popped_group)
+        else:
+            self._render_group(popped_group, self.body_content)
+        return popped_group['node']
+
+
+    def _render_group(self, group, output, nested=False):
+        """
+        Renders a group (and any groups nested within it) by appending text chunks to the *output*
+        list. Returns the last few characters of the rendered text.
+
+        A nested group is rendered the way it would be if its text was added to its parent as a
+        text block: without any leading or trailing whitespace.
+        """
+        prefix = group['prefix'].lstrip() if nested else group['prefix']
+        output.append(prefix)
+        output.append("((( ")
+        blocks = group['blocks']
+        last_block = blocks[-1] if len(blocks) > 0 else None
+        # the last few characters of the group text so far; this is all that's needed to decide
+        # which separator follows each block.
+        tail = (prefix + "((( ")[-3:]
+        for block in blocks:
+            if isinstance(block, dict):
+                tail = self._render_group(block, output, nested=True)
+            else:
+                output.append(block)
+                tail = (tail + block)[-3:]
             # only add newlines to the blocks *before* the last one.
-            if group_text.endswith(")))") or group_text.endswith('%)'):
-                group_text += "\n"
-            elif block != popped_group['blocks'][-1]:
-                group_text += "\n\n"
+            if tail.endswith(")))") or tail.endswith('%)'):
+                output.append("\n")
+                tail = tail[-2:] + "\n"
+            elif (block is not last_block) and (isinstance(block, dict) or (block != last_block)):
+                output.append("\n\n")
+                tail = tail[-1:] + "\n\n"
         # end the group.
-        group_text += (" )))" + postfix)
-        self._add_text(group_text)
-        return popped_group['node']
+        postfix = group['postfix'].rstrip() if nested else group['postfix']
+        output.append(" )))" + postfix)
+        return (" )))" + postfix)[-3:]
 
 
     # different types of admonitions are set up similarly.
     def _start_admonition(self, node, title, color):
-        self._add_text('(% class="admonition {0}" style="border-style:solid;border-color:{1};border-width:2px 2px 2px 8px;margin:16px;padding:16px 16px 8px 16px" %)'.format(title.lower(), color))
+        self.add_text('(% class="admonition {0}" style="border-style:solid;border-color:{1};border-width:2px 2px 2px 8px;margin:16px;padding:16px 16px 8px 16px" %)'.format(title.lower(), color))
         self._push_group(node)
-        self._add_text('**%s**\n' % title)
+        self.add_text('**%s**\n' % title)
 
     def _end_admonition(self, node):
         # don't test the popped node here (in some cases, we need to start the
@@ -158,20 +367,20 @@ class XWikiTranslator(nodes.NodeVisitor):
         """
         Return the entire document as text.
         """
-        return self.body_content
+        return "".join(self.body_content)
 
 
     # handle unknown nodes...
     def unknown_visit(self, node):
-        print_error("WARNING:: Visiting unknown node!", node)
+        self._report("visiting unknown node", node)
 
     def unknown_departure(self, node):
-        print_error("WARNING:: Departing unknown node!", node)
+        self._report("departing unknown node", node)
 
 
     # handle "problematic" nodes...
     def visit_problematic(self, node):
-        print_error("found problematic node!", node)
+        self._report("found problematic node", node)
 
     def depart_problematic(self, node):
         pass
@@ -194,7 +403,7 @@ class XWikiTranslator(nodes.NodeVisitor):
         if (node.parent != None) and (node.parent.tagname == "paragraph") and ('\n' in text):
             # strip any newlines from within a paragraph...
             text = ' '.join(text.split('\n'))
-        self._add_text(text)
+        self.add_text(text)
 
     def depart_Text(self, node):
         pass
@@ -206,18 +415,17 @@ class XWikiTranslator(nodes.NodeVisitor):
         # .. content in that format ..
         # {{/format}}
         if 'format' in node:
-            self._add_text("\n{{%s}}\n" % node['format'])
+            self.add_text("\n{{%s}}\n" % node['format'])
 
     def depart_raw(self, node):
         if 'format' in node:
-            self._add_text("\n{{/%s}}\n\n" % node['format'])
+            self.add_text("\n{{/%s}}\n\n" % node['format'])
 
 
     def visit_paragraph(self, node):
         self.para_level += 1
         if (self.para_level > 1):
-            print_error("nested paragraph!", node)
-            sys.stderr.write("  parent: %s\n" % str(node.parent))
+            self._report("nested paragraph (in %s)" % node.parent.tagname, node)
 
 
     def depart_paragraph(self, node):
@@ -227,14 +435,15 @@ class XWikiTranslator(nodes.NodeVisitor):
         # add two newlines when:
         # * any para except the last in a group.
         # * the end of paras not in a group.
+        para_text = "".join(self.para_text)
         if len(self.group_stack) > 0:
             # if in a group, just add it to the blocks within the group.
-            self._add_text_block_to_group(self.para_text)
+            self._add_text_block_to_group(para_text)
         else:
             # otherwise, just add it to the document.
-            self._add_text(self.para_text + "\n\n")
+            self.add_text(para_text + "\n\n")
         # do this in all cases.
-        self.para_text = ""
+        self.para_text = []
 
 
     def visit_section(self, node):
@@ -246,7 +455,7 @@ class XWikiTranslator(nodes.NodeVisitor):
         for section_id in node['ids']:
             # adding a blank line between these definitions (but none before the
             # following title) allows multiple IDs to refer to the same section.
-            self._add_text('\n(% id="{}" %)\n'.format(section_id))
+            self.add_text('\n(% id="{}" %)\n'.format(section_id))
 
     def depart_section(self, node):
         self.section_level -= 1
@@ -257,7 +466,7 @@ class XWikiTranslator(nodes.NodeVisitor):
         self._push_group(node)
 
     def depart_compound(self, node):
-        test_popped_node(node, self._pop_group())
+        self._check_popped_group(node, self._pop_group())
 
 
     def visit_line_block(self, node):
@@ -265,7 +474,7 @@ class XWikiTranslator(nodes.NodeVisitor):
         self._push_group(node)
 
     def depart_line_block(self, node):
-        test_popped_node(node, self._pop_group())
+        self._check_popped_group(node, self._pop_group())
 
 
     def visit_line(self, node):
@@ -273,22 +482,13 @@ class XWikiTranslator(nodes.NodeVisitor):
         pass
 
     def depart_line(self, node):
-        self._add_text('\n')
-
-
-    def visit_caption(self, node):
-        self.visit_paragraph(node)
-
-    def depart_caption(self, node):
-        self.depart_paragraph(node)
+        self.add_text('\n')
 
 
     def visit_rubric(self, node):
-        print_error("visit_rubric", node)
         self.visit_paragraph(node)
 
     def depart_rubric(self, node):
-        print_error("depart_rubric", node)
         self.depart_paragraph(node)
 
 
@@ -299,9 +499,9 @@ class XWikiTranslator(nodes.NodeVisitor):
             elif node['name'] == 'description':
                 raise nodes.SkipNode
             else:
-                print_error("Unknown meta", node)
+                self._report("unknown meta", node)
         else:
-            print_error("Unknown meta", node)
+            self._report("unknown meta", node)
 
     def depart_meta(self, node):
         pass
@@ -317,7 +517,7 @@ class XWikiTranslator(nodes.NodeVisitor):
 
     def depart_bullet_list(self, node):
         self.list_glyph_stack.pop()
-        self._add_text("\n")
+        self.add_text("\n")
 
 
     def visit_enumerated_list(self, node):
@@ -326,14 +526,14 @@ class XWikiTranslator(nodes.NodeVisitor):
 
     def depart_enumerated_list(self, node):
         self.list_glyph_stack.pop()
-        self._add_text("\n")
+        self.add_text("\n")
 
 
     def visit_list_item(self, node):
         self._push_group(node, prefix=(self.list_glyph_stack[-1]))
 
     def depart_list_item(self, node):
-        test_popped_node(node, self._pop_group("\n"))
+        self._check_popped_group(node, self._pop_group("\n"))
 
 
     #
@@ -348,13 +548,7 @@ class XWikiTranslator(nodes.NodeVisitor):
     def depart_hlist(self, node):
         self.depart_row(node)
 
-    def visit_hlistcol(self, node):
-        # each column is an "entry"
-        self.visit_entry(node)
-
-    def depart_hlistcol(self, node):
-        self.depart_entry(node)
-
+    # each column is an "entry" (see node_aliases).
 
     #
     # definition lists and associated nodes
@@ -382,57 +576,57 @@ class XWikiTranslator(nodes.NodeVisitor):
         """
         This is handled by the depart_term, then depart_definition elements.
         """
-        self._add_text("\n\n")
+        self.add_text("\n\n")
 
 
     def visit_term(self, node):
-        self._add_text("; ")
+        self.add_text("; ")
 
     def depart_term(self, node):
-        self._add_text("\n")
+        self.add_text("\n")
 
 
     def visit_definition(self, node):
         self._push_group(node, prefix=": ")
 
     def depart_definition(self, node):
-        test_popped_node(node, self._pop_group())
+        self._check_popped_group(node, self._pop_group())
 
 
     # emphasis
     def visit_emphasis(self, node):
-        self._add_text("//")
+        self.add_text("//")
 
     def depart_emphasis(self, node):
-        self._add_text("//")
+        self.add_text("//")
 
     # strong
     def visit_strong(self, node):
-        self._add_text("**")
+        self.add_text("**")
 
     def depart_strong(self, node):
-        self._add_text("**")
+        self.add_text("**")
 
 
     # subscript
     def visit_subscript(self, node):
-        self._add_text(",,")
+        self.add_text(",,")
 
     def depart_subscript(self, node):
-        self._add_text(",,")
+        self.add_text(",,")
 
 
     # superscript
     def visit_superscript(self, node):
-        self._add_text("^^")
+        self.add_text("^^")
 
     def depart_superscript(self, node):
-        self._add_text("^^")
+        self.add_text("^^")
 
 
     # transition
     def visit_transition(self, node):
-        self._add_text("----\n\n")
+        self.add_text("----\n\n")
         raise nodes.SkipNode
 
     def depart_transition(self, node):
@@ -445,15 +639,16 @@ class XWikiTranslator(nodes.NodeVisitor):
 
     def _add_image(self, uri, alt_text="", caption=None, inline=False):
         # strip local paths out of the URI if they exist.
-        if not re.match('^htt[p|ps]:\/\/', uri):
-            # must be local, then. Grab only the second part of os.path.split (the filename itself).
-            uri = os.path.split(uri)[1]
+        if not re.match(r'^(https?://|data:)', uri):
+            # must be local, then. Use the name it's attached with, or grab only the second part of
+            # os.path.split (the filename itself).
+            uri = self.image_names.get(uri) or os.path.split(uri)[1]
         # set the postfix depending on whether it's inline or not.
         if caption:
             text = '[[image:%s||alt="%s" title="%s")]]' % (uri, alt_text, caption)
         else:
             text = '[[image:%s||alt="%s"]]' % (uri, alt_text)
-        self._add_text(text + ("" if inline else "\n\n"))
+        self.add_text(text + ("" if inline else "\n\n"))
 
 
     def _get_image_attrs(self, node):
@@ -553,23 +748,23 @@ class XWikiTranslator(nodes.NodeVisitor):
         classes = ' '.join(node['classes']).strip()
         if 'contents local' in classes:
             # float local contents to the right.
-            self._add_text('(% class="{0}" style="border-style:solid;background-color:white;border-color:gray;border-width:2px;margin:16px;padding:16px 16px 8px 16px;float:right;clear:right;" %)\n'.format(classes))
+            self.add_text('(% class="{0}" style="border-style:solid;background-color:white;border-color:gray;border-width:2px;margin:16px;padding:16px 16px 8px 16px;float:right;clear:right;" %)\n'.format(classes))
         elif classes == '':
-            self._add_text('(% class="topic {0}" style="border-style:solid;border-color:gray;border-width:2px;margin:16px;padding:16px 16px 8px 16px" %)\n'.format(classes))
+            self.add_text('(% class="topic {0}" style="border-style:solid;border-color:gray;border-width:2px;margin:16px;padding:16px 16px 8px 16px" %)\n'.format(classes))
         else:
-            self._add_text('(% class="{0}" style="border-style:solid;border-color:gray;border-width:2px;margin:16px;padding:16px 16px 8px 16px" %)\n'.format(classes))
+            self.add_text('(% class="{0}" style="border-style:solid;border-color:gray;border-width:2px;margin:16px;padding:16px 16px 8px 16px" %)\n'.format(classes))
         self._push_group(node)
 
 
     def depart_topic(self, node):
-        test_popped_node(node, self._pop_group(postfix="\n\n"))
+        self._check_popped_group(node, self._pop_group(postfix="\n\n"))
 
 
     # literal inlines
     def visit_literal(self, node):
         # a literal, by definition, cannot have any markup within it, so convert it to regular text
         # and add '##' around it.
-        self._add_text("##%s##" % node.astext())
+        self.add_text("##%s##" % node.astext())
         raise nodes.SkipNode
 
     def depart_literal(self, node):
@@ -579,7 +774,7 @@ class XWikiTranslator(nodes.NodeVisitor):
 
     def visit_literal_strong(self, node):
         # not a normal reST element; this is added by Sphinx.
-        self._add_text("**##%s##**" % node.astext())
+        self.add_text("**##%s##**" % node.astext())
         raise nodes.SkipNode
 
     def depart_literal_strong(self, node):
@@ -587,99 +782,91 @@ class XWikiTranslator(nodes.NodeVisitor):
         pass
 
 
+    def _get_inline_markup(self, node):
+        """
+        Returns the markup to use for an inline, depending on its class, or None if it doesn't map
+        to a standard inline.
+        """
+        classes = node['classes']
+        for (class_name, markup) in self.inline_class_markup:
+            if class_name in classes:
+                return markup
+        return None
+
     def visit_inline(self, node):
         # general role handling (if it doesn't map to a standard inline).
         # this depends on the type of "class" the inline is.
-        if 'guilabel' in node['classes']:
-            self.visit_strong(node) # treat it like a **strong** element.
-        elif 'menuselection' in node['classes']:
-            self.visit_strong(node) # treat it like a **strong** element.
-        elif 'std-ref' in node['classes']:
-            self.visit_emphasis(node) # treat it like an **italic** element.
-        elif 'doc' in node['classes']:
-            self.visit_emphasis(node) # treat it like an **italic** element.
-        else:
-            # don't do anything special
-            pass
+        markup = self._get_inline_markup(node)
+        if markup:
+            self.add_text(markup)
 
     def depart_inline(self, node):
-        if 'guilabel' in node['classes']:
-            self.depart_strong(node) # treat it like a **strong** element.
-        elif 'menuselection' in node['classes']:
-            self.depart_strong(node) # treat it like a **strong** element.
-        elif 'std-ref' in node['classes']:
-            self.depart_emphasis(node) # treat it like an **italic** element.
-        elif 'doc' in node['classes']:
-            self.depart_emphasis(node) # treat it like an **italic** element.
-        else:
-            # don't do anything special
-            pass
+        markup = self._get_inline_markup(node)
+        if markup:
+            self.add_text(markup)
 
 
     def visit_literal_block(self, node):
-        #print_error("literal_block" % node.parent, node)
-        #if hasattr(node, 'get_children'):
-        #    print_error("literal block has children! %s" % node.get_children())
         code_class = ""
         if ('classes' in node) and ('code' in node['classes']):
             code_class = node['classes'][1]
         elif ('language' in node):
             code_class = node['language']
-        self._add_text('(% style="background:gainsboro;margin:16px;padding:16px" %)\n')
-        self._add_text("{{{\n")
+        self.add_text('(% style="background:gainsboro;margin:16px;padding:16px" %)\n')
+        self.add_text("{{{\n")
 
     def depart_literal_block(self, node):
-        self._add_text("\n}}}\n\n")
+        self.add_text("\n}}}\n\n")
 
 
     # option_list
     def visit_option(self, node):
-        self._add_text("<option>")
+        self.add_text("<option>")
 
     def depart_option(self, node):
-        self._add_text("</option>")
+        self.add_text("</option>")
 
 
     def visit_option_argument(self, node):
-        self._add_text("<optionarg>")
+        self.add_text("<optionarg>")
 
     def depart_option_argument(self, node):
-        self._add_text("</optionarg>")
+        self.add_text("</optionarg>")
 
 
     def visit_option_group(self, node):
-        self._add_text("<optiongroup>")
+        self.add_text("<optiongroup>")
 
     def depart_option_group(self, node):
-        self._add_text("</optiongroup>")
+        self.add_text("</optiongroup>")
 
 
     def visit_option_list(self, node):
-        self._add_text("<optionlist>")
+        self.add_text("<optionlist>")
 
     def depart_option_list(self, node):
-        self._add_text("</optionlist>")
+        self.add_text("</optionlist>")
 
 
     def visit_option_list_item(self, node):
-        self._add_text("<optionlistitem>")
+        self.add_text("<optionlistitem>")
 
     def depart_option_list_item(self, node):
-        self._add_text("</optionlistitem>")
+        self.add_text("</optionlistitem>")
 
 
     def visit_option_string(self, node):
-        self._add_text("<optionstring>")
+        self.add_text("<optionstring>")
 
     def depart_option_string(self, node):
-        self._add_text("</optionstring>")
+        self.add_text("</optionstring>")
 
     #
     # links and references
     #
     def visit_reference(self, node):
         self.force_inline = True
-        self._add_text("[[")
+        self.add_text("[[")
 
     def depart_reference(self, node):
         if 'refuri' in node:
@@ -688,45 +875,56 @@ class XWikiTranslator(nodes.NodeVisitor):
             if ('internal' in node) and (node['internal'] == True):
                 # links to another page in this doc set. Make sure to add the
                 # xwiki_root_page to the reference, if set.
-                xwiki_root_page = ''
-                if hasattr(self.sphinx_config, 'xwiki_root_page'):
-                    xwiki_root_page = self.sphinx_config.xwiki_root_page
-                if '#' in refuri:
+                link_contents = self.link_table.get(refuri)
+                self.links[refuri] = link_contents is not None
+                if link_contents is not None:
+                    # the usual case: the link target was worked out before translation.
+                    pass
+                elif '#' in refuri:
                     # here, we need to split any anchor reference from the link
                     # so it can be formatted xwiki-style.
                     page_name, refid = refuri.split('#')
-                    if (xwiki_root_page != '') and (page_name == 'Index'): # special case for the index page.
-                        page_name = xwiki_root_page # the root page *is* the "index".
-                    else:
-                        # make it a sub-page of the root.
-                        page_name = '.'.join([xwiki_root_page, page_name])
-                    link_contents = '{0}||anchor="{1}"'.format(page_name,  refid)
+                    link_contents = '{0}||anchor="{1}"'.format(
+                        self._get_page_reference(page_name), refid)
+                    if self.link_table and (page_name in self.link_table):
+                        self._report("link to a missing anchor: %s" % refuri, node)
                 else:
-                    if (xwiki_root_page != '') and (refuri == 'Index'): # special case for the index page.
-                        link_contents = xwiki_root_page # the root page *is* the "index".
-                    else:
-                        # make it a sub-page of the root.
-                        link_contents = '.'.join([xwiki_root_page, refuri])
+                    link_contents = self._get_page_reference(refuri)
             else:
                 # an external link. Just use the refuri as-is.
                 link_contents = refuri
 
-            # write the link
-            if link_contents == node.astext():
+            # write the link. Most links contain a single text node, which can be compared to the
+            # link target without walking the reference's subtree.
+            if (len(node.children) == 1) and isinstance(node[0], nodes.Text):
+                link_text = node[0].astext()
+            else:
+                link_text = node.astext()
+            if link_contents == link_text:
                 # special case where the link text and URI are the same.
-                self._add_text(']]')
+                self.add_text(']]')
             else:
                 # add the destination for the link.
-                self._add_text('>>{0}]]'.format(link_contents))
+                self.add_text('>>{0}]]'.format(link_contents))
         elif 'refid' in node:
             # this is a link on the current page.
-            self._add_text('>>||anchor="{0}"]]'.format(node['refid']))
+            self.add_text('>>||anchor="{0}"]]'.format(node['refid']))
         else:
-            print_error("depart reference: what is this?", node)
+            self._report("unknown kind of reference", node)
         self.force_inline = False
         self.ref_title = None
 
 
+    def _get_page_reference(self, page_name):
+        """
+        Returns the fully qualified XWiki reference for a page name.
+        """
+        try:
+            return self.page_references[page_name]
+        except KeyError:
+            return get_page_reference(page_name, self.xwiki_root_page)
+
+
     def visit_target(self, node):
         # These are the equivalent of <a id="target-id"/> elements in HTML.
         # However, the "refid" that is provided here is also added to the list
@@ -741,12 +939,10 @@ class XWikiTranslator(nodes.NodeVisitor):
     # table
     def visit_table(self, node):
         # nothing to do here presently.
-        #print_error('visit_table', node)
-        #sys.stderr.write('  parent: %s\n' % node.parent)
         pass
 
     def depart_table(self, node):
-        self._add_text("\n\n")
+        self.add_text("\n\n")
 
 
     def visit_tgroup(self, node):
@@ -792,31 +988,31 @@ class XWikiTranslator(nodes.NodeVisitor):
             self._push_group(node, prefix="| ")
 
     def depart_entry(self, node):
-        test_popped_node(node, self._pop_group(postfix=" "))
+        self._check_popped_group(node, self._pop_group(postfix=" "))
 
 
     def visit_row(self, node):
         pass
 
     def depart_row(self, node):
-        self._add_text("\n")
+        self.add_text("\n")
 
 
     # title
     def visit_title(self, node):
         # some titles aren't section headings...
         if (node.parent.tagname in ['topic']):
-            self._add_text("**%s**" % node.astext())
+            self.add_text("**%s**" % node.astext())
             raise nodes.SkipNode
         if (node.parent.tagname in ['admonition']):
             self._start_admonition(node, node.astext(), 'blue')
             raise nodes.SkipNode
         else: # but others are...
-            self._add_text(("=" * self.section_level) + " ")
+            self.add_text(("=" * self.section_level) + " ")
 
     def depart_title(self, node):
-        self._add_text(" " + ("=" * self.section_level))
-        self._add_text("\n\n")
+        self.add_text(" " + ("=" * self.section_level))
+        self.add_text("\n\n")
 
 
     def visit_substitution_definition(self, node):
@@ -845,7 +1041,7 @@ class XWikiTranslator(nodes.NodeVisitor):
 
     def depart_compact_paragraph(self, node):
         if node.parent.tagname in ['compound']:
-            test_popped_node(node, self._pop_group())
+            self._check_popped_group(node, self._pop_group())
         else:
             self.depart_paragraph(node)
 
@@ -853,17 +1049,9 @@ class XWikiTranslator(nodes.NodeVisitor):
     def visit_block_quote(self, node):
         # block quotes are styled block elements that may contain paras, tables, etc.
         # We consider it to be a styled group.
-        self._add_text('(% style="border-left:solid gainsboro 8px;margin:16px;padding:16px 16px 8px 16px" %)\n')
+        self.add_text('(% style="border-left:solid gainsboro 8px;margin:16px;padding:16px 16px 8px 16px" %)\n')
         self._push_group(node)
 
     def depart_block_quote(self, node):
-        test_popped_node(node, self._pop_group(postfix="\n\n"))
-
-
-    # title_reference
-    def visit_title_reference(self, node):
-        self.visit_emphasis(node)
-
-    def depart_title_reference(self, node):
-        self.depart_emphasis(node)
+        self._check_popped_group(node, self._pop_group(postfix="\n\n"))
 
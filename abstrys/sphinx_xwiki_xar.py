@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Sphinx XWiki XAR Export
+#
+# Writes pages (and their attachments) to a XAR package: a zip file of XWiki
+# document XML files and a package.xml that lists them, which XWiki can import
+# in one go.
+#
+# Each document is streamed into the archive (attachments are base64-encoded
+# a block at a time), so the export is never held in memory. Entries are given
+# fixed timestamps and attributes, so the same pages always give a
+# byte-identical package.
+#
+# by Eron Hennessey <eron@abstrys.com>
+#
+#===============================================================================
+
+import os
+import base64
+import zipfile
+import mimetypes
+from xml.sax.saxutils import escape
+
+# the timestamp given to every entry in the package (the earliest that zip files can store).
+ENTRY_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# the amount of an attachment that's encoded at a time (a multiple of 3, so the base64 blocks can
+# simply be joined).
+ATTACHMENT_BLOCK_SIZE = 3 * 64 * 1024
+
+DOCUMENT_HEADER = """<?xml version="1.1" encoding="UTF-8"?>
+
+<xwikidoc version="1.3" reference="{reference}" locale="">
+  <web>{space}</web>
+  <name>WebHome</name>
+  <language/>
+  <defaultLanguage/>
+  <translation>0</translation>
+  <creator>{author}</creator>
+  <parent>{parent}</parent>
+  <author>{author}</author>
+  <contentAuthor>{author}</contentAuthor>
+  <version>1.1</version>
+  <title>{title}</title>
+  <comment/>
+  <minorEdit>false</minorEdit>
+  <syntaxId>xwiki/2.1</syntaxId>
+  <hidden>false</hidden>
+  <content>{content}</content>
+"""
+
+ATTACHMENT_HEADER = """  <attachment>
+    <filename>{name}</filename>
+    <mimetype>{mimetype}</mimetype>
+    <filesize>{size}</filesize>
+    <author>{author}</author>
+    <version>1.1</version>
+    <comment/>
+    <content>"""
+
+ATTACHMENT_FOOTER = """</content>
+  </attachment>
+"""
+
+DOCUMENT_FOOTER = """</xwikidoc>
+"""
+
+PACKAGE_HEADER = """<?xml version="1.1" encoding="UTF-8"?>
+
+<package>
+  <infos>
+    <name>{name}</name>
+    <description>{description}</description>
+    <licence/>
+    <author>{author}</author>
+    <version>{version}</version>
+    <backupPack>false</backupPack>
+    <preserveVersion>false</preserveVersion>
+  </infos>
+  <files>
+"""
+
+PACKAGE_FOOTER = """  </files>
+</package>
+"""
+
+
+def get_document_reference(reference):
+    """
+    Returns the list of spaces for a page reference ("Space.SubSpace.Page"). Like the publisher,
+    the XAR stores every page as the WebHome of a nested page.
+    """
+    return [part for part in reference.split('.') if part]
+
+
+class XarWriter(object):
+    """
+    Writes a XAR package, one page at a time.
+
+    The package is written to a temporary file that replaces *path* when it's closed, so an
+    interrupted build never leaves a partial package behind.
+    """
+
+    def __init__(self, path, name='', description='', version='', author='XWiki.Admin'):
+        self.path = path
+        self.tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        self.infos = {'name': escape(name), 'description': escape(description),
+                      'version': escape(version), 'author': escape(author)}
+        self.author = escape(author)
+        self.documents = []
+        self.attachment_count = 0
+        self.zip_file = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _open_entry(self, filename):
+        """
+        Opens a new entry for writing, with fixed metadata so the package is reproducible.
+        """
+        info = zipfile.ZipInfo(filename, date_time=ENTRY_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.create_system = 3
+        info.external_attr = 0o644 << 16
+        return self.zip_file.open(info, 'w')
+
+    def add_page(self, reference, title, content, attachments=()):
+        """
+        Adds a page to the package.
+
+        reference:
+           The page's fully qualified reference ("Space.SubSpace.Page").
+        attachments:
+           A list of (name, path) tuples for the files attached to the page.
+        """
+        spaces = get_document_reference(reference)
+        document = '.'.join(spaces + ['WebHome'])
+        parent = '.'.join(spaces[:-1] + ['WebHome']) if len(spaces) > 1 else ''
+        self.documents.append(document)
+
+        with self._open_entry('/'.join(spaces + ['WebHome.xml'])) as entry:
+            entry.write(DOCUMENT_HEADER.format(reference=escape(document),
+                space=escape('.'.join(spaces)), parent=escape(parent), author=self.author,
+                title=escape(title), content=escape(content)).encode('utf-8'))
+            for name, path in attachments:
+                mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                entry.write(ATTACHMENT_HEADER.format(name=escape(name), mimetype=mimetype,
+                    size=os.path.getsize(path), author=self.author).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(ATTACHMENT_BLOCK_SIZE), b''):
+                        entry.write(base64.b64encode(block))
+                entry.write(ATTACHMENT_FOOTER.encode('utf-8'))
+                self.attachment_count += 1
+            entry.write(DOCUMENT_FOOTER.encode('utf-8'))
+
+    def close(self):
+        """
+        Writes package.xml and moves the finished package into place.
+        """
+        with self._open_entry('package.xml') as entry:
+            entry.write(PACKAGE_HEADER.format(**self.infos).encode('utf-8'))
+            for document in self.documents:
+                entry.write(('    <file defaultAction="0" language="">%s</file>\n'
+                             % escape(document)).encode('utf-8'))
+            entry.write(PACKAGE_FOOTER.encode('utf-8'))
+        self.zip_file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discards the package.
+        """
+        self.zip_file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Page write memory benchmark
+#
+# Builds a corpus of single large pages, then measures the peak memory
+# allocated (with tracemalloc) while each page is written, with the output
+# held in memory (the default) and streamed to the file
+# (xwiki_stream_output). The doctree itself is resolved before measuring, so
+# only the memory used for the output is counted.
+#
+#===============================================================================
+
+import os, sys, shutil, tempfile, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sphinx.application import Sphinx
+from corpus import generate_page, CONF_PY
+
+TEMPLATE = """(% class="bench" %)
+(((
+<<page_contents>>
+)))
+"""
+
+
+def measure(app, docname, stream):
+    """
+    Returns (peak bytes allocated, output bytes) for writing *docname*.
+    """
+    builder = app.builder
+    app.config.xwiki_stream_output = stream
+    doctree = app.env.get_and_resolve_doctree(docname, builder)
+    # make sure the page is written again.
+    builder.manifest.docs.pop(docname, None)
+    output = os.path.join(builder.outdir, builder.get_page_filename(docname))
+    if os.path.exists(output):
+        os.remove(output)
+    tracemalloc.start()
+    try:
+        builder.write_page(docname, doctree)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, os.path.getsize(output)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark peak memory while writing a page.")
+    parser.add_argument('--sections', type=int, nargs='+', default=[100, 200, 400, 800])
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        srcdir = os.path.join(tmpdir, 'source')
+        os.makedirs(srcdir)
+        template_path = os.path.join(tmpdir, 'template.xwiki')
+        with open(template_path, 'w') as f:
+            f.write(TEMPLATE)
+        with open(os.path.join(srcdir, 'conf.py'), 'w') as f:
+            f.write(CONF_PY + "xwiki_page_template = %r\n" % template_path)
+        toctree = ["Index", "#####", "", ".. toctree::", ""]
+        for sections in args.sections:
+            toctree.append("   page%d" % sections)
+            with open(os.path.join(srcdir, 'page%d.rst' % sections), 'w') as f:
+                f.write(generate_page(sections, sections=sections, nesting=4))
+        with open(os.path.join(srcdir, 'index.rst'), 'w') as f:
+            f.write("\n".join(toctree) + "\n")
+
+        app = Sphinx(srcdir, srcdir, os.path.join(tmpdir, 'build'),
+                     os.path.join(tmpdir, 'doctrees'), 'xwiki', status=None, warning=None)
+        app.build()
+
+        print("%10s %12s %16s %16s %8s" % ("sections", "output (MB)", "in memory (MB)",
+                                          "streamed (MB)", "ratio"))
+        for sections in args.sections:
+            docname = 'page%d' % sections
+            in_memory, size = measure(app, docname, False)
+            streamed, streamed_size = measure(app, docname, True)
+            assert size == streamed_size
+            print("%10d %12.2f %16.2f %16.2f %8.1f" % (sections, size / 1048576.0,
+                in_memory / 1048576.0, streamed / 1048576.0, in_memory / float(streamed)))
+    finally:
+        shutil.rmtree(tmpdir)
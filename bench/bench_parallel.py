@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Parallel write benchmark
+#
+# Reads a synthetic corpus once, then times the write phase of the xwiki
+# builder for an increasing number of jobs (sphinx-build -j). Each run starts
+# from an empty output directory but shares the pickled environment, so only
+# the pages are written again.
+#
+#===============================================================================
+
+import os, sys, time, shutil, tempfile, filecmp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sphinx.application import Sphinx
+from corpus import generate_corpus
+
+
+def build(srcdir, outdir, doctreedir, jobs):
+    """
+    Builds *srcdir* into *outdir* with *jobs* parallel jobs, returning the time taken.
+    """
+    app = Sphinx(srcdir, srcdir, outdir, doctreedir, 'xwiki', status=None, warning=None,
+                 parallel=jobs)
+    start = time.perf_counter()
+    app.build()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark parallel xwiki writing.")
+    parser.add_argument('--pages', type=int, default=500)
+    parser.add_argument('--jobs', type=int, nargs='+',
+                        default=sorted(set([1, 2, 4, os.cpu_count() or 1])))
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        srcdir = os.path.join(tmpdir, 'source')
+        doctreedir = os.path.join(tmpdir, 'doctrees')
+        generate_corpus(srcdir, pages=args.pages)
+        # read the corpus once, so the runs below only write.
+        build(srcdir, os.path.join(tmpdir, 'warmup'), doctreedir, 1)
+
+        print("cpus: %d, pages: %d" % (os.cpu_count() or 1, args.pages + 1))
+        print("%6s %10s %10s" % ("jobs", "time (s)", "speedup"))
+        baseline = None
+        first_outdir = None
+        for jobs in args.jobs:
+            outdir = os.path.join(tmpdir, 'out-%d' % jobs)
+            elapsed = build(srcdir, outdir, doctreedir, jobs)
+            baseline = baseline or elapsed
+            print("%6d %10.2f %10.2f" % (jobs, elapsed, baseline / elapsed))
+            # the output must not depend on the number of jobs.
+            if first_outdir is None:
+                first_outdir = outdir
+            else:
+                pages = [f for f in os.listdir(first_outdir) if f.endswith('.xwiki')]
+                match, mismatch, errors = filecmp.cmpfiles(first_outdir, outdir, pages,
+                                                           shallow=False)
+                if mismatch or errors:
+                    print("  output differs from -j %d: %s" % (args.jobs[0], mismatch + errors))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Writer and builder benchmark suite
+#
+# Generates a synthetic corpus for each scenario, then times each phase of
+# writing it:
+#
+# * build: a complete ``sphinx-build -b xwiki -E`` run, in its own process.
+# * translate: the XWikiTranslator walk over every (resolved) doctree.
+# * render: rendering every page through a page template.
+# * write: writing every page to disk.
+#
+# Results are saved as JSON; ``compare`` flags phases that got slower than a
+# threshold between two result files.
+#
+# Usage::
+#
+#    bench/bench_suite.py run --output before.json
+#    bench/bench_suite.py run --output after.json
+#    bench/bench_suite.py compare before.json after.json --threshold 10
+#
+#===============================================================================
+
+import os, sys, time, json, shutil, tempfile, platform, subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import generate_corpus
+
+# the corpus shapes that are benchmarked (on top of the --pages and --sections options).
+SCENARIOS = {
+    'baseline': {'nesting': 3, 'link_density': 1, 'literal_lines': 10},
+    'deep-nesting': {'nesting': 12, 'link_density': 1, 'literal_lines': 10},
+    'dense-links': {'nesting': 3, 'link_density': 8, 'literal_lines': 10},
+    'large-literals': {'nesting': 3, 'link_density': 1, 'literal_lines': 400},
+}
+
+PHASES = ['build', 'translate', 'render', 'write']
+
+TEMPLATE = """(% class="bench" %)
+(((
+<% for entry in toc %>* [[<<entry.title>>>>||anchor="<<entry.anchor>>"]]
+<% endfor %>
+<<page_contents>>
+)))
+"""
+
+
+def best_of(repeat, func):
+    """
+    Calls *func* *repeat* times, returning the shortest time taken (in seconds).
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def time_build(srcdir, outdir, repeat):
+    """
+    Times a complete sphinx-build run (in a new process, as it would be run by hand).
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.abspath(ROOT)] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    command = [sys.executable, '-m', 'sphinx', '-q', '-E', '-b', 'xwiki', srcdir, outdir]
+    return best_of(repeat, lambda: subprocess.run(command, env=env, check=True,
+                                                  stdout=subprocess.DEVNULL))
+
+
+def time_phases(srcdir, workdir, repeat):
+    """
+    Builds the corpus in this process, then times the translate, render and write phases over its
+    pages. Returns a tuple: (dict of phase -> seconds, number of pages, bytes of output).
+    """
+    from sphinx.application import Sphinx
+    from abstrys.sphinx_xwiki_manifest import write_bytes_atomic
+
+    outdir = os.path.join(workdir, 'phases')
+    app = Sphinx(srcdir, srcdir, outdir, os.path.join(outdir, '.doctrees'), 'xwiki',
+                 status=None, warning=None)
+    app.build()
+    builder = app.builder
+    docnames = sorted(app.env.found_docs)
+    doctrees = [(docname, app.env.get_and_resolve_doctree(docname, builder))
+                for docname in docnames]
+    contexts = dict((docname, builder.get_page_context(docname)) for docname in docnames)
+
+    bodies = {}
+    def translate():
+        for docname, doctree in doctrees:
+            bodies[docname] = builder.writer.translate_doctree(doctree)
+
+    pages = {}
+    def render():
+        for docname in docnames:
+            pages[docname] = builder.page_template.render(page_contents=bodies[docname],
+                                                          **contexts[docname])
+
+    write_dir = os.path.join(workdir, 'write')
+    os.makedirs(write_dir)
+    def write():
+        for docname in docnames:
+            write_bytes_atomic(os.path.join(write_dir, builder.get_page_filename(docname)),
+                               pages[docname].encode('utf-8'))
+
+    times = {
+        'translate': best_of(repeat, translate),
+        'render': best_of(repeat, render),
+        'write': best_of(repeat, write),
+    }
+    output_bytes = sum(len(page.encode('utf-8')) for page in pages.values())
+    return times, len(docnames), output_bytes
+
+
+def run_scenario(name, params, pages, sections, repeat):
+    """
+    Generates and benchmarks one scenario, returning its results.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        srcdir = os.path.join(tmpdir, 'source')
+        generate_corpus(srcdir, pages=pages, sections=sections, **params)
+        template_path = os.path.join(tmpdir, 'template.xwiki')
+        with open(template_path, 'w') as f:
+            f.write(TEMPLATE)
+        with open(os.path.join(srcdir, 'conf.py'), 'a') as f:
+            f.write("xwiki_page_template = %r\n" % template_path)
+
+        times, page_count, output_bytes = time_phases(srcdir, tmpdir, repeat)
+        times['build'] = time_build(srcdir, os.path.join(tmpdir, 'build'), repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {
+        'params': dict(params, pages=pages, sections=sections),
+        'pages': page_count,
+        'output_bytes': output_bytes,
+        'phases': dict((phase, {'seconds': times[phase],
+                                'ms_per_page': times[phase] * 1000.0 / page_count})
+                       for phase in PHASES),
+    }
+
+
+def get_environment():
+    """
+    Returns a description of the environment the benchmarks ran in.
+    """
+    import sphinx, docutils
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'sphinx': sphinx.__version__,
+        'docutils': docutils.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def run(args):
+    results = {'environment': get_environment(), 'scenarios': {}}
+    print("%-16s %6s %10s %10s %10s %10s  (ms/page)" % (("scenario", "pages") + tuple(PHASES)))
+    for name in args.scenarios:
+        result = run_scenario(name, SCENARIOS[name], args.pages, args.sections, args.repeat)
+        results['scenarios'][name] = result
+        print("%-16s %6d %10.2f %10.2f %10.2f %10.2f" % ((name, result['pages']) + tuple(
+            result['phases'][phase]['ms_per_page'] for phase in PHASES)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("results saved to %s" % args.output)
+    return 0
+
+
+def compare(args):
+    """
+    Compares two result files, returning 1 if any phase got slower by more than the threshold.
+    """
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    regressions = 0
+    print("%-16s %-10s %12s %12s %9s" % ("scenario", "phase", "before (ms)", "after (ms)",
+                                         "change"))
+    for name in sorted(before['scenarios']):
+        if name not in after['scenarios']:
+            continue
+        old, new = before['scenarios'][name], after['scenarios'][name]
+        if old['params'] != new['params']:
+            print("%-16s (corpus parameters differ; skipped)" % name)
+            continue
+        for phase in PHASES:
+            old_time = old['phases'][phase]['ms_per_page']
+            new_time = new['phases'][phase]['ms_per_page']
+            change = ((new_time - old_time) * 100.0 / old_time) if old_time else 0.0
+            flag = ""
+            if change > args.threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("%-16s %-10s %12.3f %12.3f %+8.1f%%%s" % (name, phase, old_time, new_time,
+                                                          change, flag))
+    if before['environment'] != after['environment']:
+        print("note: the results come from different environments (or commits).")
+    print("%d regressions over %.0f%%" % (regressions, args.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the xwiki writer and builder.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the benchmarks")
+    run_parser.add_argument('--pages', type=int, default=100)
+    run_parser.add_argument('--sections', type=int, default=5)
+    run_parser.add_argument('--repeat', type=int, default=3,
+                            help="the number of times each phase is run (the best time is kept)")
+    run_parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS),
+                            default=sorted(SCENARIOS))
+    run_parser.add_argument('--output', help="the file to save the results to (as JSON)")
+
+    compare_parser = commands.add_parser('compare', help="compare two sets of results")
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help="the slowdown (in percent) that counts as a regression")
+
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == 'run' else compare(args))
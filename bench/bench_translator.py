@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# XWikiTranslator scaling benchmark
+#
+# Translates synthetic documents of doubling size (and increasing nesting
+# depth) and reports the time taken per megabyte of output. With linear
+# scaling, the time per MB stays flat as the documents grow.
+#
+#===============================================================================
+
+import os, sys, time
+from docutils.core import publish_doctree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from abstrys.sphinx_xwiki_writer import XWikiTranslator
+from corpus import generate_page
+
+
+def time_translation(doctree, repeat=3):
+    """
+    Returns (best time in seconds, output length) for translating *doctree*.
+    """
+    best = None
+    output = ""
+    for i in range(repeat):
+        start = time.perf_counter()
+        visitor = XWikiTranslator(doctree)
+        doctree.walkabout(visitor)
+        output = visitor.astext()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, len(output)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark XWikiTranslator scaling.")
+    parser.add_argument('--sections', type=int, nargs='+', default=[50, 100, 200, 400, 800],
+                        help="page sizes (in sections) to translate")
+    parser.add_argument('--nesting', type=int, nargs='+', default=[2, 8, 32],
+                        help="list/admonition nesting depths to translate")
+    args = parser.parse_args()
+
+    print("%10s %10s %12s %10s %10s" % ("sections", "nesting", "output (MB)", "time (s)", "s / MB"))
+    for nesting in args.nesting:
+        for sections in args.sections:
+            source = generate_page(0, sections=sections, nesting=nesting)
+            doctree = publish_doctree(source, settings_overrides={'report_level': 5})
+            elapsed, length = time_translation(doctree)
+            megabytes = length / (1024.0 * 1024.0)
+            print("%10d %10d %12.2f %10.3f %10.3f" %
+                  (sections, nesting, megabytes, elapsed, elapsed / megabytes))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Per-page write overhead benchmark
+#
+# Scales the bundled test_docs up to a few thousand pages, then compares the
+# time per page taken to translate each doctree through docutils'
+# publish_from_doctree() (the way write_doc used to) and directly with
+# XWikiWriter.translate_doctree().
+#
+#===============================================================================
+
+import os, sys, time, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from docutils.core import publish_from_doctree
+from sphinx.application import Sphinx
+from abstrys.sphinx_xwiki_writer import XWikiWriter
+
+TEST_DOCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_docs', 'source')
+PAGES = ['test-page', 'test-page-2', 'test-page-2a']
+
+
+def scale_test_docs(srcdir, copies):
+    """
+    Writes a copy of test_docs to *srcdir* with each of its pages repeated *copies* times.
+    """
+    shutil.copytree(TEST_DOCS, srcdir)
+    toctree = ["Index", "#####", "", ".. toctree::", ""]
+    for i in range(copies):
+        for page in PAGES:
+            with open(os.path.join(TEST_DOCS, page + '.rst'), encoding='utf-8') as f:
+                source = f.read()
+            # labels must be unique across the doc set.
+            source = source.replace('.. _test-', '.. _test%d-' % i)
+            with open(os.path.join(srcdir, '%s-%d.rst' % (page, i)), 'w', encoding='utf-8') as f:
+                f.write(source)
+            toctree.append("   %s-%d" % (page, i))
+    with open(os.path.join(srcdir, 'index.rst'), 'w', encoding='utf-8') as f:
+        f.write("\n".join(toctree) + "\n")
+
+
+def time_pages(doctrees, translate):
+    """
+    Returns the average time per page (in seconds) taken by *translate* over all *doctrees*.
+    """
+    start = time.perf_counter()
+    for doctree in doctrees:
+        translate(doctree)
+    return (time.perf_counter() - start) / len(doctrees)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the per-page write overhead.")
+    parser.add_argument('--copies', type=int, default=1000,
+                        help="how many times to repeat each test_docs page")
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        srcdir = os.path.join(tmpdir, 'source')
+        outdir = os.path.join(tmpdir, 'build')
+        scale_test_docs(srcdir, args.copies)
+        app = Sphinx(srcdir, srcdir, outdir, os.path.join(outdir, '.doctrees'), 'xwiki',
+                     status=None, warning=None)
+        app.build()
+
+        builder = app.builder
+        doctrees = [app.env.get_and_resolve_doctree(docname, builder)
+                    for docname in sorted(app.env.found_docs)]
+        writer = XWikiWriter(app.config)
+
+        def via_publisher(doctree):
+            return publish_from_doctree(doctree, writer=writer).decode('utf-8')
+
+        before = time_pages(doctrees, via_publisher)
+        after = time_pages(doctrees, writer.translate_doctree)
+
+        print("pages: %d" % len(doctrees))
+        print("publish_from_doctree: %8.1f us/page" % (before * 1e6))
+        print("translate_doctree:    %8.1f us/page" % (after * 1e6))
+        print("saved:                %8.1f us/page" % ((before - after) * 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
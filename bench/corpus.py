@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===============================================================================
+#
+# Synthetic reST corpus generator
+#
+# Generates reStructuredText pages of a configurable size and shape, for
+# benchmarking the XWiki writer and builder.
+#
+#===============================================================================
+
+import os
+import random
+
+CONF_PY = """
+project = 'XWiki Builder Benchmark'
+extensions = ['abstrys.sphinx_xwiki_builder']
+xwiki_root_page = 'Bench'
+"""
+
+LOREM = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua").split()
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(LOREM) for i in range(count))
+
+
+def _paragraph(rng, page_count=0, link_density=0):
+    """
+    Returns a paragraph of text with some inline markup, and links to other pages in the corpus if
+    *link_density* (links per paragraph) is set.
+    """
+    parts = [_words(rng, 8).capitalize(), "**%s**" % _words(rng, 2), _words(rng, 6),
+             "*%s*" % _words(rng, 2), "``%s``" % _words(rng, 1), _words(rng, 10)]
+    for i in range(link_density):
+        if page_count > 0:
+            parts.append(":doc:`page%d`" % rng.randrange(page_count))
+        parts.append("`%s <https://example.com/%d>`__" % (_words(rng, 2), i))
+    return ' '.join(parts) + "."
+
+
+def _nested_list(rng, depth, indent=""):
+    lines = []
+    for i in range(3):
+        lines.append("%s* %s" % (indent, _words(rng, 6)))
+        lines.append("")
+        if depth > 1 and i == 1:
+            lines.extend(_nested_list(rng, depth - 1, indent + "  "))
+    return lines
+
+
+def _nested_admonitions(rng, depth, indent=""):
+    lines = ["%s.. note::" % indent, "", "%s   %s" % (indent, _words(rng, 12)), ""]
+    if depth > 1:
+        lines.extend(["%s   * %s" % (indent, _words(rng, 4)), ""])
+        lines.extend(_nested_admonitions(rng, depth - 1, indent + "     "))
+    return lines
+
+
+def _table(rng, rows, cols=3):
+    lines = [".. list-table::", "   :header-rows: 1", ""]
+    for r in range(rows):
+        for c in range(cols):
+            lines.append("   %s %s" % ("* -" if c == 0 else "  -", _words(rng, 3)))
+        if r == rows // 2:
+            # put a definition list inside one of the table cells.
+            lines.extend(["", "       term", "         %s" % _words(rng, 5), ""])
+    lines.append("")
+    return lines
+
+
+def _literal_block(rng, lines_count):
+    lines = [".. code-block:: python", ""]
+    for i in range(lines_count):
+        lines.append("   x_%d = '%s'" % (i, _words(rng, 6)))
+    lines.append("")
+    return lines
+
+
+def generate_page(index, sections=5, page_count=0, nesting=3, link_density=1,
+                  literal_lines=10, seed=None):
+    """
+    Returns the reST source of a single synthetic page.
+
+    index:
+       The number of the page (used for its title).
+    sections:
+       The number of sections on the page; the size of a page grows linearly with this.
+    page_count:
+       The number of pages in the corpus (so that :doc: links can point at them).
+    nesting:
+       How deeply lists and admonitions are nested.
+    link_density:
+       The number of links in each paragraph.
+    literal_lines:
+       The number of lines in each literal block.
+    """
+    rng = random.Random(index if seed is None else seed)
+    title = "Page %d" % index
+    lines = ["#" * len(title), title, "#" * len(title), "", ".. contents::", "   :local:", ""]
+    for s in range(sections):
+        heading = "Section %d %s" % (s, _words(rng, 2))
+        lines.extend([".. _page%d-section%d:" % (index, s), "", heading, "=" * len(heading), ""])
+        lines.extend([_paragraph(rng, page_count, link_density), ""])
+        lines.extend(_nested_list(rng, nesting))
+        lines.extend(["term %d" % s, "   %s" % _paragraph(rng, page_count, link_density), ""])
+        lines.extend(_nested_admonitions(rng, nesting))
+        lines.extend(_table(rng, 4))
+        if literal_lines > 0:
+            lines.extend(_literal_block(rng, literal_lines))
+        lines.extend(["   %s" % _paragraph(rng), ""])
+    return "\n".join(lines) + "\n"
+
+
+def generate_corpus(srcdir, pages=10, **kwargs):
+    """
+    Writes a complete Sphinx project (conf.py, index.rst and *pages* pages) to *srcdir*. Any extra
+    keyword arguments are passed on to generate_page().
+    """
+    os.makedirs(srcdir, exist_ok=True)
+    with open(os.path.join(srcdir, 'conf.py'), 'w') as f:
+        f.write(CONF_PY)
+    toctree = ["Index", "#####", "", ".. toctree::", ""]
+    for i in range(pages):
+        toctree.append("   page%d" % i)
+        with open(os.path.join(srcdir, 'page%d.rst' % i), 'w') as f:
+            f.write(generate_page(i, page_count=pages, **kwargs))
+    with open(os.path.join(srcdir, 'index.rst'), 'w') as f:
+        f.write("\n".join(toctree) + "\n")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate a synthetic Sphinx corpus.")
+    parser.add_argument('srcdir')
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--sections', type=int, default=5)
+    parser.add_argument('--nesting', type=int, default=3)
+    parser.add_argument('--link-density', type=int, default=1)
+    parser.add_argument('--literal-lines', type=int, default=10)
+    args = parser.parse_args()
+    generate_corpus(args.srcdir, pages=args.pages, sections=args.sections, nesting=args.nesting,
+                    link_density=args.link_density, literal_lines=args.literal_lines)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os, json, shutil, hashlib, tempfile
+from xwikitest import build, copy_source, report
+
+IMAGES_PAGE = """\
+:orphan:
+
+Images
+======
+
+.. image:: one/logo.png
+
+.. image:: two/logo.png
+
+.. image:: one/bird.png
+
+.. image:: two/bird.png
+
+.. image:: http://127.0.0.1:9/remote.png
+"""
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_assets.plan_attachments:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = copy_source(tmpdir)
+   outdir = os.path.join(tmpdir, 'out')
+   checks = []
+   try:
+      # the same logo in two places, and two different birds with the same name.
+      for dirname, bird in [('one', b'a bird'), ('two', b'another bird')]:
+         os.makedirs(os.path.join(srcdir, dirname))
+         with open(os.path.join(srcdir, dirname, 'logo.png'), 'wb') as f:
+            f.write(b'a logo')
+         with open(os.path.join(srcdir, dirname, 'bird.png'), 'wb') as f:
+            f.write(bird)
+      with open(os.path.join(srcdir, 'images.rst'), 'w') as f:
+         f.write(IMAGES_PAGE)
+      process = build(srcdir, outdir)
+
+      bird_names = ['bird-%s.png' % hashlib.sha1(bird).hexdigest()[:8]
+                    for bird in [b'a bird', b'another bird']]
+      with open(os.path.join(outdir, 'xwiki-pages.json')) as f:
+         attachments = json.load(f)['images']['attachments']
+      with open(os.path.join(outdir, 'Images.xwiki')) as f:
+         output = f.read()
+      images = [line.split('||')[0][len('[[image:'):] for line in output.splitlines()
+                if line.startswith('[[image:')]
+      checks += [
+         ("build succeeds", process.returncode == 0),
+         ("same image attached once", attachments == sorted(['logo.png'] + bird_names)),
+         ("same image referenced by one name", images[:2] == ['logo.png', 'logo.png']),
+         ("images with the same name attached separately",
+          all(os.path.exists(os.path.join(outdir, 'attachments', name)) for name in bird_names)),
+         ("images with the same name referenced by their own names", images[2:4] == bird_names),
+         ("remote image linked to", images[4:] == ['http://127.0.0.1:9/remote.png']),
+         ("remote image not downloaded", 'remote image' not in process.stderr),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import os, re, shutil, tempfile
+import multiprocessing
+from abstrys.sphinx_xwiki_cache import TranslationCache
+from xwikitest import SOURCE_DIR, start_build, same_output, report
+
+CACHE_STATS = re.compile(r"translation cache: (\d+) hits, (\d+) misses")
+
+def hammer(cache_dir, worker, results):
+   """
+   Writes, reads and collects the same entries as the other workers, all at once.
+   """
+   cache = TranslationCache(cache_dir, max_size=1024 * 1024)
+   bad_reads = 0
+   for i in range(200):
+      key = "%040x" % (i % 50)
+      text = ("entry %d\n" % (i % 50)) * 100
+      cache.put(key, text)
+      found = cache.get(key)
+      # another worker may have evicted the entry, but it's never half-written.
+      if found is not None and found[0] != text:
+         bad_reads += 1
+      if i % 40 == 0:
+         cache.collect()
+   results.put((worker, bad_reads))
+
+def build(cache_dir, outdir):
+   """
+   Starts a build of the test docs that uses the shared cache.
+   """
+   return start_build(SOURCE_DIR, outdir, '-E',
+                      '-D', 'xwiki_translation_cache_dir=%s' % cache_dir)
+
+def get_stats(process):
+   output = process.communicate()[0]
+   match = CACHE_STATS.search(output)
+   if process.returncode != 0 or match is None:
+      return None
+   return int(match.group(1)), int(match.group(2))
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_cache.TranslationCache:")
+
+   tmpdir = tempfile.mkdtemp()
+   checks = []
+   try:
+      # two processes using the same cache directory at once.
+      cache_dir = os.path.join(tmpdir, 'hammer')
+      results = multiprocessing.Queue()
+      workers = [multiprocessing.Process(target=hammer, args=(cache_dir, n, results))
+                 for n in range(2)]
+      for worker in workers:
+         worker.start()
+      for worker in workers:
+         worker.join()
+      bad_reads = [results.get()[1] for worker in workers]
+      leftovers = [name for dirpath, dirnames, filenames in os.walk(cache_dir)
+                   for name in filenames if name.endswith('.tmp')]
+      cache = TranslationCache(cache_dir, max_size=4096)
+      stats = cache.collect()
+      checks += [
+         ("concurrent writers never give a damaged entry", bad_reads == [0, 0]),
+         ("no temporary files left behind", leftovers == []),
+         ("collected to the size limit", stats['size'] <= 4096 and stats['removed'] > 0),
+      ]
+
+      # a damaged entry is a miss, not a wrong page.
+      cache.put("ab" * 20, "some text")
+      with open(cache.get_path("ab" * 20), 'r+b') as f:
+         f.seek(-1, os.SEEK_END)
+         f.write(b'!')
+      checks.append(("damaged entry ignored", cache.get("ab" * 20) is None))
+
+      # two builds sharing a cache directory at once, then a third that finds every page in it.
+      cache_dir = os.path.join(tmpdir, 'shared')
+      outdirs = [os.path.join(tmpdir, 'out%d' % n) for n in range(3)]
+      first = [build(cache_dir, outdir) for outdir in outdirs[:2]]
+      first_stats = [get_stats(process) for process in first]
+      third_stats = get_stats(build(cache_dir, outdirs[2]))
+      entries = sum(len(filenames) for dirpath, dirnames, filenames in os.walk(cache_dir))
+      checks += [
+         ("concurrent builds succeed", None not in first_stats),
+         ("later build uses the shared cache", third_stats is not None
+                                               and third_stats[0] == entries > 0),
+         ("output is the same with or without the cache",
+          same_output(outdirs[0], outdirs[1]) and same_output(outdirs[0], outdirs[2])),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import os, json, shutil, tempfile
+from xwikitest import build, copy_source, report
+
+MESSAGE = "link to a missing anchor: TestPage2a#not-a-section"
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_diagnostics.Diagnostics:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = copy_source(tmpdir)
+   checks = []
+   try:
+      # two links to a label that isn't on a section: the same problem, found twice.
+      with open(os.path.join(srcdir, 'test-page-2a.rst'), 'a') as f:
+         f.write("\n.. _not-a-section:\n\nA paragraph with a label.\n")
+      with open(os.path.join(srcdir, 'index.rst'), 'a') as f:
+         f.write("\nSee :ref:`the paragraph <not-a-section>`.\n\n"
+                 "Or :ref:`that paragraph <not-a-section>`.\n")
+      outdir = os.path.join(tmpdir, 'out')
+      process = build(srcdir, outdir, '-D', 'xwiki_diagnostics_filename=diagnostics.json')
+      with open(os.path.join(outdir, 'diagnostics.json')) as f:
+         diagnostics = json.load(f)
+      checks += [
+         ("build succeeds", process.returncode == 0),
+         ("repeated problem reported once", process.stderr.count(MESSAGE) == 1),
+         ("problems counted", "problems found while translating (1 distinct)" in process.stdout
+                              and "     2 x %s (reference)" % MESSAGE in process.stdout),
+         ("diagnostics saved", len(diagnostics) == 1 and diagnostics[0]['message'] == MESSAGE
+                               and diagnostics[0]['node_type'] == 'reference'
+                               and diagnostics[0]['count'] == 2
+                               and len(diagnostics[0]['locations']) == 2),
+      ]
+
+      # the warning can be silenced for the node type, but the problem is still counted.
+      process = build(srcdir, os.path.join(tmpdir, 'suppressed'),
+                      '-D', 'suppress_warnings=xwiki.reference')
+      checks += [
+         ("warning suppressed", process.returncode == 0 and MESSAGE not in process.stderr),
+         ("suppressed problem counted", "     2 x %s" % MESSAGE in process.stdout),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
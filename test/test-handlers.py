@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import sys, os, shutil, tempfile
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace, patch_docutils
+from abstrys.sphinx_xwiki_writer import XWikiTranslator
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_docs', 'source')
+
+# an extension with two node types: one with handlers added through app.add_node(), the other with
+# handlers registered with the builder.
+EXTENSION = '''
+from docutils import nodes
+
+class shout(nodes.Inline, nodes.TextElement):
+    pass
+
+class whisper(nodes.Inline, nodes.TextElement):
+    pass
+
+def make_role(node_class):
+    def role(name, rawtext, text, lineno, inliner, options=None, content=None):
+        return [node_class(text, text)], []
+    return role
+
+def visit_shout(translator, node):
+    translator.add_text("**")
+
+def depart_shout(translator, node):
+    translator.add_text("!**")
+
+def visit_whisper(translator, node):
+    translator.add_text(",,")
+
+def depart_whisper(translator, node):
+    translator.add_text(",,")
+
+def on_builder_inited(app):
+    if app.builder.name == 'xwiki':
+        app.builder.register_node_handler(whisper, visit_whisper, depart_whisper)
+
+def setup(app):
+    app.add_node(shout, xwiki=(visit_shout, depart_shout))
+    app.add_node(whisper)
+    app.add_role('shout', make_role(shout))
+    app.add_role('whisper', make_role(whisper))
+    app.connect('builder-inited', on_builder_inited)
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
+'''
+
+CONF_PY = '''
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+extensions = ['abstrys.sphinx_xwiki_builder', 'noisy']
+'''
+
+INDEX_RST = '''
+Index
+=====
+
+Say :shout:`hello`, then :whisper:`goodbye`, in `a title`.
+'''
+
+def build(srcdir, outdir):
+   """
+   Builds the docs in *srcdir* in this process, returning the Sphinx application.
+   """
+   with patch_docutils(srcdir), docutils_namespace():
+      app = Sphinx(srcdir, srcdir, outdir, os.path.join(outdir, '.doctrees'), 'xwiki',
+                   confoverrides={'xwiki_root_page': 'Root.Page'}, status=None, warning=None,
+                   freshenv=True)
+      app.build()
+   return app
+
+if __name__ == "__main__":
+   print("Testing node handlers and node_aliases:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = os.path.join(tmpdir, 'source')
+   checks = []
+   try:
+      os.makedirs(srcdir)
+      for name, text in (('noisy.py', EXTENSION), ('conf.py', CONF_PY), ('index.rst', INDEX_RST)):
+         with open(os.path.join(srcdir, name), 'w') as f:
+            f.write(text)
+      app = build(srcdir, os.path.join(tmpdir, 'noisy'))
+      with open(os.path.join(tmpdir, 'noisy', 'Index.xwiki')) as f:
+         output = f.read()
+      checks += [
+         ("handlers added with app.add_node() used", "**hello!**" in output),
+         ("handlers registered with the builder used", ",,goodbye,," in output),
+         ("node_aliases used", "//a title//" in output),
+      ]
+
+      # another application in the same process doesn't see the first one's handlers.
+      other_app = build(SOURCE_DIR, os.path.join(tmpdir, 'plain'))
+      translator_class = other_app.builder.translator_class
+      checks += [
+         ("handlers kept out of XWikiTranslator",
+          XWikiTranslator.node_handlers == {}
+          and not any(node_class.__name__ in ('shout', 'whisper')
+                      for node_class in XWikiTranslator._get_dispatch_table())),
+         ("handlers kept out of other builders",
+          not (set(translator_class.node_handlers) & set(['shout', 'whisper']))),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   for name, passed in checks:
+      print("%s -- %s" % (name, "passed" if passed else "failed"))
+      if not passed:
+         sys.exit(1)
+
+   sys.exit(0)
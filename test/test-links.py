@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os, shutil, tempfile
+from xwikitest import build, copy_source, get_written_docnames, same_output, report
+
+def build_docnames(srcdir, outdir, *options):
+   """
+   Builds the docs in *srcdir*, returning the set of docnames that were written.
+   """
+   return get_written_docnames(build(srcdir, outdir, *options))
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_links.LinkIndex:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = copy_source(tmpdir)
+   outdir = os.path.join(tmpdir, 'out')
+   checks = []
+   try:
+      # a link to a label that isn't on a section, so there's no anchor for it on the page.
+      with open(os.path.join(srcdir, 'test-page-2a.rst'), 'a') as f:
+         f.write("\n.. _not-a-section:\n\nA paragraph with a label.\n")
+      with open(os.path.join(srcdir, 'index.rst'), 'a') as f:
+         f.write("\nSee :ref:`the paragraph <not-a-section>`.\n")
+      process = build(srcdir, outdir)
+      checks.append(("link to a missing anchor reported",
+                     "link to a missing anchor: TestPage2a#not-a-section" in process.stderr))
+
+      # test-page is linked to from index (its toctree) and test-page-2 (:doc: and :ref: links);
+      # test-page-2a doesn't link to it.
+      with open(os.path.join(srcdir, 'conf.py'), 'a') as f:
+         f.write("\nxwiki_page_name_overrides = {'test-page': 'Renamed.xwiki'}\n")
+      written = build_docnames(srcdir, outdir)
+      with open(os.path.join(outdir, 'TestPage2.xwiki')) as f:
+         output = f.read()
+      links_to_renamed = (">>Root.Page.Renamed]]" in output
+                          and '>>Root.Page.Renamed||anchor="test-tables"]]' in output
+                          and "Root.Page.TestPage]]" not in output
+                          and "Root.Page.TestPage|" not in output)
+      checks += [
+         ("renamed page and its referrers written",
+          written == set(['test-page', 'index', 'test-page-2'])),
+         ("links to the renamed page use its new name", links_to_renamed),
+         ("output is the same as a clean build",
+          build(srcdir, os.path.join(tmpdir, 'clean'), '-E').returncode == 0
+          and same_output(outdir, os.path.join(tmpdir, 'clean'))),
+         ("nothing written when nothing is renamed", build_docnames(srcdir, outdir) == set()),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
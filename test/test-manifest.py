@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os, shutil, tempfile
+from xwikitest import build, copy_source, get_page_stats, edit, report
+
+# runs sphinx-build as if the writer was a newer version.
+NEWER_WRITER = ("import sys, abstrys.sphinx_xwiki_builder as builder; builder.WRITER_VERSION += 1; "
+                "from sphinx.cmd.build import main; sys.exit(main(sys.argv[1:]))")
+
+def build_stats(srcdir, outdir, **kwargs):
+   """
+   Builds the docs in *srcdir*, returning the number of pages (written, unchanged, removed).
+   """
+   return get_page_stats(build(srcdir, outdir, **kwargs))
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_manifest.BuildManifest:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = copy_source(tmpdir)
+   outdir = os.path.join(tmpdir, 'out')
+   checks = []
+   try:
+      sources = [os.path.join(srcdir, name) for name in os.listdir(srcdir)
+                 if name.endswith('.rst')]
+      pages = len(sources)
+
+      checks.append(("first build writes every page", build_stats(srcdir, outdir) == (pages, 0, 0)))
+      checks.append(("no-op build writes nothing", build_stats(srcdir, outdir) == (0, 0, 0)))
+
+      # the sources are read again, but the pages come out the same.
+      for path in sources:
+         os.utime(path)
+      checks.append(("touched pages are unchanged", build_stats(srcdir, outdir) == (0, pages, 0)))
+
+      # a new version of the writer translates every page again.
+      checks.append(("newer writer translates every page",
+                     build_stats(srcdir, outdir, code=NEWER_WRITER) == (0, pages, 0)))
+      build(srcdir, outdir)
+
+      # Sphinx writes the page's parent too, but only the edited page has changed.
+      edit(os.path.join(srcdir, 'test-page-2a.rst'), "demonstrate", "show")
+      stats = build_stats(srcdir, outdir)
+      checks.append(("only the edited page is written", stats is not None and stats[0] == 1))
+
+      # rename a page: it's written under its new name, and the old file is removed.
+      with open(os.path.join(srcdir, 'conf.py'), 'a') as f:
+         f.write("\nxwiki_page_name_overrides = {'test-page-2a': 'Renamed.xwiki'}\n")
+      stats = build_stats(srcdir, outdir)
+      checks += [
+         ("renamed page is written", stats is not None and stats[0] >= 1 and stats[2] == 1),
+         ("renamed page's old file is removed",
+          os.path.exists(os.path.join(outdir, 'Renamed.xwiki'))
+          and not os.path.exists(os.path.join(outdir, 'TestPage2a.xwiki'))),
+      ]
+
+      # delete a page: its file is removed.
+      os.remove(os.path.join(srcdir, 'test-page-2a.rst'))
+      edit(os.path.join(srcdir, 'test-page-2.rst'), "test-page-2a", "")
+      stats = build_stats(srcdir, outdir)
+      checks += [
+         ("deleted page is removed", stats is not None and stats[2] == 1),
+         ("deleted page's file is removed",
+          not os.path.exists(os.path.join(outdir, 'Renamed.xwiki'))),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
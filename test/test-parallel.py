@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import os, shutil, tempfile
+from xwikitest import SOURCE_DIR, build, read_trace, same_output, report
+
+def build_processes(outdir, *options):
+   """
+   Builds the test docs from scratch, returning the names of the processes in the build trace, or
+   None if the build fails.
+   """
+   if build(SOURCE_DIR, outdir, '-E', '-D', 'xwiki_trace_filename=trace.json',
+            *options).returncode != 0:
+      return None
+   return [event['args']['name'] for event in read_trace(outdir)
+           if event['name'] == 'process_name']
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_builder.XWikiBuilder.write_parallel:")
+
+   tmpdir = tempfile.mkdtemp()
+   serial = os.path.join(tmpdir, 'serial')
+   parallel = os.path.join(tmpdir, 'parallel')
+   checks = []
+   try:
+      serial_processes = build_processes(serial)
+      parallel_processes = build_processes(parallel, '-j', '4')
+      checks += [
+         ("serial build succeeds", serial_processes == ['sphinx-build']),
+         ("pages written by workers", parallel_processes is not None
+          and any(name.startswith('worker') for name in parallel_processes)),
+         ("parallel output is the same as serial output",
+          same_output(serial, parallel, ['xwiki-pages.json'])),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
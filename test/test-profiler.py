@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os, json, shutil, tempfile
+from xwikitest import SOURCE_DIR, build, read_trace, report
+
+def build_profile(outdir, *options):
+   """
+   Builds the test docs from scratch with the translator profile, returning the saved profile, or
+   None if the build fails.
+   """
+   if build(SOURCE_DIR, outdir, '-E', '-D', 'xwiki_profile=1',
+            '-D', 'xwiki_trace_filename=trace.json', *options).returncode != 0:
+      return None
+   with open(os.path.join(outdir, 'xwiki-profile.json')) as f:
+      return json.load(f)
+
+def get_counts(stats):
+   return dict((name, stat['count']) for name, stat in stats.items())
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_profiler.TranslatorProfile:")
+
+   tmpdir = tempfile.mkdtemp()
+   serial = os.path.join(tmpdir, 'serial')
+   parallel = os.path.join(tmpdir, 'parallel')
+   checks = []
+   try:
+      profile = build_profile(serial)
+      docnames = set(name[:-4] for name in os.listdir(SOURCE_DIR) if name.endswith('.rst'))
+      checks.append(("profile written", profile is not None))
+      if profile is None:
+         report(checks)
+      handlers = get_counts(profile['handlers'])
+      checks += [
+         ("every page profiled", set(profile['documents']) == docnames),
+         ("visits counted", handlers.get('visit_paragraph', 0) > 0 and
+          handlers['visit_paragraph'] == get_counts(profile['nodes'])['paragraph']),
+         ("departures counted", handlers.get('depart_paragraph') == handlers['visit_paragraph']),
+         ("group depths measured", profile['documents']['test-page']['max_group_depth'] > 0),
+      ]
+
+      # the pages written by -j workers are profiled there, and added to the totals.
+      parallel_profile = build_profile(parallel, '-j', '4')
+      processes = [event['args']['name'] for event in read_trace(parallel)
+                   if event['name'] == 'process_name']
+      checks += [
+         ("pages written by workers", any(name.startswith('worker') for name in processes)),
+         ("workers' pages profiled", parallel_profile is not None
+                                     and set(parallel_profile['documents']) == docnames),
+         ("workers' counts added up",
+          get_counts(parallel_profile['nodes']) == get_counts(profile['nodes'])
+          and get_counts(parallel_profile['handlers']) == handlers),
+         ("workers' group depths kept",
+          dict((docname, doc['max_group_depth'])
+               for docname, doc in parallel_profile['documents'].items()) ==
+          dict((docname, doc['max_group_depth'])
+               for docname, doc in profile['documents'].items())),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
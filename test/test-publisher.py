@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import sys, os, json, shutil, tempfile, threading
+import xml.etree.ElementTree as ET
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from abstrys.sphinx_xwiki_publisher import (XWikiPublisher, PUBLISH_MANIFEST_FILENAME,
+   publish_outdir)
+
+class StubXWiki(BaseHTTPRequestHandler):
+   """
+   A stand-in for the XWiki REST API. It stores the pages and attachments it's sent (failing the
+   first request for each path with a 503, to exercise the retries) and returns them as JSON. Like
+   XWiki, it answers a PUT of a page that hasn't changed with a 304.
+   """
+   protocol_version = "HTTP/1.1"
+   pages = {}
+   bodies = {}
+   attachments = {}
+   refuse_attachments = False
+   puts = []
+   downloads = []
+   seen = set()
+   connections = set()
+   lock = threading.Lock()
+
+   def reply(self, status, data=b''):
+      self.send_response(status)
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+   def do_PUT(self):
+      body = self.rfile.read(int(self.headers['Content-Length']))
+      with self.lock:
+         self.connections.add(self.client_address)
+         if self.path not in self.seen:
+            self.seen.add(self.path)
+            return self.reply(503)
+         self.puts.append(self.path)
+         if '/attachments/' in self.path:
+            if self.refuse_attachments:
+               return self.reply(403)
+            self.attachments[self.path] = body
+         elif self.bodies.get(self.path) == body:
+            return self.reply(304)
+         else:
+            self.bodies[self.path] = body
+            page = ET.fromstring(body)
+            ns = '{http://www.xwiki.org}'
+            self.pages[self.path] = {'title': page.find(ns + 'title').text or '',
+                                     'content': page.find(ns + 'content').text or ''}
+      self.reply(201)
+
+   def do_DELETE(self):
+      with self.lock:
+         found = self.pages.pop(self.path, None) or self.attachments.pop(self.path, None)
+      self.reply(204 if found else 404)
+
+   def do_GET(self):
+      if self.path.endswith('/attachments'):
+         listing = [{'name': p.rsplit('/', 1)[1], 'longSize': len(body)}
+                    for p, body in self.attachments.items() if p.startswith(self.path + '/')]
+         data = json.dumps({'attachments': listing}).encode('utf-8')
+      elif self.path in self.attachments:
+         self.downloads.append(self.path)
+         data = self.attachments[self.path]
+      elif self.path in self.pages:
+         data = json.dumps(self.pages[self.path]).encode('utf-8')
+      else:
+         return self.reply(404)
+      self.reply(200, data)
+
+   def log_message(self, *args):
+      pass
+
+def write_outdir(outdir, count, changed=None, image=b'not really a png'):
+   """
+   Writes a fake xwiki builder output directory with *count* pages.
+   """
+   os.makedirs(os.path.join(outdir, 'attachments'), exist_ok=True)
+   with open(os.path.join(outdir, 'attachments', 'image.png'), 'wb') as f:
+      f.write(image)
+   index = {}
+   for i in range(count):
+      page_name = 'Page%d' % i
+      index['page%d' % i] = {'filename': page_name + '.xwiki', 'page_name': page_name,
+         'reference': 'Root.' + page_name, 'title': 'Page <%d>' % i,
+         'attachments': ['image.png'] if i == 0 else []}
+      with open(os.path.join(outdir, page_name + '.xwiki'), 'w') as f:
+         f.write('= Page %d =%s' % (i, ' (changed)' if i == changed else ''))
+   with open(os.path.join(outdir, 'xwiki-pages.json'), 'w') as f:
+      json.dump(index, f)
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_publisher.XWikiPublisher:")
+
+   server = ThreadingHTTPServer(('127.0.0.1', 0), StubXWiki)
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   url = "http://127.0.0.1:%d/xwiki" % server.server_address[1]
+   page0 = "/xwiki/rest/wikis/xwiki/spaces/Root/spaces/Page0/pages/WebHome"
+   page3 = "/xwiki/rest/wikis/xwiki/spaces/Root/spaces/Page3/pages/WebHome"
+   outdir = tempfile.mkdtemp()
+   log = lambda line: None
+   checks = []
+
+   try:
+      publisher = XWikiPublisher(url, jobs=4, retries=2, backoff=0.01)
+      write_outdir(outdir, 20)
+      stats = publish_outdir(publisher, outdir, log=log)
+      checks += [
+         ("all pages published", stats['created'] == 20 and stats['failed'] == 0),
+         ("attachments published", stats['attachments'] == 1),
+         ("pages PUT to nested spaces", page3 in StubXWiki.pages),
+         ("titles escaped", StubXWiki.pages[page3]['title'] == "Page <3>"),
+         ("connections reused", len(StubXWiki.connections) <= 4),
+         ("throughput reported", stats['pages_per_second'] > 0),
+      ]
+
+      # change one page and remove another: only those are sent.
+      write_outdir(outdir, 19, changed=3)
+      del StubXWiki.puts[:]
+      stats = publish_outdir(publisher, outdir, log=log)
+      checks += [
+         ("only changes published", (stats['created'], stats['updated'], stats['deleted'],
+                                     stats['unchanged']) == (0, 1, 1, 18)),
+         ("only the changed page sent", StubXWiki.puts == [page3]),
+         ("removed page deleted", len(StubXWiki.pages) == 19),
+      ]
+
+      # the page is sent but its attachment isn't, so it's sent again (Not Modified) next time.
+      write_outdir(outdir, 19, changed=0, image=b'still not a png')
+      StubXWiki.refuse_attachments = True
+      failed = []
+      stats = publish_outdir(publisher, outdir, log=log,
+                             on_error=lambda change, error: failed.append(change['page_name']))
+      StubXWiki.refuse_attachments = False
+      del StubXWiki.puts[:]
+      retried = publish_outdir(publisher, outdir, log=log)
+      checks += [
+         ("failed attachment fails the page", stats['failed'] == 1 and failed == ['Page0']),
+         ("unchanged page resent after a failure", retried['failed'] == 0
+                                                   and retried['updated'] == 1
+                                                   and StubXWiki.puts[0] == page0),
+         ("attachment sent after a failure",
+          StubXWiki.attachments[page0 + '/attachments/image.png'] == b'still not a png'),
+      ]
+
+      # rebuild the manifest from the server: nothing has changed.
+      os.remove(os.path.join(outdir, PUBLISH_MANIFEST_FILENAME))
+      lines = []
+      publish_outdir(publisher, outdir, dry_run=True, log=lines.append)
+      checks += [
+         ("manifest rebuilt from the server", lines[-1].startswith("0 changes")),
+         ("attachment of the same size downloaded", len(StubXWiki.downloads) == 1),
+      ]
+
+      # an attachment of another size is changed, without downloading it.
+      write_outdir(outdir, 19, changed=0, image=b'a different size')
+      del StubXWiki.downloads[:]
+      lines = []
+      publish_outdir(publisher, outdir, dry_run=True, rebuild=True, log=lines.append)
+      checks += [
+         ("attachment of another size changed", lines[-1].startswith("1 changes")
+                                                and "upload image.png" in lines[-2]),
+         ("attachment of another size not downloaded", StubXWiki.downloads == []),
+      ]
+   finally:
+      server.shutdown()
+      shutil.rmtree(outdir)
+
+   for name, passed in checks:
+      print("%s -- %s" % (name, "passed" if passed else "failed"))
+      if not passed:
+         sys.exit(1)
+
+   sys.exit(0)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import os, shutil, tempfile
+from xwikitest import SOURCE_DIR, build, read_trace, same_output, report
+
+# (name, template, whether pages can be streamed through it): they can only be streamed through a
+# template that includes the page contents exactly once, as they are.
+TEMPLATES = [
+   ("no template", None, True),
+   ("a template with the page contents once", "= <<page_name>> =\n\n<<page_contents>>\n", True),
+   ("a template with the page contents twice", "<<page_contents>>\n----\n<<page_contents>>\n",
+    False),
+   ("a template that changes the page contents", "<<page_contents|upper>>\n", False),
+]
+
+def build_renders(outdir, *options):
+   """
+   Builds the test docs from scratch, returning the number of times each page was rendered, or
+   None if the build fails.
+   """
+   if build(SOURCE_DIR, outdir, '-E', '-D', 'xwiki_trace_filename=trace.json',
+            *options).returncode != 0:
+      return None
+   renders = {}
+   for event in read_trace(outdir):
+      if event['name'] == 'render':
+         docname = event['args']['docname']
+         renders[docname] = renders.get(docname, 0) + 1
+   return renders
+
+if __name__ == "__main__":
+   print("Testing xwiki_stream_output:")
+
+   tmpdir = tempfile.mkdtemp()
+   checks = []
+   try:
+      for i, (name, text, streamable) in enumerate(TEMPLATES):
+         options = []
+         if text is not None:
+            template = os.path.join(tmpdir, 'template%d.xwiki' % i)
+            with open(template, 'w') as f:
+               f.write(text)
+            options = ['-D', 'xwiki_page_template=%s' % template]
+         in_memory = os.path.join(tmpdir, 'in-memory%d' % i)
+         streamed = os.path.join(tmpdir, 'streamed%d' % i)
+         build_renders(in_memory, *options)
+         # a streamed page is rendered once, to find the header and footer around its contents;
+         # a page that can't be streamed is then rendered again, in full.
+         renders = build_renders(streamed, '-D', 'xwiki_stream_output=1', *options)
+         checks += [
+            ("pages %s with %s" % ("streamed" if streamable else "rendered in full", name),
+             renders is not None and set(renders.values()) == set([1 if streamable else 2])),
+            ("streamed output the same as in-memory output with %s" % name,
+             same_output(in_memory, streamed)),
+         ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
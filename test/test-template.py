@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import os, shutil, tempfile
+from xwikitest import TEST_DOCS, build, copy_source, read_trace, same_output, report
+
+def build_spans(srcdir, outdir, *options):
+   """
+   Builds the docs in *srcdir* with a build trace, returning the set of docnames that had each
+   span ('translate', 'render', ...) in the trace, or None if the build fails.
+   """
+   if build(srcdir, outdir, '-D', 'xwiki_trace_filename=trace.json', *options).returncode != 0:
+      return None
+   spans = {}
+   for event in read_trace(outdir):
+      if 'docname' in event.get('args', {}):
+         spans.setdefault(event['name'], set()).add(event['args']['docname'])
+   return spans
+
+if __name__ == "__main__":
+   print("Testing re-rendering pages when only xwiki_page_template changes:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = copy_source(tmpdir)
+   outdir = os.path.join(tmpdir, 'out')
+   template = os.path.join(tmpdir, 'template.xwiki')
+   checks = []
+   try:
+      shutil.copy(os.path.join(TEST_DOCS, 'templates', 'test_template.xwiki'), template)
+      with open(os.path.join(srcdir, 'conf.py'), 'a') as f:
+         f.write("\nxwiki_page_template = %r\n" % template)
+      docnames = set(name[:-4] for name in os.listdir(srcdir) if name.endswith('.rst'))
+      spans = build_spans(srcdir, outdir)
+      checks.append(("first build translates every page",
+                     spans is not None and spans.get('translate') == docnames))
+
+      # a new template: the pages are rendered again from their stored bodies.
+      with open(template, 'a') as f:
+         f.write("\nA new footer.\n")
+      spans = build_spans(srcdir, outdir)
+      checks += [
+         ("stored bodies kept", all(os.path.exists(os.path.join(outdir, '.doctrees',
+                                    'xwiki-bodies', docname + '.xwiki')) for docname in docnames)),
+         ("template change re-renders every page",
+          spans is not None and spans.get('render') == docnames),
+         ("template change translates nothing", spans is not None and 'translate' not in spans),
+         ("re-rendered output is the same as a clean build",
+          build_spans(srcdir, os.path.join(tmpdir, 'clean'), '-E') is not None
+          and same_output(outdir, os.path.join(tmpdir, 'clean'))),
+      ]
+
+      # the same template: the pages are translated again, but not rendered.
+      for docname in docnames:
+         os.utime(os.path.join(srcdir, docname + '.rst'))
+      spans = build_spans(srcdir, outdir)
+      checks += [
+         ("touched pages translated", spans is not None and spans.get('translate') == docnames),
+         ("unchanged template isn't rendered", spans is not None and 'render' not in spans),
+      ]
+
+      # a template included by the page template: changing it renders every page again.
+      footer = os.path.join(tmpdir, 'footer.xwiki')
+      with open(footer, 'w') as f:
+         f.write("The old footer.\n")
+      with open(template, 'a') as f:
+         f.write("\n<% include 'footer.xwiki' %>\n")
+      build_spans(srcdir, outdir)
+      with open(footer, 'w') as f:
+         f.write("The new footer.\n")
+      spans = build_spans(srcdir, outdir, '-a')
+      with open(os.path.join(outdir, 'Index.xwiki')) as f:
+         output = f.read()
+      checks += [
+         ("included template change re-renders every page on a full build",
+          spans is not None and spans.get('render') == docnames),
+         ("included template change in the output", "The new footer." in output),
+      ]
+
+      # ... and on an incremental build, without translating them.
+      with open(footer, 'w') as f:
+         f.write("The newer footer.\n")
+      spans = build_spans(srcdir, outdir)
+      with open(os.path.join(outdir, 'Index.xwiki')) as f:
+         output = f.read()
+      checks += [
+         ("included template change re-renders every page",
+          spans is not None and spans.get('render') == docnames and 'translate' not in spans),
+         ("included template change in the incremental output", "The newer footer." in output),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import sys, os, re, json, queue, shutil, signal, tempfile, threading, subprocess
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from xwikitest import TEST_DOCS, copy_source, edit, report
+
+# how long (in seconds) to wait for the watcher to report something.
+TIMEOUT = 60
+
+SERVING = re.compile(r"^serving .* at (http://[^/]+/)$")
+
+REBUILT = re.compile(r"^1 changed \(test-page\.rst\): (\d+) pages written")
+
+def start_watching(srcdir, outdir):
+   """
+   Starts watching *srcdir* (polling for changes) and serving the output, returning the process
+   and a queue that gets each line it prints.
+   """
+   process = subprocess.Popen([sys.executable, '-u', '-m', 'abstrys.sphinx_xwiki_watch', '-q',
+      '--poll', '--serve', '0', '-D', 'xwiki_root_page=Root.Page', srcdir, outdir],
+      cwd=os.path.join(TEST_DOCS, '..'), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+      universal_newlines=True)
+   lines = queue.Queue()
+   def read_lines():
+      for line in process.stdout:
+         lines.put(line.rstrip('\n'))
+   threading.Thread(target=read_lines, daemon=True).start()
+   return process, lines
+
+def wait_for(lines, pattern):
+   """
+   Returns the match of the first line (from here on) that matches *pattern*, or None if there
+   isn't one within the timeout.
+   """
+   while True:
+      try:
+         line = lines.get(timeout=TIMEOUT)
+      except queue.Empty:
+         return None
+      match = re.match(pattern, line)
+      if match is not None:
+         return match
+
+def get(url):
+   """
+   Returns (status, text) for a GET of *url*.
+   """
+   try:
+      with urlopen(url, timeout=TIMEOUT) as response:
+         return response.status, response.read().decode('utf-8')
+   except HTTPError as error:
+      return error.code, ''
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_watch:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = copy_source(tmpdir)
+   outdir = os.path.join(tmpdir, 'out')
+   process, lines = start_watching(srcdir, outdir)
+   checks = []
+   try:
+      serving = wait_for(lines, SERVING)
+      watching = wait_for(lines, r"^watching .* for changes \(polling\)$")
+      checks.append(("output served and sources watched",
+                     serving is not None and watching is not None))
+      if None in (serving, watching):
+         report(checks)
+      url = serving.group(1)
+
+      status, listing = get(url)
+      pages = json.loads(listing) if status == 200 else []
+      status, page = get(url + 'TestPage')
+      checks += [
+         ("pages listed", sorted(page['page_name'] for page in pages)
+                          == ['Index', 'TestPage', 'TestPage2', 'TestPage2a']),
+         ("page served", status == 200 and "= Markup test =" in page),
+         ("page served by docname", get(url + 'test-page') == (status, page)),
+         ("unknown page not found", get(url + 'NoSuchPage')[0] == 404),
+      ]
+
+      # a new title: the page is written again, along with the pages whose links show the title.
+      edit(os.path.join(srcdir, 'test-page.rst'), "Markup test", "Markup tests")
+      rebuilt = wait_for(lines, REBUILT)
+      status, page = get(url + 'TestPage')
+      status2, page2 = get(url + 'TestPage2')
+      checks += [
+         ("changed page and its linkers rebuilt",
+          rebuilt is not None and int(rebuilt.group(1)) == 3),
+         ("changed page served", status == 200 and "= Markup tests =" in page),
+         ("linking page served with the new title",
+          status2 == 200 and "[[//Markup tests//>>Root.Page.TestPage]]" in page2),
+      ]
+   finally:
+      process.send_signal(signal.SIGINT)
+      try:
+         process.wait(timeout=TIMEOUT)
+      except subprocess.TimeoutExpired:
+         process.kill()
+      shutil.rmtree(tmpdir)
+
+   report(checks)
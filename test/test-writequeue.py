@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import sys, os, shutil, tempfile
+from abstrys.sphinx_xwiki_trace import TraceBuffer
+from abstrys.sphinx_xwiki_writequeue import WriteQueue
+
+def read(path):
+   with open(path, 'rb') as f:
+      return f.read()
+
+def raises(func, *args):
+   """
+   Returns the exception raised by calling *func*, or None.
+   """
+   try:
+      func(*args)
+   except Exception as e:
+      return e
+   return None
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_writequeue.WriteQueue:")
+
+   tmpdir = tempfile.mkdtemp()
+   checks = []
+   try:
+      # files are written in the order they're queued, and all of them are written by flush().
+      trace = TraceBuffer()
+      write_queue = WriteQueue(maxsize=4, trace=trace)
+      paths = [os.path.join(tmpdir, 'page%d.xwiki' % i) for i in range(20)]
+      for i, path in enumerate(paths):
+         write_queue.put(path, b'page %d' % i, 'page%d' % i)
+      for i in range(5):
+         write_queue.put(paths[0], b'page 0, version %d' % i, 'page0')
+      write_queue.flush()
+      checks += [
+         ("every file written by flush()",
+          all(read(path) == b'page %d' % i for i, path in enumerate(paths[1:], 1))),
+         ("later writes of a file win", read(paths[0]) == b'page 0, version 4'),
+         ("files written in order", [span[5]['docname'] for span in trace.spans]
+                                    == ['page%d' % i for i in range(20)] + ['page0'] * 5),
+         ("queue usable after flush()", raises(write_queue.put, paths[1], b'again') is None
+                                        and raises(write_queue.flush) is None
+                                        and read(paths[1]) == b'again'),
+      ]
+
+      # the first error fails the queue for good; nothing is written after it.
+      write_queue = WriteQueue()
+      missing = os.path.join(tmpdir, 'missing', 'page.xwiki')
+      after = os.path.join(tmpdir, 'after.xwiki')
+      write_queue.put(missing, b'lost')
+      write_queue.put(after, b'not written')
+      error = raises(write_queue.flush)
+      checks += [
+         ("error raised by flush()", isinstance(error, OSError)),
+         ("nothing written after an error", not os.path.exists(after)),
+         ("error raised by later put()", raises(write_queue.put, after, b'still not written')
+                                         is error),
+         ("error raised by later flush()", raises(write_queue.flush) is error),
+         ("nothing written after the error is raised", not os.path.exists(after)),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   for name, passed in checks:
+      print("%s -- %s" % (name, "passed" if passed else "failed"))
+      if not passed:
+         sys.exit(1)
+
+   sys.exit(0)
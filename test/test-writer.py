@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import sys, os
+from docutils.core import publish_doctree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+
+from abstrys.sphinx_xwiki_writer import XWikiTranslator
+from corpus import generate_page
+
+# the output of the writer that flattened each nested group into a string (before groups were
+# rendered from a group tree), for nested_source().
+EXPECTED_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nested-12.xwiki')
+
+def nested_tables(depth, indent=""):
+   """
+   Returns the lines of a list item holding an admonition holding a table, with the next level in
+   one of the table's cells.
+   """
+   lines = ["%s* item %d" % (indent, depth), "",
+            "%s  .. warning::" % indent, "",
+            "%s     warning %d" % (indent, depth), "",
+            "%s     .. list-table::" % indent, "",
+            "%s        * - cell %d" % (indent, depth),
+            "%s          - cell text" % indent, ""]
+   if depth > 1:
+      lines.extend(nested_tables(depth - 1, indent + " " * 12))
+   return lines
+
+def nested_source(nesting=12):
+   """
+   Returns a page from the benchmark corpus with lists and admonitions nested *nesting* deep,
+   followed by tables nested as deeply.
+   """
+   source = generate_page(0, sections=3, nesting=nesting, link_density=0, literal_lines=3)
+   return source + "\n" + "\n".join(nested_tables(nesting)) + "\n"
+
+def translate(source):
+   doctree = publish_doctree(source, settings_overrides={'report_level': 5})
+   visitor = XWikiTranslator(doctree)
+   doctree.walkabout(visitor)
+   return visitor.astext()
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_writer.XWikiTranslator:")
+
+   with open(EXPECTED_FILENAME, encoding='utf-8') as f:
+      expected = f.read()
+   output = translate(nested_source())
+
+   checks = [
+      ("nested groups unchanged at nesting 12", output == expected),
+   ]
+
+   for name, passed in checks:
+      print("%s -- %s" % (name, "passed" if passed else "failed"))
+      if not passed:
+         sys.exit(1)
+
+   sys.exit(0)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os, time, shutil, tempfile, threading, zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xwikitest import build, copy_source, report
+
+class EmptyXWiki(BaseHTTPRequestHandler):
+   """
+   A stand-in for an XWiki instance with no pages.
+   """
+   def do_GET(self):
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+
+   def log_message(self, *args):
+      pass
+
+def build_xar(srcdir, outdir, *options):
+   """
+   Builds the docs in *srcdir* from scratch with a XAR package, returning the package's contents
+   (as bytes), or None if the build fails.
+   """
+   if build(srcdir, outdir, '-E', '-D', 'xwiki_xar_filename=docs.xar', *options).returncode != 0:
+      return None
+   with open(os.path.join(outdir, 'docs.xar'), 'rb') as f:
+      return f.read()
+
+if __name__ == "__main__":
+   print("Testing abstrys.sphinx_xwiki_xar.XarWriter:")
+
+   tmpdir = tempfile.mkdtemp()
+   srcdir = copy_source(tmpdir)
+   checks = []
+   try:
+      first = build_xar(srcdir, os.path.join(tmpdir, 'out1'))
+
+      # build again later, from sources with other mtimes, in parallel.
+      mtime = time.time() - 86400
+      for dirpath, dirnames, filenames in os.walk(srcdir):
+         for name in filenames:
+            os.utime(os.path.join(dirpath, name), (mtime, mtime))
+      second = build_xar(srcdir, os.path.join(tmpdir, 'out2'), '-j', '2')
+
+      names = zipfile.ZipFile(os.path.join(tmpdir, 'out1', 'docs.xar')).namelist()
+      checks += [
+         ("package written", first is not None and 'package.xml' in names),
+         ("every page packaged", len([name for name in names if name.endswith('.xml')]) == 5),
+         ("package is the same for the same docs", first == second),
+      ]
+
+      # a link to the general index, which isn't a page in the doc set, doesn't add a page to be
+      # packaged or published.
+      with open(os.path.join(srcdir, 'index.rst'), 'a') as f:
+         f.write("\nSee the :ref:`genindex`.\n")
+      server = ThreadingHTTPServer(('127.0.0.1', 0), EmptyXWiki)
+      threading.Thread(target=server.serve_forever, daemon=True).start()
+      try:
+         process = build(srcdir, os.path.join(tmpdir, 'out3'), '-D', 'xwiki_xar_filename=docs.xar',
+            '-D', 'xwiki_publish_url=http://127.0.0.1:%d/xwiki' % server.server_address[1],
+            '-D', 'xwiki_publish_dry_run=1')
+      finally:
+         server.shutdown()
+      checks += [
+         ("link to the general index packaged",
+          process.returncode == 0 and "4 pages" in process.stdout),
+         ("link to the general index published", "4 changes" in process.stdout),
+      ]
+   finally:
+      shutil.rmtree(tmpdir)
+
+   report(checks)
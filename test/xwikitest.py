@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#===============================================================================
+#
+# Helpers shared by the test scripts in this directory: building docs with the
+# xwiki builder in a separate process, reading what the build reported, and
+# comparing output directories.
+#
+#===============================================================================
+
+import sys, os, re, json, shutil, filecmp, subprocess
+
+TEST_DOCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_docs')
+
+SOURCE_DIR = os.path.join(TEST_DOCS, 'source')
+
+PAGE_STATS = re.compile(r"(\d+) pages written, (\d+) unchanged, (\d+) removed")
+
+WRITING = re.compile(r"^writing output\.\.\. \[\s*\d+%\] (\S+)$", re.M)
+
+def build_command(srcdir, outdir, *options, **kwargs):
+   """
+   Returns the command line that builds the docs in *srcdir* to *outdir* with the xwiki builder.
+
+   options:
+      Extra sphinx-build options ('-E', '-D', 'name=value', ...).
+   code:
+      If set, Python code that's run instead of ``python -m sphinx``, with the rest of the command
+      line in ``sys.argv[1:]``.
+   """
+   code = kwargs.get('code')
+   command = [sys.executable] + (['-c', code] if code else ['-m', 'sphinx'])
+   return command + ['-b', 'xwiki', '-D', 'xwiki_root_page=Root.Page'] + list(options) + [
+      srcdir, outdir]
+
+def build(srcdir, outdir, *options, **kwargs):
+   """
+   Builds the docs in *srcdir* (incrementally, if *outdir* has been built before), returning the
+   finished process, with its output in ``stdout`` and ``stderr``. Takes the same arguments as
+   build_command().
+   """
+   return subprocess.run(build_command(srcdir, outdir, *options, **kwargs),
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+def start_build(srcdir, outdir, *options, **kwargs):
+   """
+   Like build(), but returns the process as soon as it has started.
+   """
+   return subprocess.Popen(build_command(srcdir, outdir, *options, **kwargs),
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+def get_page_stats(process):
+   """
+   Returns the number of pages (written, unchanged, removed) reported by a build, or None if the
+   build failed.
+   """
+   match = PAGE_STATS.search(process.stdout)
+   if process.returncode != 0 or match is None:
+      return None
+   return tuple(int(count) for count in match.groups())
+
+def get_written_docnames(process):
+   """
+   Returns the set of docnames that a build wrote, or None if the build failed.
+   """
+   if process.returncode != 0:
+      return None
+   return set(WRITING.findall(process.stdout))
+
+def read_trace(outdir, filename='trace.json'):
+   """
+   Returns the events of the build trace written to *outdir* (with xwiki_trace_filename).
+   """
+   with open(os.path.join(outdir, filename)) as f:
+      return json.load(f)['traceEvents']
+
+def copy_source(tmpdir, source_dir=SOURCE_DIR):
+   """
+   Copies the test docs to *tmpdir*, so they can be changed, returning the path of the copy.
+   """
+   srcdir = os.path.join(tmpdir, 'source')
+   shutil.copytree(source_dir, srcdir)
+   return srcdir
+
+def same_output(dir1, dir2, names=()):
+   """
+   Returns True if two output directories have the same files, and the same pages (and any other
+   files in *names*) byte for byte.
+   """
+   comparison = filecmp.dircmp(dir1, dir2, ignore=['.doctrees', '.buildinfo'])
+   compared = [name for name in comparison.common_files
+               if name.endswith('.xwiki') or name in names]
+   return not (comparison.left_only or comparison.right_only or
+               filecmp.cmpfiles(dir1, dir2, compared, shallow=False)[1])
+
+def edit(path, old, new):
+   """
+   Replaces *old* with *new* in a file.
+   """
+   with open(path) as f:
+      text = f.read()
+   with open(path, 'w') as f:
+      f.write(text.replace(old, new))
+
+def report(checks):
+   """
+   Prints the result of each (name, passed) check, and exits: with 1 at the first failed check,
+   otherwise with 0.
+   """
+   for name, passed in checks:
+      print("%s -- %s" % (name, "passed" if passed else "failed"))
+      if not passed:
+         sys.exit(1)
+   sys.exit(0)